@@ -0,0 +1,115 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import sys
+import numpy as np
+from contextlib import closing
+
+sys.path += [os.path.abspath('../django')]
+import OCP.settings
+os.environ['DJANGO_SETTINGS_MODULE'] = 'OCP.settings'
+from django.conf import settings
+
+import django
+django.setup()
+
+import ocplib
+import ocpcaproj
+import ocpcadb
+import cubeexists
+from ocptype import TIMESERIES_CHANNELS, MYSQL
+
+#
+#  Build the cuboid existence bitmaps of a channel.
+#
+#  Writers set bits whether or not the bitmaps are complete so the
+#    channel can be written while this runs.  The READY record is
+#    written last and only then do reads skip missing cuboids.
+#
+
+# cuboids looked up in each read
+CUBE_BATCH = 4096
+
+
+def existingCubes ( db, ch, res, zidxs ):
+  """The zindexes of the cuboids in the channel.  Reads the kvio directly to bypass the bitmaps."""
+
+  if db.KVENGINE == MYSQL:
+    with closing ( db.conn.cursor() ) as cursor:
+      cursor.execute ( "SELECT zindex FROM {}".format(ch.getTable(res)) )
+      return [ int(zidx) for ( zidx, ) in cursor.fetchall() ]
+
+  existing = []
+  for start in range ( 0, len(zidxs), CUBE_BATCH ):
+    existing += [ zidx for zidx, cubestr in db.kvio.getCubes ( ch, zidxs[start:start+CUBE_BATCH], res ) ]
+  return existing
+
+
+def main():
+
+  parser = argparse.ArgumentParser(description='Build the cuboid existence bitmaps of a channel.')
+  parser.add_argument('token', action="store", help='Project token')
+  parser.add_argument('channel', action="store", help='Channel name')
+  parser.add_argument('--resolution', type=int, action="store", default=None, help='Only this resolution')
+
+  result = parser.parse_args()
+
+  with closing ( ocpcaproj.OCPCAProjectsDB() ) as projdb:
+    proj = projdb.loadToken ( result.token )
+
+  ch = proj.getChannelObj ( result.channel )
+  if ch.getChannelType() in TIMESERIES_CHANNELS:
+    print "Timeseries channels don't have existence bitmaps"
+    sys.exit(-1)
+
+  if result.resolution is not None:
+    resolutions = [ result.resolution ]
+  else:
+    resolutions = proj.datasetcfg.getResolutions()
+
+  with closing ( ocpcadb.OCPCADB(proj) ) as db:
+
+    if getattr ( db.kvio, 'mergeExistsBlocks', None ) is None:
+      print "The {} engine doesn't keep existence bitmaps".format(proj.getKVEngine())
+      sys.exit(-1)
+
+    if db.KVENGINE == MYSQL:
+      with closing ( db.conn.cursor() ) as cursor:
+        cursor.execute ( "CREATE TABLE IF NOT EXISTS {} ( resolution INT, block BIGINT, bitmap BLOB, PRIMARY KEY(resolution,block))".format(ch.getExistsTable()) )
+      db.conn.commit()
+
+    for res in resolutions:
+
+      [[ximagesz, yimagesz, zimagesz], timerange] = proj.datasetcfg.imageSize(res)
+      [xcubedim, ycubedim, zcubedim] = proj.datasetcfg.getCubeDims()[res]
+
+      xlimit = (ximagesz-1) / xcubedim + 1
+      ylimit = (yimagesz-1) / ycubedim + 1
+      zlimit = (zimagesz-1) / zcubedim + 1
+
+      zidxs = np.sort ( ocplib.XYZMortonBatch ( ocplib.XYZBox ( [0,0,0], [xlimit,ylimit,zlimit] ) ) ).tolist()
+      existing = existingCubes ( db, ch, res, zidxs )
+
+      bitmaps = cubeexists.buildBitmaps ( existing )
+      if bitmaps:
+        db.kvio.mergeExistsBlocks ( ch, res, bitmaps )
+      db.kvio.mergeExistsBlocks ( ch, res, { cubeexists.READY : '' } )
+
+      print "Resolution {}: {} cuboids in {} blocks".format(res, len(existing), len(bitmaps))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,67 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import sys
+from contextlib import closing
+
+sys.path += [os.path.abspath('../django')]
+import OCP.settings
+os.environ['DJANGO_SETTINGS_MODULE'] = 'OCP.settings'
+from django.conf import settings
+
+import django
+django.setup()
+
+import ocpcaproj
+import ocpcadb
+
+#
+#  Compact the value logs of a project in the File engine or a tiered local store.
+#
+#  The live values of each channel are copied to a new log.  Readers are
+#    not interrupted but writers to the project wait for each channel.
+#
+
+
+def main():
+
+  parser = argparse.ArgumentParser(description='Reclaim the space of overwritten and deleted values in the logs of a File or tiered project.')
+  parser.add_argument('token', action="store", help='Project token')
+  parser.add_argument('--channel', action="store", default=None, help='Only this channel')
+
+  result = parser.parse_args()
+
+  with closing ( ocpcaproj.OCPCAProjectsDB() ) as projdb:
+    proj = projdb.loadToken ( result.token )
+
+  if result.channel is not None:
+    channels = [ proj.getChannelObj ( result.channel ) ]
+  else:
+    channels = list ( proj.projectChannels() )
+
+  with closing ( ocpcadb.OCPCADB(proj) ) as db:
+
+    if getattr ( db.kvio, 'compactLog', None ) is None:
+      print "Project {} does not keep value logs".format(proj.getProjectName())
+      sys.exit(-1)
+
+    for ch in channels:
+      reclaimed = db.kvio.compactLog ( ch )
+      print "Channel {}: reclaimed {} bytes".format(ch.getChannelName(), reclaimed)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,94 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import sys
+from contextlib import closing
+
+sys.path += [os.path.abspath('../django')]
+import OCP.settings
+os.environ['DJANGO_SETTINGS_MODULE'] = 'OCP.settings'
+from django.conf import settings
+
+import django
+django.setup()
+
+import ocpcaproj
+import ocpcadb
+from ocptype import ANNOTATION_CHANNELS, MYSQL
+
+#
+#  Add the index delta log to an annotation channel and compact its indexes.
+#
+#  Every index is rewritten as sorted runs with its deltas folded in.
+#    Each batch of BATCH annotations is compacted in its own transaction
+#    so the channel can be written while this runs.
+#
+
+# annotations per transaction
+BATCH = 256
+
+
+def main():
+
+  parser = argparse.ArgumentParser(description='Add the index delta log to an annotation channel and compact its indexes.')
+  parser.add_argument('token', action="store", help='Project token')
+  parser.add_argument('channel', action="store", help='Channel name')
+  parser.add_argument('--resolution', type=int, action="store", default=None, help='Only this resolution')
+
+  result = parser.parse_args()
+
+  with closing ( ocpcaproj.OCPCAProjectsDB() ) as projdb:
+    proj = projdb.loadToken ( result.token )
+
+  ch = proj.getChannelObj ( result.channel )
+  if ch.getChannelType() not in ANNOTATION_CHANNELS:
+    print "Only annotation channels have indexes"
+    sys.exit(-1)
+
+  if proj.getKVEngine() != MYSQL:
+    print "The {} engine doesn't keep an index delta log".format(proj.getKVEngine())
+    sys.exit(-1)
+
+  if result.resolution is not None:
+    resolutions = [ result.resolution ]
+  else:
+    resolutions = proj.datasetcfg.getResolutions()
+
+  with closing ( ocpcadb.OCPCADB(proj) ) as db:
+
+    for res in resolutions:
+
+      with closing ( db.conn.cursor() ) as cursor:
+        cursor.execute ( "CREATE TABLE IF NOT EXISTS {} ( seq BIGINT AUTO_INCREMENT PRIMARY KEY, annid BIGINT, delta LONGBLOB, INDEX ( annid, seq ) )".format(ch.getIdxLogTable(res)) )
+        cursor.execute ( "SELECT annid FROM {} UNION SELECT DISTINCT annid FROM {}".format(ch.getIdxTable(res), ch.getIdxLogTable(res)) )
+        annids = [ int(annid) for ( annid, ) in cursor.fetchall() ]
+      db.conn.commit()
+
+      # compact a batch of indexes per transaction
+      for i in range ( 0, len(annids), BATCH ):
+        db.kvStartTxn()
+        try:
+          db.annoIdx.compactIndexes ( ch, annids[i:i+BATCH], res )
+        except:
+          db.kvRollback()
+          raise
+        db.kvCommit()
+
+      print "Resolution {}: compacted {} indexes".format(res, len(annids))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,101 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import sys
+import cStringIO
+import zlib
+import numpy as np
+from contextlib import closing
+
+sys.path += [os.path.abspath('../django')]
+import OCP.settings
+os.environ['DJANGO_SETTINGS_MODULE'] = 'OCP.settings'
+from django.conf import settings
+
+import django
+django.setup()
+
+import ocpcaproj
+import ocpcadb
+from ocptype import ANNOTATION_CHANNELS, MYSQL
+
+#
+#  Move the exceptions of an annotation channel into one blob per cuboid.
+#
+#  The rows of each batch of BATCH cuboids are merged into the blobs and
+#    deleted in one transaction.  Once the blob table exists the channel
+#    reads only the blobs so don't read or write the channel while this runs.
+#
+
+# cuboids per transaction
+BATCH = 256
+
+
+def main():
+
+  parser = argparse.ArgumentParser(description='Move the exceptions of an annotation channel into one blob per cuboid.')
+  parser.add_argument('token', action="store", help='Project token')
+  parser.add_argument('channel', action="store", help='Channel name')
+  parser.add_argument('--resolution', type=int, action="store", default=None, help='Only this resolution')
+
+  result = parser.parse_args()
+
+  with closing ( ocpcaproj.OCPCAProjectsDB() ) as projdb:
+    proj = projdb.loadToken ( result.token )
+
+  ch = proj.getChannelObj ( result.channel )
+  if ch.getChannelType() not in ANNOTATION_CHANNELS:
+    print "Only annotation channels have exceptions"
+    sys.exit(-1)
+
+  if proj.getKVEngine() != MYSQL:
+    print "The {} engine doesn't keep exceptions per cuboid".format(proj.getKVEngine())
+    sys.exit(-1)
+
+  if result.resolution is not None:
+    resolutions = [ result.resolution ]
+  else:
+    resolutions = proj.datasetcfg.getResolutions()
+
+  with closing ( ocpcadb.OCPCADB(proj) ) as db:
+
+    for res in resolutions:
+
+      with closing ( db.conn.cursor() ) as cursor:
+        cursor.execute ( "CREATE TABLE IF NOT EXISTS {} ( zindex BIGINT PRIMARY KEY, exlist LONGBLOB )".format(ch.getCubeExceptionsTable(res)) )
+        cursor.execute ( "SELECT DISTINCT zindex FROM {}".format(ch.getExceptionsTable(res)) )
+        zidxs = [ int(zidx) for ( zidx, ) in cursor.fetchall() ]
+      db.conn.commit()
+
+      for i in range ( 0, len(zidxs), BATCH ):
+        chunk = zidxs[i:i+BATCH]
+        db.kvStartTxn()
+        try:
+          cursor = db.kvio.txncursor
+          cursor.execute ( "SELECT zindex, id, exlist FROM {} WHERE zindex IN ({}) FOR UPDATE".format(ch.getExceptionsTable(res), ','.join(['%s']*len(chunk))), chunk )
+          listofexceptions = [ ( zidx, { int(annid) : np.load ( cStringIO.StringIO ( zlib.decompress ( exlist ) ) ) } ) for zidx, annid, exlist in cursor.fetchall() ]
+          db.updateCubeExceptions ( ch, res, listofexceptions )
+          cursor.execute ( "DELETE FROM {} WHERE zindex IN ({})".format(ch.getExceptionsTable(res), ','.join(['%s']*len(chunk))), chunk )
+        except:
+          db.kvRollback()
+          raise
+        db.kvCommit()
+
+      print "Resolution {}: packed the exceptions of {} cuboids".format(res, len(zidxs))
+
+
+if __name__ == "__main__":
+  main()
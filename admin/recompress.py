@@ -0,0 +1,159 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import sys
+import numpy as np
+from contextlib import closing
+
+sys.path += [os.path.abspath('../django')]
+import OCP.settings
+os.environ['DJANGO_SETTINGS_MODULE'] = 'OCP.settings'
+from django.conf import settings
+
+import django
+django.setup()
+
+from cube import Cube
+import ocplib
+import ocpcaproj
+import ocpcadb
+import cubecodec
+from ocptype import TIMESERIES_CHANNELS
+
+#
+#  Recompress a channel in place with the channel's codec.
+#
+#  Cuboids that are already in the codec or constant are skipped so an interrupted
+#    run can be restarted.  Reads handle mixed codecs so the channel
+#    stays available while this runs.  Cuboids are read with locking reads
+#    so a write that commits during a batch waits for it instead of being
+#    overwritten.  Neariso tables are rebuilt by propagation and are not rewritten.
+#
+
+# number of cuboids rewritten in each transaction
+CUBE_BATCH = 256
+
+
+def recompressImage ( db, ch, res, codec, zidxs ):
+  """Rewrite the cuboids of an image or annotation channel at one resolution"""
+
+  cubedim = db.datasetcfg.getCubeDims()[res]
+  cube = Cube.getCube ( cubedim, ch.getChannelType(), ch.getDataType() )
+  count = 0
+
+  for start in range ( 0, len(zidxs), CUBE_BATCH ):
+
+    db.startTxn()
+    try:
+      listofidxs = []
+      listofcubes = []
+      # lock the batch so writers wait until it is rewritten
+      for idx, datastring in list ( db.kvio.getCubes ( ch, zidxs[start:start+CUBE_BATCH], res, update=True ) ):
+        if cubecodec.codecOf ( datastring ) in [ codec, cubecodec.CONSTANT ]:
+          continue
+        cube.fromCodec ( datastring[:], db.NPZ )
+        listofidxs.append ( idx )
+        listofcubes.append ( cube.toCodec ( codec, db.NPZ ) )
+
+      if listofidxs:
+        db.putCubes ( ch, listofidxs, res, listofcubes, update=True )
+      db.commit()
+    except:
+      db.rollback()
+      raise
+
+    count += len(listofidxs)
+
+  return count
+
+
+def recompressTime ( db, ch, res, codec, zidxs ):
+  """Rewrite the cuboids of a timeseries channel at one resolution"""
+
+  cubedim = db.datasetcfg.getCubeDims()[res]
+  [ starttime, endtime ] = db.datasetcfg.getTimeRange()
+  cube = Cube.getCube ( cubedim, ch.getChannelType(), ch.getDataType() )
+  count = 0
+
+  for zidx in zidxs:
+
+    db.startTxn()
+    try:
+      for idx, timestamp, datastring in list ( db.getTimeCubes ( ch, zidx, range(starttime, endtime+1), res ) ):
+        if cubecodec.codecOf ( datastring ) in [ codec, cubecodec.CONSTANT ]:
+          continue
+        # lock the cuboid and read it again in case it was written since
+        datastring = db.kvio.getTimeCube ( ch, idx, timestamp, res, update=True )
+        if datastring is None or cubecodec.codecOf ( datastring ) in [ codec, cubecodec.CONSTANT ]:
+          continue
+        cube.fromCodec ( datastring[:], db.NPZ )
+        db.putTimeCube ( ch, idx, timestamp, res, cube, update=True )
+        count += 1
+      db.commit()
+    except:
+      db.rollback()
+      raise
+
+  return count
+
+
+def main():
+
+  parser = argparse.ArgumentParser(description='Recompress the cuboids of a channel with its codec.')
+  parser.add_argument('token', action="store", help='Project token')
+  parser.add_argument('channel', action="store", help='Channel name')
+  parser.add_argument('--codec', action="store", default=None, help='Set the channel codec before recompressing: {}'.format(', '.join(sorted(cubecodec.CODEC_IDS.keys()))))
+  parser.add_argument('--resolution', type=int, action="store", default=None, help='Only this resolution')
+
+  result = parser.parse_args()
+
+  with closing ( ocpcaproj.OCPCAProjectsDB() ) as projdb:
+    proj = projdb.loadToken ( result.token )
+
+  ch = proj.getChannelObj ( result.channel )
+  if result.codec is not None:
+    ch.setCodec ( result.codec )
+  codec = ch.getCodec()
+
+  if result.resolution is not None:
+    resolutions = [ result.resolution ]
+  else:
+    resolutions = proj.datasetcfg.getResolutions()
+
+  with closing ( ocpcadb.OCPCADB(proj) ) as db:
+
+    for res in resolutions:
+
+      [[ximagesz, yimagesz, zimagesz], timerange] = proj.datasetcfg.imageSize(res)
+      [xcubedim, ycubedim, zcubedim] = proj.datasetcfg.getCubeDims()[res]
+
+      xlimit = (ximagesz-1) / xcubedim + 1
+      ylimit = (yimagesz-1) / ycubedim + 1
+      zlimit = (zimagesz-1) / zcubedim + 1
+
+      # all the cuboids in Morton order so they are read sequentially
+      zidxs = np.sort ( ocplib.XYZMortonBatch ( ocplib.XYZBox ( [0,0,0], [xlimit,ylimit,zlimit] ) ) ).tolist()
+
+      if ch.getChannelType() in TIMESERIES_CHANNELS:
+        count = recompressTime ( db, ch, res, codec, zidxs )
+      else:
+        count = recompressImage ( db, ch, res, codec, zidxs )
+
+      print "Resolution {}: recompressed {} cuboids".format(res, count)
+
+
+if __name__ == "__main__":
+  main()
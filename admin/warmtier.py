@@ -0,0 +1,88 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import sys
+import numpy as np
+from contextlib import closing
+
+sys.path += [os.path.abspath('../django')]
+import OCP.settings
+os.environ['DJANGO_SETTINGS_MODULE'] = 'OCP.settings'
+from django.conf import settings
+
+import django
+django.setup()
+
+import ocplib
+import ocpcaproj
+import ocpcadb
+import tieredkvio
+
+#
+#  Preload the local store of a tiered project from its engine.
+#
+
+
+def main():
+
+  parser = argparse.ArgumentParser(description='Copy cuboids of a channel into the local store of a tiered project.')
+  parser.add_argument('token', action="store", help='Project token')
+  parser.add_argument('channel', action="store", help='Channel name')
+  parser.add_argument('--resolution', type=int, action="store", default=None, help='Only this resolution')
+  parser.add_argument('--box', type=int, nargs=6, action="store", default=None, metavar=('XMIN','XMAX','YMIN','YMAX','ZMIN','ZMAX'), help='Only the cuboids in this pixel box at each resolution')
+
+  result = parser.parse_args()
+
+  with closing ( ocpcaproj.OCPCAProjectsDB() ) as projdb:
+    proj = projdb.loadToken ( result.token )
+
+  ch = proj.getChannelObj ( result.channel )
+
+  if result.resolution is not None:
+    resolutions = [ result.resolution ]
+  else:
+    resolutions = proj.datasetcfg.getResolutions()
+
+  with closing ( ocpcadb.OCPCADB(proj) ) as db:
+
+    if not isinstance ( db.kvio, tieredkvio.TieredKVIO ):
+      print "Project {} does not have a local store".format(proj.getProjectName())
+      sys.exit(-1)
+
+    for res in resolutions:
+
+      [[ximagesz, yimagesz, zimagesz], timerange] = proj.datasetcfg.imageSize(res)
+      [xcubedim, ycubedim, zcubedim] = proj.datasetcfg.getCubeDims()[res]
+
+      if result.box is None:
+        [ xmin, xmax, ymin, ymax, zmin, zmax ] = [ 0, ximagesz, 0, yimagesz, 0, zimagesz ]
+      else:
+        [ xmin, xmax, ymin, ymax, zmin, zmax ] = result.box
+
+      start = [ xmin/xcubedim, ymin/ycubedim, zmin/zcubedim ]
+      numcubes = [ (xmax-1)/xcubedim+1-start[0], (ymax-1)/ycubedim+1-start[1], (zmax-1)/zcubedim+1-start[2] ]
+      if min(numcubes) <= 0:
+        continue
+
+      # all the cuboids in Morton order so they are read sequentially
+      zidxs = np.sort ( ocplib.XYZMortonBatch ( ocplib.XYZBox ( start, numcubes ) ) ).tolist()
+
+      count = db.kvio.warm ( ch, zidxs, res )
+      print "Resolution {}: copied {} cuboids".format(res, count)
+
+
+if __name__ == "__main__":
+  main()
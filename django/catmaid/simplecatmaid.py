@@ -25,6 +25,7 @@ import restargs
 import ocpcadb
 import ocpcaproj
 import ocpcarest
+import singleflight
 
 from ocpcaerror import OCPCAError
 import logging
@@ -169,6 +170,25 @@ class SimpleCatmaid:
     return cb.yzImage( scalefactor )
 
 
+  def loadTile ( self, mckey, res, slice_type, xtile, ytile, ztile, timetile=None ):
+    """Cutout a tile, load it into mocpcache and return the png"""
+
+    if slice_type == 'xy':
+      img = self.cacheMissXY(res, xtile, ytile, ztile, timetile=timetile)
+    elif slice_type == 'xz':
+      img = self.cacheMissXZ(res, xtile, ytile, ztile, timetile=timetile)
+    elif slice_type == 'yz':
+      img = self.cacheMissYZ(res, xtile, ytile, ztile, timetile=timetile)
+    else:
+      logger.warning ("Requested illegal image plance {}. Should be xy, xz, yz.".format(slice_type))
+      raise OCPCAError ("Requested illegal image plance {}. Should be xy, xz, yz.".format(slice_type))
+
+    fobj = cStringIO.StringIO ( )
+    img.save ( fobj, "PNG" )
+    self.mc.set(mckey,fobj.getvalue())
+    return fobj.getvalue()
+
+
   def getTile ( self, webargs ):
     """Fetch the file from mocpcache or get a cutout from the database"""
   
@@ -193,23 +213,11 @@ class SimpleCatmaid:
         # if tile is in mocpcache, return it
         tile = self.mc.get(mckey)
         
+        # concurrent misses of the same tile share one cutout
         if tile == None:
-          if slice_type == 'xy':
-            img = self.cacheMissXY(res, xtile, ytile, ztile, timetile=timetile)
-          elif slice_type == 'xz':
-            img = self.cacheMissXZ(res, xtile, ytile, ztile, timetile=timetile)
-          elif slice_type == 'yz':
-            img = self.cacheMissYZ(res, xtile, ytile, ztile, timetile=timetile)
-          else:
-            logger.warning ("Requested illegal image plance {}. Should be xy, xz, yz.".format(slice_type))
-            raise OCPCAError ("Requested illegal image plance {}. Should be xy, xz, yz.".format(slice_type))
-          
-          fobj = cStringIO.StringIO ( )
-          img.save ( fobj, "PNG" )
-          self.mc.set(mckey,fobj.getvalue())
-        
-        else:
-          fobj = cStringIO.StringIO(tile)
+          tile = singleflight.do ( mckey, lambda: self.loadTile(mckey, res, slice_type, xtile, ytile, ztile, timetile), self.mc )
+
+        fobj = cStringIO.StringIO(tile)
 
 
         fobj.seek(0)
@@ -0,0 +1,30 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import kvmetrics
+
+
+class ServerTimingMiddleware(object):
+  """Add the key/value, codec and assembly time of a request as a Server-Timing header when KV_METRICS is set.
+     Streamed responses only count the work done before the first byte."""
+
+  def process_request ( self, request ):
+    if kvmetrics.enabled():
+      kvmetrics.startRequest()
+
+  def process_response ( self, request, response ):
+    if kvmetrics.enabled():
+      timings, cuboids = kvmetrics.endRequest()
+      response['Server-Timing'] = kvmetrics.serverTiming ( timings, cuboids )
+    return response
@@ -18,7 +18,9 @@ from celery import task
 from django.conf import settings
 
 import h5annasync
+import annindex
 import ocpcastack
+import cutoutjob
 from ocpcaingest import IngestData
 
 import logging
@@ -42,3 +44,21 @@ def ingest (token_name, channel_name, resolution, data_url, file_format, file_ty
     ingest_data.ingest()
   except Exception, e:
     logger.error("Error in ingest. {}".format(e))
+
+@task(queue='cutout')
+def cutoutJob (jobid):
+  """Run a queued cutout and write the result to a file"""
+
+  try:
+    cutoutjob.run(jobid)
+  except Exception, e:
+    logger.error("Error in cutout job {}. {}".format(jobid, e))
+
+@task(queue='index')
+def compactIndexes (project_name, channel_name, listofids, resolution):
+  """Fold the delta logs of a list of annotation indexes into the indexes"""
+
+  try:
+    annindex.compact(project_name, channel_name, listofids, resolution)
+  except Exception, e:
+    logger.error("Error compacting {} indexes in {}. {}".format(len(listofids), project_name, e))
@@ -32,6 +32,11 @@ urlpatterns = patterns('ocpca.views',
   url(r'(?P<webargs>^\w+/volume.vikingxml)$', 'xmlinfo'),
   # get public tokens 
   url(r'(?P<webargs>^public_tokens/)$', 'publictokens'),
+  # background cutouts written to a file
+  url(r'(?P<webargs>^\w+/[\w+,]+/(hdf5|npz|blosc)_async/[\w+,/-]+)$', 'asyncCutout'),
+  url(r'(?P<webargs>^jobs/\w+/(status|download)/)$', 'cutoutJob'),
+  # key/value I/O metrics of this process
+  url(r'(?P<webargs>^metrics/)$', 'metrics'),
   # Create/Delete channel interfaces
   url(r'(?P<webargs>^\w+/createChannel/)$', 'createChannel'),
   url(r'(?P<webargs>^\w+/deleteChannel/)$', 'deleteChannel'),
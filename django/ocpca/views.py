@@ -20,6 +20,8 @@ import re
 
 import ocpcarest
 import jsonproj
+import cutoutjob
+import kvmetrics
 
 from ocpcaerror import OCPCAError
 import logging
@@ -52,7 +54,7 @@ def cutout (request, webargs):
       elif service in ['hdf5']:
         fname = re.sub ( r',','_', webargs )
         fname = re.sub ( r'/','-', fname )
-        response = django.http.HttpResponse(ocpcarest.getCutout(webargs), content_type="product/hdf5" )
+        response = django.http.StreamingHttpResponse(ocpcarest.getCutoutStream(webargs), content_type="product/hdf5" )
         response['Content-Disposition'] = "attachment; filename={}ocpcutout.h5".format(fname)
         return response
       elif service in ['blosc']:
@@ -68,12 +70,12 @@ def cutout (request, webargs):
         response['Content-Disposition'] = "attachment; filename={}ocpcutout.jpeg".format(fname)
         return response
       elif service in ['npz']:
-        return django.http.HttpResponse(ocpcarest.getCutout(webargs), content_type="product/npz" )
+        return django.http.StreamingHttpResponse(ocpcarest.getCutoutStream(webargs), content_type="product/npz" )
       elif service in ['tiff']:
         # build a file name from the webarguments
         fname = re.sub ( r',','_', webargs )
         fname = re.sub ( r'/','-', fname )
-        response = django.http.HttpResponse(ocpcarest.getCutout(webargs), content_type="image/tiff" )
+        response = django.http.StreamingHttpResponse(ocpcarest.getCutoutStream(webargs), content_type="image/tiff" )
         response['Content-Disposition'] = "attachment; filename={}ocpcutout.tif".format(fname)
         return response
       elif service in ['zip']:
@@ -245,6 +247,47 @@ def publictokens (request, webargs):
     raise OCPCAError("Unknown exception in publictokens")
 
 
+def asyncCutout (request, webargs):
+  """Queue a large cutout as a background job"""
+
+  try:
+    return django.http.HttpResponse(cutoutjob.submit(webargs), content_type="application/json")
+  except OCPCAError, e:
+    return django.http.HttpResponseNotFound(e.value)
+  except MySQLdb.Error, e:
+    return django.http.HttpResponseNotFound(e)
+  except:
+    logger.exception("Unknown exception in asyncCutout")
+    raise OCPCAError("Unknown exception in asyncCutout")
+
+def cutoutJob (request, webargs):
+  """Status and result of a background cutout"""
+
+  try:
+    m = re.match(r"jobs/(\w+)/(status|download)/$", webargs)
+    [jobid, service] = [i for i in m.groups()]
+
+    if service == 'status':
+      return django.http.HttpResponse(cutoutjob.getStatus(jobid), content_type="application/json")
+    else:
+      fileobj, content_type, fname = cutoutjob.getResult(jobid)
+      response = django.http.StreamingHttpResponse(ocpcarest.streamFile(fileobj), content_type=content_type)
+      response['Content-Disposition'] = "attachment; filename={}".format(fname)
+      return response
+  except OCPCAError, e:
+    return django.http.HttpResponseNotFound(e.value)
+  except:
+    logger.exception("Unknown exception in cutoutJob")
+    raise OCPCAError("Unknown exception in cutoutJob")
+
+def metrics (request, webargs):
+  """Return the key/value I/O metrics of this process in the Prometheus text format"""
+
+  if not kvmetrics.enabled():
+    return django.http.HttpResponseNotFound("Metrics are not enabled. Set KV_METRICS.")
+  return django.http.HttpResponse(kvmetrics.exposition(), content_type="text/plain; version=0.0.4")
+
+
 #@cache_control(no_cache=True)
 def jsoninfo (request, webargs):
   """Return project and dataset configuration information"""
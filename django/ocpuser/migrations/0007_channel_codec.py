@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ocpuser', '0006_auto_20261018_1422'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='codec',
+            field=models.CharField(default=b'', max_length=255, blank=True, choices=[(b'', b'Engine default'), (b'zlib', b'zlib'), (b'blosc', b'blosc'), (b'lz4', b'blosc lz4'), (b'zstd', b'blosc zstd')]),
+        ),
+    ]
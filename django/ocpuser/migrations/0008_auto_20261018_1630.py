@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ocpuser', '0007_channel_codec'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='project',
+            name='kvengine',
+            field=models.CharField(default=b'MySQL', max_length=255, choices=[(b'MySQL', b'MySQL'), (b'Cassandra', b'Cassandra'), (b'Riak', b'Riak'), (b'File', b'File'), (b'Aerospike', b'Aerospike')]),
+        ),
+    ]
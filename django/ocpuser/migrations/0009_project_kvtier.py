@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ocpuser', '0008_auto_20261018_1630'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='kvtier',
+            field=models.CharField(default=b'', max_length=255, blank=True, choices=[(b'', b'None'), (b'File', b'Local File')]),
+        ),
+    ]
@@ -20,7 +20,7 @@ from django.contrib import messages
 from django.contrib.auth.models import User
 from django.conf import settings
 
-from ocptype import IMAGE, ANNOTATION, TIMESERIES, UINT8, UINT16, UINT32, UINT64, FLOAT32, READONLY_TRUE, READONLY_FALSE, ZSLICES, ISOTROPIC, PUBLIC_TRUE, PUBLIC_FALSE, PROPAGATED, NOT_PROPAGATED, EXCEPTION_TRUE, EXCEPTION_FALSE
+from ocptype import IMAGE, ANNOTATION, TIMESERIES, UINT8, UINT16, UINT32, UINT64, FLOAT32, READONLY_TRUE, READONLY_FALSE, ZSLICES, ISOTROPIC, PUBLIC_TRUE, PUBLIC_FALSE, PROPAGATED, NOT_PROPAGATED, EXCEPTION_TRUE, EXCEPTION_FALSE, CODEC_DEFAULT, CODEC_ZLIB, CODEC_BLOSC, CODEC_LZ4, CODEC_ZSTD
 
 # Create your models here.
 class Dataset ( models.Model):
@@ -81,6 +81,8 @@ class Project ( models.Model):
     ('MySQL','MySQL'),
     ('Cassandra','Cassandra'),
     ('Riak','Riak'),
+    ('File','File'),
+    ('Aerospike','Aerospike'),
   )
   kvengine =  models.CharField(max_length=255, choices=KVENGINE_CHOICES, default='MySQL')
   KVSERVER_CHOICES = (
@@ -91,6 +93,11 @@ class Project ( models.Model):
     ('localhost', 'Debug'),
   )
   kvserver =  models.CharField(max_length=255, choices=KVSERVER_CHOICES, default='dsp061.pha.jhu.edu')
+  KVTIER_CHOICES = (
+    ('', 'None'),
+    ('File', 'Local File'),
+  )
+  kvtier =  models.CharField(max_length=255, choices=KVTIER_CHOICES, default='', blank=True)
 
   # Version information -- set automatically
   ocp_version =  models.CharField(max_length=255, default='0.6')
@@ -167,6 +174,15 @@ class Channel ( models.Model):
     (EXCEPTION_FALSE, 'No'),
   )
   exceptions =  models.IntegerField(choices=EXCEPTION_CHOICES, default=EXCEPTION_FALSE)
+
+  CODEC_CHOICES = (
+    (CODEC_DEFAULT, 'Engine default'),
+    (CODEC_ZLIB, 'zlib'),
+    (CODEC_BLOSC, 'blosc'),
+    (CODEC_LZ4, 'blosc lz4'),
+    (CODEC_ZSTD, 'blosc zstd'),
+  )
+  codec = models.CharField(max_length=255, choices=CODEC_CHOICES, default=CODEC_DEFAULT, blank=True)
   startwindow = models.IntegerField(default=0)
   endwindow = models.IntegerField(default=0)
   default = models.BooleanField(default=False)
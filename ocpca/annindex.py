@@ -13,110 +13,257 @@
 # limitations under the License.
 
 import numpy as np
-import array
-import cStringIO
-import tempfile
-import h5py
-import blosc
+import time
+import random
+import threading
+from contextlib import closing
+
+from django.conf import settings
+
+import indexcodec
 
 import logging
 logger=logging.getLogger("ocp")
 
+"""
+  The cuboids that hold each annotation.
+
+  An index is stored as sorted runs of cuboids, see indexcodec.  Writes
+    append the new cuboids to a delta log when the kvio has one so they
+    don't read and rewrite the whole index.  Reads union the index with
+    its deltas.  Once an annotation has ANNO_INDEX_COMPACT deltas the
+    compactIndexes task folds them into the index in the background.
+    Compactions queued in a transaction are sent when it commits with
+    one task for each channel and resolution.
+
+  Indexes of many annotations are read and written together with
+    getIndexes ( ch, [ annid ], resolution, update ) -> [ indexstr or None ] in the order of the ids
+    putIndexes ( ch, resolution, [ ( annid, indexstr ) ] )
+    deleteIndexes ( ch, resolution, [ annid ] )
+
+  A kvio supports the delta log with
+    putIndexDeltas ( ch, resolution, [ ( annid, deltastr ) ] ) -> False if the channel has no log
+    getIndexDeltas ( ch, [ annid ], resolution, update ) -> { annid : [ ( seq, deltastr ) ] } in write order or None without a log
+    deleteIndexDeltas ( ch, resolution, [ ( annid, lastseq ) ] ) deletes up to lastseq or all of them when lastseq is None
+"""
+
+# don't queue the compaction of an index again for this many seconds
+COMPACT_SECONDS = 60
+
+# ( project, channel, annid, resolution ) -> time the compaction was queued
+_compacting = {}
+_compacting_lock = threading.Lock()
+
+
+def compact ( project_name, channel_name, listofids, resolution ):
+  """Fold the delta logs of a list of annotations' indexes into the indexes.  Run by the compactIndexes task."""
+
+  # ocpcadb imports this module
+  import ocpcaproj
+  import ocpcadb
+  from ocpuser.models import Project
+
+  proj = ocpcaproj.OCPCAProject ( Project.objects.get ( project_name=project_name ) )
+  ch = proj.getChannelObj ( channel_name )
+
+  with closing ( ocpcadb.OCPCADB(proj) ) as db:
+    db.kvStartTxn()
+    try:
+      db.annoIdx.compactIndexes ( ch, listofids, resolution )
+    except:
+      db.kvRollback()
+      raise
+    db.kvCommit()
+
 
 class AnnotateIndex:
 
-  def __init__(self,kvio,proj):
-    """Give an active connection.This puts all index operations in the same transation as the calling db."""
+  def __init__(self,kvio,proj,intxn=None):
+    """Give an active connection.This puts all index operations in the same transation as the calling db.
+       intxn returns True while the db has a transaction open.  Compactions wait for flushCompactions then."""
 
     self.proj = proj
     self.kvio = kvio
+    self.intxn = intxn
 
     if self.proj.getKVEngine() == 'MySQL':
       self.NPZ = True
     else: 
       self.NPZ = False
+
+    # deltas are always read so the log can be turned off without losing them
+    self.readdeltas = getattr ( kvio, 'getIndexDeltas', None ) is not None
+    # append to the delta log instead of rewriting indexes
+    self.usedeltas = self.readdeltas and getattr ( settings, 'ANNO_INDEX_DELTAS', True )
+    # deltas of an index that start a compaction
+    self.compactdeltas = getattr ( settings, 'ANNO_INDEX_COMPACT', 16 )
+    # ( channel name, resolution ) of the logs that don't exist
+    self.nolog = set()
+    # ( channel name, resolution ) -> ( channel, set of ids ) of the compactions to queue
+    self.compactions = {}
    
 
+  def getIndexRanges ( self, ch, entityid, resolution, update=False ):
+    """Retrieve the index for the annotation with id as ranges of cuboids"""
+
+    ranges = indexcodec.decode ( self.kvio.getIndex(ch, entityid, resolution, update), self.NPZ )
+
+    deltas = self.getDeltas ( ch, [ entityid ], resolution, update ).get ( int(entityid) )
+    if not deltas:
+      return ranges
+    if len(deltas) >= self.compactdeltas:
+      self.queueCompaction ( ch, entityid, resolution )
+    return indexcodec.union ( [ ranges ] + [ indexcodec.decode ( deltastr, self.NPZ ) for seq, deltastr in deltas ] )
+
+  def getDeltas ( self, ch, listofids, resolution, update=False ):
+    """The deltas of a list of indexes by id.  Stops looking once the kvio says the resolution has no log."""
+
+    if not self.readdeltas or ( ch.getChannelName(), resolution ) in self.nolog:
+      return {}
+    deltas = self.kvio.getIndexDeltas ( ch, listofids, resolution, update )
+    if deltas is None:
+      self.nolog.add ( ( ch.getChannelName(), resolution ) )
+      return {}
+    return deltas
+
   def getIndex ( self, ch, entityid, resolution, update=False ):
     """Retrieve the index for the annotation with id"""  
-    
-    idxstr = self.kvio.getIndex(ch, entityid, resolution, update)
-    if idxstr:
-      if self.NPZ:
-        fobj = cStringIO.StringIO ( idxstr )
-        return np.load ( fobj )
-      else:
-        return blosc.unpack_array(idxstr)
-    else:
-      return []
-       
+    return indexcodec.toZidxs ( self.getIndexRanges ( ch, entityid, resolution, update ) )
   
   def putIndex ( self, ch, entityid, resolution, index, update=False ):
     """Write the index for the annotation with id"""
+    self.kvio.putIndex ( ch, entityid, resolution, indexcodec.encode ( indexcodec.toRanges ( index ) ), update )
+
+
+  def rewriteIndexes ( self, ch, listofranges, resolution ):
+    """Union the ranges in { id : ranges } and the deltas into the indexes and write them back"""
+
+    ids = sorted ( listofranges.keys() )
+    if not ids:
+      return
+
+    idxstrs = self.kvio.getIndexes ( ch, ids, resolution, True )
+    deltas = self.getDeltas ( ch, ids, resolution, True )
+
+    listofindexes = []
+    for annid, idxstr in zip ( ids, idxstrs ):
+      ranges = listofranges[annid]
+      iddeltas = deltas.get ( int(annid), [] )
+      # nothing to fold in and already stored as runs
+      if len(ranges) == 0 and not iddeltas and ( not idxstr or idxstr.startswith ( indexcodec.MAGIC ) ):
+        continue
+      newranges = indexcodec.union ( [ indexcodec.decode ( idxstr, self.NPZ ), ranges ] + [ indexcodec.decode ( deltastr, self.NPZ ) for seq, deltastr in iddeltas ] )
+      listofindexes.append ( ( annid, indexcodec.encode ( newranges ) ) )
+
+    if listofindexes:
+      self.kvio.putIndexes ( ch, resolution, listofindexes )
+
+    # deltas appended since the read are newer and stay in the log
+    if deltas:
+      self.kvio.deleteIndexDeltas ( ch, resolution, [ ( annid, iddeltas[-1][0] ) for annid, iddeltas in deltas.iteritems() if iddeltas ] )
+
+  def rewriteIndex ( self, ch, entityid, resolution, ranges ):
+    """Union ranges and the deltas into an index and write it back"""
+    self.rewriteIndexes ( ch, { entityid : ranges }, resolution )
+
+  def compactIndexes ( self, ch, listofids, resolution ):
+    """Fold the delta logs of a list of indexes into the indexes.  Legacy indexes are rewritten as runs."""
+    self.rewriteIndexes ( ch, dict ( [ ( annid, indexcodec.empty() ) for annid in listofids ] ), resolution )
+
+  def compactIndex ( self, ch, entityid, resolution ):
+    """Fold the delta log of an index into the index.  Legacy indexes are rewritten as runs."""
+    self.compactIndexes ( ch, [ entityid ], resolution )
+
+  def queueCompaction ( self, ch, entityid, resolution ):
+    """Compact an index in the background unless it was queued recently"""
+    self.queueCompactions ( ch, [ entityid ], resolution )
+
+  def queueCompactions ( self, ch, listofids, resolution ):
+    """Compact a list of indexes in the background.  Skips those queued recently."""
+
+    now = time.time()
+    ids = self.compactions.setdefault ( ( ch.getChannelName(), resolution ), ( ch, set() ) )[1]
+    with _compacting_lock:
+      for annid in listofids:
+        key = ( self.proj.getProjectName(), ch.getChannelName(), int(annid), resolution )
+        queued = _compacting.get ( key )
+        if queued is not None and now - queued < COMPACT_SECONDS:
+          continue
+        _compacting[key] = now
+        ids.add ( int(annid) )
+      # forget old entries
+      if len(_compacting) > 65536:
+        _compacting.clear()
+
+    # the task has to see the deltas so it waits for the transaction to commit
+    if self.intxn is None or not self.intxn():
+      self.flushCompactions()
+
+  def flushCompactions ( self ):
+    """Send the queued compactions with one task for each channel and resolution"""
+
+    compactions = self.compactions
+    self.compactions = {}
+
+    for ( channame, resolution ), ( ch, ids ) in compactions.iteritems():
+      if not ids:
+        continue
+      try:
+        from ocpca.tasks import compactIndexes
+        compactIndexes.delay ( self.proj.getProjectName(), channame, sorted ( ids ), resolution )
+      except Exception, e:
+        logger.warning ( "Failed to queue compaction of {} indexes in {}. {}".format(len(ids), channame, e) )
+
+  def dropCompactions ( self ):
+    """Forget the queued compactions of a transaction that rolled back so they can be queued again"""
+
+    compactions = self.compactions
+    self.compactions = {}
+
+    with _compacting_lock:
+      for ( channame, resolution ), ( ch, ids ) in compactions.iteritems():
+        for annid in ids:
+          _compacting.pop ( ( self.proj.getProjectName(), channame, annid, resolution ), None )
 
-    if self.NPZ:
-      fileobj = cStringIO.StringIO ()
-      np.save ( fileobj, index )
-      self.kvio.putIndex(ch, entityid, resolution, fileobj.getvalue(), update)
-    else:
-      self.kvio.putIndex(ch, entityid, resolution, blosc.pack_array(index), update)
 
   def updateIndexDense(self, ch, index,resolution):
     """Updated the database index table with the input index hash table"""
 
-    for key, value in index.iteritems():
-      cubelist = list(value)
-      cubeindex = np.array(cubelist, dtype=np.uint64)
-      
-      curindex = self.getIndex(ch, key,resolution,True)
-         
-      if curindex == []:
-        self.putIndex(ch, key, resolution, cubeindex, False)
-            
-      else:
-        # Update index to the union of the currentIndex and the updated index
-        newIndex = np.union1d(curindex, cubeindex)
-        self.putIndex(ch, key, resolution, newIndex, True)
+    if self.usedeltas and ( ch.getChannelName(), resolution ) not in self.nolog:
+      # append the new cuboids without reading the indexes
+      listofdeltas = [ ( key, indexcodec.encode ( indexcodec.toRanges ( list(value) ) ) ) for key, value in index.iteritems() if len(value) ]
+      if not listofdeltas:
+        return
+      if self.kvio.putIndexDeltas ( ch, resolution, listofdeltas ):
+        # without reads an index is compacted after ANNO_INDEX_COMPACT writes on average
+        self.queueCompactions ( ch, [ key for key in index.iterkeys() if random.random() * self.compactdeltas < 1.0 ], resolution )
+        return
+      # the channel predates the log
+      self.nolog.add ( ( ch.getChannelName(), resolution ) )
+
+    # read and write all the indexes in a few batched statements
+    self.rewriteIndexes ( ch, dict ( [ ( key, indexcodec.toRanges ( list(value) ) ) for key, value in index.iteritems() ] ), resolution )
 
   
   def deleteIndexResolution ( self, ch, annid, res ):
     """delete the index for a given annid at the given resolution"""
-    
-    # delete Index table for each resolution
-    self.kvio.deleteIndex(ch, annid, res)
+    self.deleteIndexes ( ch, [ annid ], [ res ] )
   
   
   def deleteIndex ( self, ch, annid, resolutions ):
     """delete the index for a given annid"""
+    self.deleteIndexes ( ch, [ annid ], resolutions )
+
+  def deleteIndexes ( self, ch, listofids, resolutions ):
+    """delete the indexes of a list of ids at each resolution"""
     
     #delete Index table for each resolution
     for res in resolutions:
-      self.kvio.deleteIndex(ch, annid,res)
+      self.kvio.deleteIndexes ( ch, res, listofids )
+      if getattr ( self.kvio, 'deleteIndexDeltas', None ) is not None:
+        self.kvio.deleteIndexDeltas ( ch, res, [ ( annid, None ) for annid in listofids ] )
 
 
   def updateIndex ( self, ch, entityid, index, resolution ):
     """Updated the database index table with the input index hash table"""
-
-    curindex = self.getIndex(ch, entityid, resolution, True)
-
-    if curindex == []:
-        
-      if self.NPZ:
-        fileobj = cStringIO.StringIO ()
-        np.save ( fileobj, index )
-        self.kvio.putIndex(ch, entityid, resolution, fileobj.getvalue())
-      else:
-        self.kvio.putIndex(ch, entityid, resolution, blosc.pack_array(index))
-
-    else :
-        
-      # Update Index to the union of the currentIndex and the updated index
-      newIndex = np.union1d(curindex, index)
-
-      # Update the index in the database
-      if self.NPZ:
-        fileobj = cStringIO.StringIO ()
-        np.save ( fileobj, newIndex )
-        self.kvio.putIndex(ch, entityid, resolution, fileobj.getvalue(), True)
-      else:
-        self.kvio.putIndex(ch, entityid, resolution, blosc.pack_array(newIndex), True)
+    self.updateIndexDense ( ch, { entityid : index }, resolution )
@@ -13,19 +13,46 @@
 # limitations under the License.
 
 import numpy as np
-import cStringIO
-import zlib
-import MySQLdb
-import re
-from collections import defaultdict
-import itertools
-
 import aerospike
+from aerospike import exception as asexception
+
+from django.conf import settings
+
+import kvpool
+
+import logging
+logger=logging.getLogger("ocp")
 
-"""Helpers function to do cube I/O in across multiple DBs.
-    This file is aerospike
+"""Helpers function to do cube I/O in Aerospike.
+    Each project is a set in the AEROSPIKE_NAMESPACE namespace and keys
+    are prefixed with the channel name.  Values are stored as bytes in
+    one bin.
     This uses the state and methods of ocpcadb"""
 
+# bin that holds the value of each record
+VALUEBIN = 'value'
+
+def connect ( host ):
+  """Connect to the Aerospike cluster at host"""
+  return aerospike.client ( { 'hosts': [ ( host, getattr(settings, 'AEROSPIKE_PORT', 3000) ) ] } ).connect()
+
+def deleteSet ( host, setname ):
+  """Remove all the records of a project"""
+
+  ascli = connect ( host )
+  try:
+    namespace = getattr ( settings, 'AEROSPIKE_NAMESPACE', 'ocp' )
+    askeys = []
+    ascli.scan ( namespace, setname ).foreach ( lambda record: askeys.append ( record[0] ) )
+    for askey in askeys:
+      try:
+        ascli.remove ( askey )
+      except asexception.RecordNotFound:
+        pass
+  finally:
+    ascli.close()
+
+
 class AerospikeKVIO:
 
   def __init__ ( self, db ):
@@ -33,8 +60,9 @@ class AerospikeKVIO:
  
     self.db = db
 
-    ascfg = { 'hosts': [ ('127.0.0.1', 3000) ] }
-    self.ascli = aerospike.client(ascfg).connect()
+    self.ascli = connect ( db.proj.getKVServer() )
+    self.namespace = getattr ( settings, 'AEROSPIKE_NAMESPACE', 'ocp' )
+    self.set = db.proj.getDBName()
 
 
   def close ( self ):
@@ -56,64 +84,143 @@ class AerospikeKVIO:
     pass
     
 
-  def getCube ( self, zidx, resolution, update ):
-    """Retrieve a cube from the database by token, resolution, and zidx"""
+  def cubeKey ( self, ch, zidx, resolution, neariso=False ):
+    """Key of a cuboid"""
+    return ( self.namespace, self.set, "{}:{}:{}:{}".format(ch.getChannelName(), "neariso" if neariso else "cuboid", resolution, int(zidx)) )
+
+  def timeCubeKey ( self, ch, zidx, timestamp, resolution ):
+    """Key of a cuboid at a timestamp"""
+    return ( self.namespace, self.set, "{}:timecuboid:{}:{}:{}".format(ch.getChannelName(), resolution, int(zidx), int(timestamp)) )
+
+  def indexKey ( self, ch, annid, resolution ):
+    """Key of an annotation index"""
+    return ( self.namespace, self.set, "{}:idx:{}:{}".format(ch.getChannelName(), resolution, annid) )
 
-    askey = ( "ocp", self.db.annoproj.getDBName(), str(resolution)+"_"+str(zidx) )
+  def exceptionsKey ( self, ch, zidx, resolution, annid ):
+    """Key of the exceptions of an annotation in a cuboid"""
+    return ( self.namespace, self.set, "{}:excs:{}:{}:{}".format(ch.getChannelName(), resolution, int(zidx), annid) )
 
-    (retkey, asmd, asvalue) = self.ascli.get ( askey )
-    if asvalue != None:
-      return asvalue('cuboid')
-    else:
+  def _get ( self, askey ):
+    """Value of a key or None"""
+
+    try:
+      ( retkey, asmd, bins ) = self.ascli.get ( askey )
+    except asexception.RecordNotFound:
       return None
+    return str ( bins[VALUEBIN] )
+
+  def _multiget ( self, askeys ):
+    """Values of a list of keys in the same order with one batch read"""
 
+    if not askeys:
+      return []
+    return [ None if bins is None else str(bins[VALUEBIN]) for ( retkey, asmd, bins ) in self.ascli.get_many ( askeys ) ]
 
-  def getCubes ( self, listofidxs, resolution ):
+  def _put ( self, askey, value ):
+    """Store a value.  bytearray keeps it a blob."""
+    self.ascli.put ( askey, { VALUEBIN : bytearray(value) } )
 
-    if len(listofidxs)==1:
-      yield listofidxs[0], self.ascli.get ( self.db.annoproj.getTable(resolution) + ":img:" + str(resolution)  + ":" + str(zidx))
-    for zidx in listofidxs:
+  def _multiput ( self, items ):
+    """Store a list of ( key, value ) in parallel"""
+    kvpool.parallelMap ( lambda item: self._put ( item[0], item[1] ), items )
 
-      (askey, asmd, asvalue) = self.ascli.get ( self.db.annoproj.getTable(resolution) + ":img:" + str(resolution)  + ":" + str(zidx) )
-      # how to deal with empty cubes RBTODO
-      yield zidx, asvalue
+  def _remove ( self, askey ):
+    """Delete a key if it exists"""
 
+    try:
+      self.ascli.remove ( askey )
+    except asexception.RecordNotFound:
+      pass
 
-  #
-  # putCube
-  #
-  def putCube ( self, zidx, resolution, cubestr, update ):
+
+  def getCube ( self, ch, zidx, resolution, update=False ):
+    """Retrieve a cube from the database by token, resolution, and zidx"""
+    return self._get ( self.cubeKey ( ch, zidx, resolution ) )
+
+  def getTimeCube ( self, ch, zidx, timestamp, resolution, update=False ):
+    """Retrieve a cube by resolution, timestamp and zidx"""
+    return self._get ( self.timeCubeKey ( ch, zidx, timestamp, resolution ) )
+
+  def getCubes ( self, ch, listofidxs, resolution, neariso=False, update=False ):
+    """Retrieve a list of cubes with one batch read"""
+
+    listofidxs = [ int(zidx) for zidx in listofidxs ]
+    values = self._multiget ( [ self.cubeKey ( ch, zidx, resolution, neariso ) for zidx in listofidxs ] )
+    for zidx, value in zip ( listofidxs, values ):
+      if value is not None:
+        yield ( zidx, value )
+
+  def getCubeRanges ( self, ch, ranges, resolution, neariso=False ):
+    """Retrieve the cubes in a list of inclusive [start,end] zindex ranges"""
+
+    listofidxs = [ zidx for ( start, end ) in np.asarray(ranges, dtype=np.uint64).tolist() for zidx in xrange(start, end+1) ]
+    return self.getCubes ( ch, listofidxs, resolution, neariso )
+
+  def getTimeCubes ( self, ch, idx, listoftimestamps, resolution ):
+    """Retrieve the cubes at zidx for a list of timestamps"""
+
+    listoftimestamps = list ( listoftimestamps )
+    values = self._multiget ( [ self.timeCubeKey ( ch, idx, timestamp, resolution ) for timestamp in listoftimestamps ] )
+    for timestamp, value in zip ( listoftimestamps, values ):
+      if value is not None:
+        yield ( idx, timestamp, value )
+
+  def putCubes ( self, ch, listofidxs, resolution, listofcubes, update=False ):
+    """Store multiple cubes in parallel"""
+    self._multiput ( [ ( self.cubeKey ( ch, zidx, resolution ), cubestr ) for zidx, cubestr in zip ( listofidxs, listofcubes ) ] )
+
+  def putCube ( self, ch, zidx, resolution, cubestr, update=False ):
     """Store a cube from the annotation database"""
+    self._put ( self.cubeKey ( ch, zidx, resolution ), cubestr )
 
-    askey = ( "ocp", self.db.annoproj.getDBName(), str(resolution)+"_"+str(zidx) )
-    self.ascli.put ( askey, {'cuboid':cubestr} ) 
+  def putTimeCube ( self, ch, zidx, timestamp, resolution, cubestr, update=False ):
+    """Store a cube at a timestamp"""
+    self._put ( self.timeCubeKey ( ch, zidx, timestamp, resolution ), cubestr )
 
 
-  def getIndex ( self, annid, resolution, update ):
+  def getIndex ( self, ch, annid, resolution, update=False ):
     """Fetch index routine.  Update is irrelevant for KV clients"""
 
-    (askey, asmd, asvalue) = self.ascli.get ( self.db.annoproj.getTable(resolution) + ":idx:" + str(resolution)  + ":" + str(annid) )
-
-    # If we can't find a cube, assume it hasn't been written yet
-    if ( asvalue == None ):
+    indexstr = self._get ( self.indexKey ( ch, annid, resolution ) )
+    # If we can't find a index, they don't exist
+    if indexstr is None:
       return []
-    else:
-      return asvalue
+    return indexstr
+
+  def putIndex ( self, ch, annid, resolution, indexstr, update=False ):
+    """Aerospike put index routine"""
+    self._put ( self.indexKey ( ch, annid, resolution ), indexstr )
 
+  def deleteIndex ( self, ch, annid, resolution ):
+    """Aerospike delete index routine"""
+    self._remove ( self.indexKey ( ch, annid, resolution ) )
 
-  def putIndex ( self, annid, index, resolution ):
-    """MySQL put index routine"""
+  def getIndexes ( self, ch, listofannids, resolution, update=False ):
+    """Fetch the indexes of a list of annotations in order with one batch read.  None for missing indexes."""
+    return self._multiget ( [ self.indexKey ( ch, annid, resolution ) for annid in listofannids ] )
 
-    self.ascli.put ( self.db.annoproj.getTable(resolution) + ":idx:" + str(resolution)  + ":" + str(annid), index ) 
+  def putIndexes ( self, ch, resolution, listofindexes ):
+    """Store the indexes of a list of ( annid, indexstr ) in parallel"""
+    self._multiput ( [ ( self.indexKey ( ch, annid, resolution ), indexstr ) for annid, indexstr in listofindexes ] )
 
+  def deleteIndexes ( self, ch, resolution, listofannids ):
+    """Delete the indexes of a list of annotations in parallel"""
+    kvpool.parallelMap ( lambda annid: self._remove ( self.indexKey ( ch, annid, resolution ) ), listofannids )
 
-  def updateIndex ( self, annid, index, resolution ):
-    """MySQL update index routine"""
 
-    self.putIndex ( annid, index, resolution )
+  def getExceptions ( self, ch, zidx, resolution, annid ):
+    """Retrieve exceptions from the database by token, resolution, and zidx"""
 
+    excstr = self._get ( self.exceptionsKey ( ch, zidx, resolution, annid ) )
+    # If we can't find a list of exceptions, they don't exist
+    if excstr is None:
+      return []
+    return excstr
 
-  def deleteIndex ( self, annid, resolution ):
-    """MySQL update index routine"""
+  def putExceptions ( self, ch, zidx, resolution, annid, excstr, update=False ):
+    """Store exceptions in the annotation database"""
+    self._put ( self.exceptionsKey ( ch, zidx, resolution, annid ), excstr )
 
-    self.ascli.remove ( self.db.annoproj.getTable(resolution) + ":idx:" + str(resolution)  + ":" + str(annid) ) 
+  def deleteExceptions ( self, ch, zidx, resolution, annid ):
+    """Delete a list of exceptions for this cuboid"""
+    self._remove ( self.exceptionsKey ( ch, zidx, resolution, annid ) )
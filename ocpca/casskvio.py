@@ -22,6 +22,12 @@ import itertools
 import tempfile
 import h5py
 from cassandra.cluster import Cluster
+from cassandra.concurrent import execute_concurrent_with_args
+
+from django.conf import settings
+
+import logging
+logger=logging.getLogger("ocp")
 
 class CassandraKVIO:
 
@@ -35,6 +41,11 @@ class CassandraKVIO:
     self.session = self.cluster.connect(self.db.proj.getDBName())
     self.session.default_timeout = 120
 
+    # requests in flight for a multi-cube read or write
+    self.concurrency = getattr ( settings, 'CASSANDRA_CONCURRENCY', 32 )
+    # prepared statements for this session by cql
+    self.prepared = {}
+
   def close ( self ):
     """Close the connection"""
     self.cluster.shutdown()
@@ -52,61 +63,70 @@ class CassandraKVIO:
     """Rollback the transaction.  To be called on exceptions."""
     pass
     
+  def prepare ( self, cql ):
+    """Return the prepared statement for a cql string.  Prepared once per session."""
+
+    stmt = self.prepared.get ( cql )
+    if stmt is None:
+      stmt = self.prepared[cql] = self.session.prepare ( cql )
+    return stmt
+
+  def executeConcurrent ( self, cql, listofargs ):
+    """Run a prepared statement for each set of args with up to concurrency requests in flight.  Results are in the order of the args."""
+
+    results = execute_concurrent_with_args ( self.session, self.prepare(cql), listofargs, concurrency=self.concurrency, raise_on_first_error=True )
+    return [ result for success, result in results ]
+
 
   def getCube(self, ch, zidx, resolution, update=False):
     """Retrieve a cube from the database by token, resolution, and zidx"""
 
-    try:
-      cql = "SELECT cuboid FROM {} WHERE resolution = {} AND zidx = {}".format(ch.getTable(resolution), resolution, zidx)
-      row = self.session.execute(cql)
+    cql = "SELECT cuboid FROM {} WHERE resolution = ? AND zidx = ?".format(ch.getTable(resolution))
+    row = self.session.execute ( self.prepare(cql), ( resolution, int(zidx) ) )
 
-      if row:
-        return row[0].cuboid.decode('hex')
-      else:
-        return None
-    except Exception, e:
-      pass
+    if row:
+      return row[0].cuboid.decode('hex')
+    else:
+      return None
 
 
-  def getCubes(self, ch, listofidxs, resolution, neariso=False):
+  def getCubes(self, ch, listofidxs, resolution, neariso=False, update=False):
+    """Retrieve a list of cubes with one concurrent read per cube"""
 
-    # weird pythonism for tuples of length 1 they print as (1,) and don't parse
-    # just get the cube
-    if len(listofidxs) == 1:
-      data = self.getCube(ch, listofidxs[0], resolution, False)
-      if data is None:
-        return
-      else:
-        yield listofidxs[0], None
-    else:
+    listofidxs = [ int(i) for i in listofidxs ]
+    cql = "SELECT zidx, cuboid FROM {} WHERE resolution = ? AND zidx = ?".format(ch.getTable(resolution))
 
-      try:
-        # Converting the listofidxs to INT. This is wrong and needs to be fixed.
-        listofidxs = [ int(i) for i in listofidxs ]
-        cql = "SELECT zidx, cuboid FROM {} WHERE resolution ={} AND zidx in {}".format(ch.getTable(resolution), resolution, tuple(listofidxs)) 
-        rows = self.session.execute ( cql )
-        
-        for row in rows:
-          yield (row.zidx, row.cuboid.decode('hex'))
+    for rows in self.executeConcurrent ( cql, [ ( resolution, zidx ) for zidx in listofidxs ] ):
+      for row in rows:
+        yield (row.zidx, row.cuboid.decode('hex'))
 
-      except Exception, e:
-        raise
+  def getCubeRanges(self, ch, ranges, resolution, neariso=False):
+    """Retrieve the cubes in a list of inclusive [start,end] zidx ranges.  zidx is a clustering column so each range is a slice of the partition."""
+
+    cql = "SELECT zidx, cuboid FROM {} WHERE resolution = ? AND zidx >= ? AND zidx <= ?".format(ch.getTable(resolution))
+
+    for rows in self.executeConcurrent ( cql, [ ( resolution, int(start), int(end) ) for start, end in ranges ] ):
+      for row in rows:
+        yield (row.zidx, row.cuboid.decode('hex'))
+
+  def putCubes ( self, ch, listofidxs, resolution, listofcubes, update=False ):
+    """Store multiple cubes with concurrent writes"""
+
+    cql = "INSERT INTO {} ( resolution, zidx, cuboid ) VALUES ( ?, ?, ? )".format(ch.getTable(resolution))
+    self.executeConcurrent ( cql, [ ( resolution, int(zidx), cubestr.encode('hex') ) for zidx, cubestr in zip ( listofidxs, listofcubes ) ] )
 
   def putCube ( self, ch, zidx, resolution, cubestr, update=False ):
     """Store a cube from the annotation database"""
 
-    try:
-      cql = "INSERT INTO {} ( resolution, zidx, cuboid ) VALUES ( {}, %s, %s )".format(ch.getTable(resolution), resolution)
-      self.session.execute ( cql, (zidx, cubestr.encode('hex')))
-    except Exception, e:
-      pass
+    cql = "INSERT INTO {} ( resolution, zidx, cuboid ) VALUES ( ?, ?, ? )".format(ch.getTable(resolution))
+    self.session.execute ( self.prepare(cql), ( resolution, int(zidx), cubestr.encode('hex') ) )
 
 
   def getIndex ( self, ch, annid, resolution, update=False ):
     """Fetch index routine. Update is irrelevant for KV clients"""
 
-    cql = "SELECT cuboids FROM {} WHERE annoid={} and resolution={}".format(ch.getIdxTable(resolution),annoid, resolution) 
-    row = self.session.execute (cql)
+    cql = "SELECT cuboids FROM {} WHERE annoid = ? and resolution = ?".format(ch.getIdxTable(resolution))
+    row = self.session.execute ( self.prepare(cql), ( annid, resolution ) )
 
     if row:
       return row[0].cuboids.decode('hex')
@@ -116,24 +136,40 @@ class CassandraKVIO:
   def putIndex ( self, ch, annid, resolution, indexstr, update ):
     """Cassandra put index routine"""
     
-    cql = "INSERT INTO {} ( resolution, annoid, cuboids ) VALUES ( {}, {}, {} )".format(ch.getIdxTable(resolution), resolution, annid, indexstr.encode('hex'))
-    self.session.execute(cql)
+    cql = "INSERT INTO {} ( resolution, annoid, cuboids ) VALUES ( ?, ?, ? )".format(ch.getIdxTable(resolution))
+    self.session.execute ( self.prepare(cql), ( resolution, annid, indexstr.encode('hex') ) )
 
   def deleteIndex ( self, ch, annid, resolution ):
     """Cassandra update index routine"""
 
-    cql = "DELETE FROM {} where annoid={} and resolution={}".format(ch.getIdxTable(resolution), annid, resolution)
-    self.session.execute(cql)
+    cql = "DELETE FROM {} where annoid = ? and resolution = ?".format(ch.getIdxTable(resolution))
+    self.session.execute ( self.prepare(cql), ( annid, resolution ) )
+
+  def getIndexes ( self, ch, listofannids, resolution, update=False ):
+    """Fetch the indexes of a list of annotations in order with concurrent reads.  None for missing indexes."""
+
+    cql = "SELECT cuboids FROM {} WHERE annoid = ? and resolution = ?".format(ch.getIdxTable(resolution))
+    results = self.executeConcurrent ( cql, [ ( int(annid), resolution ) for annid in listofannids ] )
+    return [ rows[0].cuboids.decode('hex') if rows else None for rows in [ list(result) for result in results ] ]
+
+  def putIndexes ( self, ch, resolution, listofindexes ):
+    """Store the indexes of a list of ( annid, indexstr ) with concurrent writes"""
+
+    cql = "INSERT INTO {} ( resolution, annoid, cuboids ) VALUES ( ?, ?, ? )".format(ch.getIdxTable(resolution))
+    self.executeConcurrent ( cql, [ ( resolution, int(annid), indexstr.encode('hex') ) for annid, indexstr in listofindexes ] )
+
+  def deleteIndexes ( self, ch, resolution, listofannids ):
+    """Delete the indexes of a list of annotations with concurrent writes"""
+
+    cql = "DELETE FROM {} where annoid = ? and resolution = ?".format(ch.getIdxTable(resolution))
+    self.executeConcurrent ( cql, [ ( int(annid), resolution ) for annid in listofannids ] )
 
 
   def getExceptions ( self, ch, zidx, resolution, annid ):
     """Retrieve exceptions from the database by token, resolution, and zidx"""
 
-    try:
-      cql = "SELECT exceptions FROM exceptions WHERE resolution = %s AND zidx = %s and annoid=%s"
-      row = self.session.execute ( cql, (resolution, zidx, annid ))
-    except Exception, e:
-      raise
+    cql = "SELECT exceptions FROM exceptions WHERE resolution = ? AND zidx = ? and annoid = ?"
+    row = self.session.execute ( self.prepare(cql), ( resolution, int(zidx), annid ) )
 
     if row:
       return row[0].exceptions.decode('hex')
@@ -143,12 +179,12 @@ class CassandraKVIO:
   def putExceptions ( self, ch, zidx, resolution, annid, excstr, update=False ):
     """Store exceptions in the annotation database"""
 
-    cql = "INSERT INTO exceptions ( resolution, zidx, annoid, exceptions ) VALUES ( %s, %s, %s, %s )"
-    self.session.execute ( cql, ( resolution, zidx, annid, excstr.encode('hex')))
+    cql = "INSERT INTO exceptions ( resolution, zidx, annoid, exceptions ) VALUES ( ?, ?, ?, ? )"
+    self.session.execute ( self.prepare(cql), ( resolution, int(zidx), annid, excstr.encode('hex') ) )
 
 
   def deleteExceptions ( self, ch, zidx, resolution, annid ):
     """Delete a list of exceptions for this cuboid"""
 
-    cql = "DELETE FROM exceptions WHERE resolution = %s AND zidx = %s AND annoid = %s"
-    self.session.execute ( cql, ( resolution, zidx, annid))
+    cql = "DELETE FROM exceptions WHERE resolution = ? AND zidx = ? AND annoid = ?"
+    self.session.execute ( self.prepare(cql), ( resolution, int(zidx), annid ) )
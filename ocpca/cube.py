@@ -19,6 +19,8 @@ import zlib
 import blosc
 
 import ocplib
+import cubecodec
+import kvmetrics
 from ocptype import ANNOTATION_CHANNELS, TIMESERIES_CHANNELS, DTYPE_uint8, DTYPE_uint16, DTYPE_uint32, DTYPE_uint64, DTYPE_float32
 
 import logging
@@ -53,19 +55,29 @@ class Cube:
                 xoffset:xoffset+other.xdim]\
             = other.data [:,:,:]
 
-  def addData_new ( self, other, index ):
-    """Add data to a larger cube from a smaller cube"""
+  def addTrimmedData ( self, other, index, trimoffset ):
+    """Add data to a trimmed larger cube from a smaller cube.
+       trimoffset is the [x,y,z] voxel offset of this cube into the cuboid aligned region.
+       Only the overlapping part of the smaller cube is copied."""
 
-    xoffset = index[0]*other.xdim
-    yoffset = index[1]*other.ydim
-    zoffset = index[2]*other.zdim
+    dst = []
+    src = []
+    # this cube and other are in z,y,x order
+    for (odim, sdim, start) in zip ( other.data.shape, self.data.shape, [ index[2]*other.zdim-trimoffset[2], index[1]*other.ydim-trimoffset[1], index[0]*other.xdim-trimoffset[0] ] ):
+      lo = max ( 0, -start )
+      hi = min ( odim, sdim-start )
+      if hi <= lo:
+        return
+      src.append ( slice(lo,hi) )
+      dst.append ( slice(start+lo,start+hi) )
+
+    np.copyto ( self.data[dst[0],dst[1],dst[2]], other.data[src[0],src[1],src[2]] )
 
-    np.copyto ( self.data[zoffset:zoffset+other.zdim,yoffset:yoffset+other.ydim,xoffset:xoffset+other.xdim],other.data [:,:,:] )
-  
   def trim ( self, xoffset, xsize, yoffset, ysize, zoffset, zsize ):
     """Trim off the excess data"""
     self.data = self.data [ zoffset:zoffset+zsize, yoffset:yoffset+ysize, xoffset:xoffset+xsize ]
 
+  @kvmetrics.timed ( 'decompress.fromNPZ' )
   def fromNPZ ( self, pandz ):
     """Load the cube from a pickled and zipped blob"""
     try:
@@ -79,6 +91,14 @@ class Cube:
     self._newcube = False
 
 
+  def fromArray ( self, data ):
+    """Load the cube from an array that holds database contents"""
+    self.data = data
+    self.zdim, self.ydim, self.xdim = self.data.shape
+    self._newcube = False
+
+
+  @kvmetrics.timed ( 'encode.toNPZ' )
   def toNPZ ( self ):
     """Pickle and zip the object"""
     try:
@@ -90,6 +110,7 @@ class Cube:
       logger.error ("Failed to compress database cube.  Data integrity concern.")
       raise
  
+  @kvmetrics.timed ( 'encode.toBlosc' )
   def toBlosc ( self ):
     """Pack the object"""
     try:
@@ -99,6 +120,7 @@ class Cube:
       logger.error ("Failed to compress database cube.  Data integrity concern.")
       raise
   
+  @kvmetrics.timed ( 'decompress.fromBlosc' )
   def fromBlosc ( self, pandz ):
     """Load the cube from a pickled and zipped blob"""
     try:
@@ -111,6 +133,27 @@ class Cube:
 
     self._newcube = False
   
+  @kvmetrics.timed ( 'encode.toCodec' )
+  def toCodec ( self, codec, npz ):
+    """Compress the object with a channel codec"""
+    try:
+      return cubecodec.compress ( self.data, codec, npz )
+    except:
+      logger.error ("Failed to compress database cube.  Data integrity concern.")
+      raise
+
+  @kvmetrics.timed ( 'decompress.fromCodec' )
+  def fromCodec ( self, cubestr, npz ):
+    """Load the cube from a blob in any codec.  npz selects the legacy format."""
+    try:
+      self.data = cubecodec.decompress ( cubestr, npz )
+      self.zdim, self.ydim, self.xdim = self.data.shape[-3:]
+    except:
+      logger.error ("Failed to decompress database cube.  Data integrity concern.")
+      raise
+
+    self._newcube = False
+
   def overwrite ( self, writedata ):
     """Get's a dense voxel region and overwrites all non-zero values"""
     if (self.data.dtype != writedata.dtype ):
@@ -0,0 +1,145 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+import shmcache
+
+import logging
+logger=logging.getLogger("ocp")
+
+"""
+  Process wide LRU cache of decompressed cuboids.
+
+  Keys are ( project, channel, resolution, zindex ) or
+    ( project, channel, resolution, zindex, timestamp ) for timeseries.
+  Values are numpy arrays that are owned by the cache.  Callers must
+    not modify an array returned by get.
+
+  Each entry keeps the invalidation epoch of its key in the host wide
+    epoch table (see shmcache) from before the cuboid was read.  Writers in
+    any process on the host move the epoch, so get drops entries whose
+    epoch is not the current one and put refuses cuboids read before a write.
+    Writes from other hosts are not seen until the cuboid is evicted.
+"""
+
+class CuboidCache:
+
+  def __init__ ( self, maxbytes, epochs ):
+    """Create an empty cache bounded at maxbytes of cuboid data that checks entries against the EpochTable epochs"""
+
+    self.maxbytes = maxbytes
+    self.epochs = epochs
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.stale = 0
+
+    self._cuboids = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get ( self, key ):
+    """Return the cached array or None. Moves the entry to most recently used."""
+
+    epoch = self.epochs.epoch ( key )
+    with self._lock:
+      entry = self._cuboids.pop ( key, None )
+      # the cuboid was written since it was cached
+      if entry is not None and entry[1] != epoch:
+        self.nbytes -= entry[0].nbytes
+        self.stale += 1
+        entry = None
+      if entry is None:
+        self.misses += 1
+        return None
+      self._cuboids[key] = entry
+      self.hits += 1
+      return entry[0]
+
+  def put ( self, key, data, epoch ):
+    """Insert an array read at epoch and evict least recently used entries over the bound.
+       Nothing is cached if the key was written since epoch."""
+
+    # don't let one cuboid flush the whole cache
+    if data.nbytes > self.maxbytes:
+      return
+
+    # readers share the array
+    data.flags.writeable = False
+
+    with self._lock:
+      old = self._cuboids.pop ( key, None )
+      if old is not None:
+        self.nbytes -= old[0].nbytes
+      if epoch != self.epochs.epoch ( key ):
+        self.stale += 1
+        return
+      self._cuboids[key] = ( data, epoch )
+      self.nbytes += data.nbytes
+
+      while self.nbytes > self.maxbytes:
+        evkey, ( evdata, evepoch ) = self._cuboids.popitem ( last=False )
+        self.nbytes -= evdata.nbytes
+        self.evictions += 1
+
+  def invalidate ( self, key ):
+    """Drop a cuboid that has been written"""
+
+    with self._lock:
+      old = self._cuboids.pop ( key, None )
+      if old is not None:
+        self.nbytes -= old[0].nbytes
+
+  def clear ( self ):
+    """Drop all cuboids"""
+
+    with self._lock:
+      self._cuboids.clear()
+      self.nbytes = 0
+
+  def stats ( self ):
+    """Return the counters as a dictionary"""
+
+    with self._lock:
+      return { 'hits' : self.hits, 'misses' : self.misses, 'evictions' : self.evictions, 'stale' : self.stale, 'cuboids' : len(self._cuboids), 'bytes' : self.nbytes, 'maxbytes' : self.maxbytes }
+
+
+_cubecache = None
+_cubecache_lock = threading.Lock()
+
+def getCubeCache ():
+  """Return the process wide cache or None if CUBE_CACHE_BYTES is not set"""
+
+  global _cubecache
+  maxbytes = getattr ( settings, 'CUBE_CACHE_BYTES', 0 )
+  if not maxbytes:
+    return None
+
+  with _cubecache_lock:
+    if _cubecache is None:
+      logger.info ( "Creating cuboid cache of {} bytes".format(maxbytes) )
+      _cubecache = CuboidCache ( maxbytes, shmcache.getEpochTable() )
+  return _cubecache
+
+def cacheStats ():
+  """Counters of the process wide cache or None if it hasn't been created"""
+
+  cache = _cubecache
+  if cache is None:
+    return None
+  return cache.stats()
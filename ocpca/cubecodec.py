@@ -0,0 +1,150 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import cStringIO
+import struct
+import zlib
+import blosc
+
+from django.conf import settings
+
+from ocptype import CODEC_DEFAULT, CODEC_ZLIB, CODEC_BLOSC, CODEC_LZ4, CODEC_ZSTD
+from ocpcaerror import OCPCAError
+
+import logging
+logger=logging.getLogger("ocp")
+
+"""
+  Self describing cuboid compression.
+
+  A cuboid written with a channel codec starts with MAGIC and a codec byte.
+    Cuboids without the header are in the engine's legacy format: np.save
+    and zlib for MySQL and blosc.pack_array for the others.  Neither of
+    those can start with MAGIC, so tables with both can be read.
+
+  Cuboids with a single value are written as a CONSTANT record with the
+    dtype, shape and value instead of compressed data in any codec.
+"""
+
+MAGIC = '\x93OCP'
+HEADERSIZE = len(MAGIC)+1
+
+# codec byte in the header
+CODEC_IDS = { CODEC_ZLIB : 1, CODEC_BLOSC : 2, CODEC_LZ4 : 3, CODEC_ZSTD : 4 }
+CODEC_NAMES = dict ( [ ( v, k ) for k, v in CODEC_IDS.iteritems() ] )
+
+# codec byte of a constant cuboid
+CONSTANT = 'constant'
+CONSTANT_ID = 15
+CODEC_NAMES[CONSTANT_ID] = CONSTANT
+
+# blosc compressor for each blosc codec.  All of them byte shuffle.
+BLOSC_CNAMES = { CODEC_BLOSC : 'blosclz', CODEC_LZ4 : 'lz4', CODEC_ZSTD : 'zstd' }
+
+
+def toLegacy ( data, npz ):
+  """Compress in the engine's format without a header"""
+
+  if npz:
+    fileobj = cStringIO.StringIO ()
+    np.save ( fileobj, data )
+    return zlib.compress ( fileobj.getvalue() )
+  else:
+    return blosc.pack_array ( data )
+
+def toConstant ( data ):
+  """A CONSTANT record if all of the array has one value or None"""
+
+  flat = data.ravel()
+  # most cuboids differ at the corners
+  if flat.size == 0 or flat[0] != flat[-1] or not ( flat == flat[0] ).all():
+    return None
+
+  dtypestr = data.dtype.str
+  return MAGIC + chr(CONSTANT_ID) + struct.pack ( '<B', len(dtypestr) ) + dtypestr + struct.pack ( '<B{}I'.format(data.ndim), data.ndim, *data.shape ) + flat[:1].tostring()
+
+def fromConstant ( cubestr ):
+  """Return ( dtype, shape, value ) of a CONSTANT record"""
+
+  cubestr = str ( cubestr )
+  pos = HEADERSIZE
+  dtypelen = ord ( cubestr[pos] )
+  dtype = np.dtype ( cubestr[pos+1:pos+1+dtypelen] )
+  pos += 1+dtypelen
+  ndim = ord ( cubestr[pos] )
+  shape = struct.unpack ( '<{}I'.format(ndim), cubestr[pos+1:pos+1+4*ndim] )
+  pos += 1+4*ndim
+  value = np.fromstring ( cubestr[pos:pos+dtype.itemsize], dtype=dtype )[0]
+  return dtype, shape, value
+
+def isZeros ( cubestr ):
+  """True if a compressed cuboid is a CONSTANT record of zeros"""
+
+  if cubestr[:HEADERSIZE] != MAGIC + chr(CONSTANT_ID):
+    return False
+  dtype, shape, value = fromConstant ( cubestr )
+  return value == 0
+
+def compress ( data, codec, npz ):
+  """Compress an array with a codec.  The default codec is the engine's legacy format."""
+
+  if getattr ( settings, 'CUBE_DEDUP_CONSTANT', True ):
+    cubestr = toConstant ( data )
+    if cubestr is not None:
+      return cubestr
+
+  if codec == CODEC_DEFAULT:
+    return toLegacy ( data, npz )
+
+  if codec == CODEC_ZLIB:
+    payload = toLegacy ( data, True )
+  elif codec in BLOSC_CNAMES:
+    cname = BLOSC_CNAMES[codec]
+    if cname not in blosc.compressor_list():
+      raise OCPCAError ( "Codec {} is not supported by this blosc build".format(codec) )
+    payload = blosc.pack_array ( data, cname=cname )
+  else:
+    raise OCPCAError ( "Unknown cuboid codec {}".format(codec) )
+
+  return MAGIC + chr(CODEC_IDS[codec]) + payload
+
+def codecOf ( cubestr ):
+  """The codec of a compressed cuboid or CODEC_DEFAULT for the legacy format"""
+
+  if cubestr[:len(MAGIC)] != MAGIC:
+    return CODEC_DEFAULT
+
+  codecid = ord ( cubestr[len(MAGIC):HEADERSIZE] )
+  if codecid not in CODEC_NAMES:
+    raise OCPCAError ( "Unknown cuboid codec {}".format(codecid) )
+  return CODEC_NAMES[codecid]
+
+def decompress ( cubestr, npz ):
+  """Decompress a cuboid written with any codec.  npz selects the legacy format."""
+
+  codec = codecOf ( cubestr )
+
+  if codec == CODEC_DEFAULT:
+    if npz:
+      return np.load ( cStringIO.StringIO ( zlib.decompress ( cubestr[:] ) ) )
+    else:
+      return blosc.unpack_array ( cubestr[:] )
+  elif codec == CONSTANT:
+    dtype, shape, value = fromConstant ( cubestr )
+    return np.full ( shape, value, dtype=dtype )
+  elif codec == CODEC_ZLIB:
+    return np.load ( cStringIO.StringIO ( zlib.decompress ( buffer ( cubestr, HEADERSIZE ) ) ) )
+  else:
+    return blosc.unpack_array ( cubestr[HEADERSIZE:] )
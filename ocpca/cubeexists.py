@@ -0,0 +1,205 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+
+from django.conf import settings
+
+import logging
+logger=logging.getLogger("ocp")
+
+"""
+  Which cuboids of a ( channel, resolution ) have been written.
+
+  The Morton space is cut into blocks of 2**BLOCKBITS cuboids and each block
+    that holds a cuboid has a bitmap of BLOCKBYTES in the kvio.  Blocks that
+    were never written have no bitmap.  A READY record says the bitmaps are
+    complete.  Without it, e.g. for channels that predate bitmaps, every
+    cuboid is assumed to exist.
+
+  Bits are only ever set and are set before the cuboid's own write commits,
+    so a stale bit can only claim a missing cuboid exists.  Writes set bits
+    even before the READY record exists so that bitmaps can be built while
+    the channel is written.  The process wide cache keeps the packed bitmaps
+    of the CUBE_EXISTS_CACHE_BLOCKS most recently used blocks and rereads
+    blocks for bits that are clear, so an evicted block is just read again.
+
+  A kvio supports bitmaps with
+    getExistsBlocks ( ch, resolution, listofblocks ) -> { block : bitmap } or None if not READY
+    mergeExistsBlocks ( ch, resolution, { block : bitmap } ) ORs bitmaps in and commits right away
+"""
+
+BLOCKBITS = 15
+BLOCKSIZE = 2**BLOCKBITS
+BLOCKBYTES = BLOCKSIZE/8
+
+# block number of the READY record
+READY = -1
+
+# ( dbname, channel name, resolution, block ) -> packed bitmap of BLOCKBYTES np.uint8.  Least recently used first.
+_blocks = OrderedDict()
+_blocks_lock = threading.Lock()
+
+# ( dbname, channel name, resolution ) -> time the kvio said it had no complete bitmap
+_unknown = {}
+
+
+def _cacheKey ( kvio, ch, resolution ):
+  return ( kvio.db.proj.getDBName(), ch.getChannelName(), resolution )
+
+def _split ( listofidxs ):
+  """Blocks and offsets of a list of zindexes"""
+  zidxs = np.asarray ( listofidxs, dtype=np.uint64 )
+  return ( zidxs >> BLOCKBITS ).astype(np.int64), ( zidxs & (BLOCKSIZE-1) ).astype(np.int64)
+
+def _testBits ( packed, offsets ):
+  """Bits of a packed bitmap at offsets.  packbits puts the first bit in the high bit."""
+  return ( packed[offsets >> 3] >> ( 7 - ( offsets & 7 ) ) ) & 1
+
+def _lookup ( key, blocks, offsets ):
+  """Cached bits of each zindex.  Blocks that aren't cached are clear."""
+
+  bits = np.zeros ( len(blocks), dtype=bool )
+  with _blocks_lock:
+    for block in np.unique ( blocks ):
+      packed = _blocks.pop ( key+(int(block),), None )
+      if packed is not None:
+        _blocks[key+(int(block),)] = packed
+        inblock = blocks == block
+        bits[inblock] = _testBits ( packed, offsets[inblock] )
+  return bits
+
+def _readBits ( bitmaps, blocks, offsets ):
+  """Bits of each zindex in bitmaps just read.  The cache may already have evicted them."""
+
+  bits = np.zeros ( len(blocks), dtype=bool )
+  for block, bitmap in bitmaps.iteritems():
+    inblock = blocks == block
+    packed = np.fromstring ( bitmap, dtype=np.uint8 )
+    inoffsets = offsets[inblock]
+    # bitmaps may be shorter than a block
+    inbitmap = ( inoffsets >> 3 ) < len(packed)
+    bits[np.flatnonzero(inblock)[inbitmap]] = _testBits ( packed, inoffsets[inbitmap] )
+  return bits
+
+def _merge ( key, bitmaps ):
+  """OR bitmaps read from or written to the kvio into the cache"""
+
+  maxblocks = getattr ( settings, 'CUBE_EXISTS_CACHE_BLOCKS', 4096 )
+  with _blocks_lock:
+    for block, bitmap in bitmaps.iteritems():
+      packed = np.zeros ( BLOCKBYTES, dtype=np.uint8 )
+      newbytes = np.fromstring ( bitmap, dtype=np.uint8 )
+      packed[:len(newbytes)] = newbytes
+      cached = _blocks.pop ( key+(int(block),), None )
+      if cached is not None:
+        packed |= cached
+      _blocks[key+(int(block),)] = packed
+
+    # evicted blocks read as clear and are read again from the kvio
+    while len(_blocks) > maxblocks:
+      _blocks.popitem ( last=False )
+
+def _read ( kvio, ch, resolution, key, blocks ):
+  """Refresh blocks from the kvio.  Returns the bitmaps read or None if the kvio has no complete bitmap."""
+
+  getblocks = getattr ( kvio, 'getExistsBlocks', None )
+  if getblocks is None:
+    return None
+
+  # don't ask again for a while when the bitmaps were incomplete
+  checked = _unknown.get ( key )
+  if checked is not None and time.time() - checked < getattr ( settings, 'CUBE_EXISTS_RECHECK', 60 ):
+    return None
+
+  bitmaps = getblocks ( ch, resolution, [ int(block) for block in blocks ] )
+  if bitmaps is None:
+    _unknown[key] = time.time()
+    return None
+  _unknown.pop ( key, None )
+
+  _merge ( key, bitmaps )
+  return bitmaps
+
+
+def existingCubes ( kvio, ch, resolution, listofidxs ):
+  """The zindexes in listofidxs that may have been written"""
+
+  if len(listofidxs) == 0:
+    return listofidxs
+
+  key = _cacheKey ( kvio, ch, resolution )
+  blocks, offsets = _split ( listofidxs )
+  bits = _lookup ( key, blocks, offsets )
+  if bits.all():
+    return listofidxs
+
+  # clear bits may have been set by other writers
+  bitmaps = _read ( kvio, ch, resolution, key, np.unique ( blocks[~bits] ) )
+  if bitmaps is None:
+    return listofidxs
+
+  bits |= _readBits ( bitmaps, blocks, offsets )
+  return [ zidx for zidx, bit in zip ( listofidxs, bits ) if bit ]
+
+def markCubes ( kvio, ch, resolution, listofidxs ):
+  """Set the bits of cuboids about to be written"""
+
+  if len(listofidxs) == 0 or getattr ( kvio, 'mergeExistsBlocks', None ) is None:
+    return
+
+  key = _cacheKey ( kvio, ch, resolution )
+  blocks, offsets = _split ( listofidxs )
+  bits = _lookup ( key, blocks, offsets )
+  if bits.all():
+    return
+
+  # reading first keeps rewrites of existing cuboids from taking the write lock
+  bitmaps = _read ( kvio, ch, resolution, key, np.unique ( blocks[~bits] ) )
+  if bitmaps is not None:
+    bits |= _readBits ( bitmaps, blocks, offsets )
+    if bits.all():
+      return
+
+  bitmaps = {}
+  for block in np.unique ( blocks[~bits] ):
+    newbits = np.zeros ( BLOCKSIZE, dtype=bool )
+    newbits[offsets[blocks == block]] = True
+    bitmaps[int(block)] = np.packbits ( newbits ).tostring()
+
+  kvio.mergeExistsBlocks ( ch, resolution, bitmaps )
+  _merge ( key, bitmaps )
+
+def orBitmaps ( bitmap, newbitmap ):
+  """OR two packed bitmaps.  Either may be empty."""
+
+  if not bitmap:
+    return newbitmap
+  if not newbitmap:
+    return bitmap
+  return np.bitwise_or ( np.fromstring ( bitmap, dtype=np.uint8 ), np.fromstring ( newbitmap, dtype=np.uint8 ) ).tostring()
+
+def buildBitmaps ( listofidxs ):
+  """Bitmaps of the blocks that hold a list of zindexes.  For building a channel's bitmaps."""
+
+  blocks, offsets = _split ( listofidxs )
+  bitmaps = {}
+  for block in np.unique ( blocks ):
+    bits = np.zeros ( BLOCKSIZE, dtype=bool )
+    bits[offsets[blocks == block]] = True
+    bitmaps[int(block)] = np.packbits ( bits ).tostring()
+  return bitmaps
@@ -0,0 +1,289 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import json
+import time
+import uuid
+import errno
+import threading
+from collections import deque
+from contextlib import closing
+from concurrent import futures
+
+from django.conf import settings
+
+import ocpcaproj
+import ocpcadb
+import ocpcarest
+from ocptype import TIMESERIES_CHANNELS
+
+from ocpcaerror import OCPCAError
+import logging
+logger=logging.getLogger("ocp")
+
+"""
+  Cutouts that run as Celery jobs and write their result to a file.
+
+  A job is submitted with the arguments of an hdf5, npz or blosc cutout.
+    Its status is a JSON file in ASYNC_CUTOUT_ROOT that the job updates as
+    it reads each slab and the result is written next to it when the job
+    is done.  Workers and web servers have to share the directory.
+
+  Each job reads ASYNC_CUTOUT_WORKERS slabs in parallel, each worker with
+    its own database connection.  Jobs and results are removed after
+    ASYNC_CUTOUT_KEEP_SECONDS.
+"""
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# result file extension and content type of each format
+FORMATS = { 'hdf5' : ( 'h5', 'product/hdf5' ), 'npz' : ( 'npz', 'product/npz' ), 'blosc' : ( 'blosc', 'product/blosc' ) }
+
+
+def resultRoot ():
+  return getattr ( settings, 'ASYNC_CUTOUT_ROOT', '/data/ocpcutouts' )
+
+def checkJobId ( jobid ):
+  """Job ids are file names so only accept the ones we make"""
+  if re.match ( r'^[0-9a-f]{32}$', jobid ) is None:
+    raise OCPCAError ( "Illegal job id {}".format(jobid) )
+
+def statusPath ( jobid ):
+  return os.path.join ( resultRoot(), '{}.json'.format(jobid) )
+
+def resultPath ( jobid, service ):
+  return os.path.join ( resultRoot(), '{}.{}'.format(jobid, FORMATS[service][0]) )
+
+def readStatus ( jobid ):
+  """Return the status of a job"""
+
+  checkJobId ( jobid )
+  try:
+    with open ( statusPath(jobid) ) as f:
+      return json.load ( f )
+  except IOError, e:
+    if e.errno == errno.ENOENT:
+      raise OCPCAError ( "No cutout job {}".format(jobid) )
+    raise
+
+def writeStatus ( status ):
+  """Replace the status of a job so readers never see a partial file"""
+
+  path = statusPath ( status['jobid'] )
+  with open ( path+'.tmp', 'w' ) as f:
+    json.dump ( status, f )
+  os.rename ( path+'.tmp', path )
+
+
+def expireJobs ():
+  """Remove the status and results of old jobs"""
+
+  cutoff = time.time() - getattr ( settings, 'ASYNC_CUTOUT_KEEP_SECONDS', 7*24*3600 )
+  for name in os.listdir ( resultRoot() ):
+    path = os.path.join ( resultRoot(), name )
+    try:
+      if os.stat(path).st_mtime < cutoff:
+        os.remove ( path )
+    except OSError:
+      # another server got there first
+      pass
+
+
+def submit ( webargs ):
+  """Check a cutout and queue it as a job.  Returns the job status as JSON."""
+
+  try:
+    # argument of format token/channels/service_async/imageargs
+    m = re.match ( r"(\w+)/([\w+,]+)/(\w+)_async/([\w+,/-]+)$", webargs )
+    [token, channels, service, imageargs] = [i for i in m.groups()]
+  except Exception, e:
+    logger.warning("Incorrect arguments for an async cutout {}. {}".format(webargs, e))
+    raise OCPCAError("Incorrect arguments for an async cutout {}. {}".format(webargs, e))
+
+  if service not in FORMATS:
+    raise OCPCAError ( "Async cutouts are {}.  Not {}".format(', '.join(sorted(FORMATS.keys())), service) )
+
+  chanargs = '{}/{}/{}'.format(channels, service, imageargs)
+
+  # check the arguments now rather than fail in the job
+  with closing ( ocpcaproj.OCPCAProjectsDB() ) as projdb:
+    proj = projdb.loadToken ( token )
+  channel_list, imageargs, args = ocpcarest.streamArgs ( chanargs, proj )
+  for channel_name in channel_list:
+    if channel_name != '0':
+      proj.getChannelObj ( channel_name )
+
+  try:
+    os.makedirs ( resultRoot() )
+  except OSError, e:
+    if e.errno != errno.EEXIST:
+      raise
+  expireJobs()
+
+  jobid = uuid.uuid4().hex
+  status = { 'jobid' : jobid, 'token' : token, 'args' : chanargs, 'format' : service, 'state' : QUEUED, 'submitted' : time.time() }
+  writeStatus ( status )
+
+  from ocpca.tasks import cutoutJob
+  cutoutJob.apply_async ( ( jobid, ), task_id=jobid )
+
+  return json.dumps ( status )
+
+
+class SlabReader:
+  """Read the slabs of a cutout in parallel and count them in the job status"""
+
+  def __init__ ( self, proj, status, workers ):
+
+    self.proj = proj
+    self.status = status
+    self.workers = workers
+
+    # each worker thread has its own database
+    self.local = threading.local()
+    self.dbs = []
+    self.dbs_lock = threading.Lock()
+
+  def close ( self ):
+    for db in self.dbs:
+      db.close()
+    self.dbs = []
+
+  def getDB ( self ):
+    db = getattr ( self.local, 'db', None )
+    if db is None:
+      db = self.local.db = ocpcadb.OCPCADB ( self.proj )
+      with self.dbs_lock:
+        self.dbs.append ( db )
+    return db
+
+  def readSlab ( self, ch, args, corner, dim ):
+    cube = self.getDB().cutout ( ch, corner, dim, args.getResolution(), args.getZScaling() )
+    ocpcarest.filterCube ( ch, cube, args.getFilter() )
+    return cube
+
+  def done ( self ):
+    self.status['slabsdone'] += 1
+    writeStatus ( self.status )
+
+  def __call__ ( self, args, ch, db ):
+    """Yield ( zoffset, cube ) in z order like ocpcarest.cutoutSlabs"""
+
+    # timeseries cutouts are not split
+    if ch.getChannelType() in TIMESERIES_CHANNELS or self.workers <= 1:
+      for zoffset, cube in ocpcarest.cutoutSlabs ( args, ch, db ):
+        yield ( zoffset, cube )
+        self.done()
+      return
+
+    pool = futures.ThreadPoolExecutor ( max_workers=self.workers )
+    inflight = deque()
+    try:
+      # bound the number of slabs in memory
+      for zoffset, corner, dim in db.slabBoxes ( ch, args.getCorner(), args.getDim(), args.getResolution() ):
+        inflight.append ( ( zoffset, pool.submit ( self.readSlab, ch, args, corner, dim ) ) )
+        if len(inflight) >= self.workers:
+          zoffset, future = inflight.popleft()
+          yield ( zoffset, future.result() )
+          self.done()
+      while inflight:
+        zoffset, future = inflight.popleft()
+        yield ( zoffset, future.result() )
+        self.done()
+    finally:
+      for zoffset, future in inflight:
+        future.cancel()
+      pool.shutdown ( wait=True )
+
+
+def countSlabs ( proj, channel_list, args, db ):
+  """Number of slabs a job reads"""
+
+  count = 0
+  for channel_name in channel_list:
+    if channel_name == '0':
+      continue
+    ch = proj.getChannelObj ( channel_name )
+    if ch.getChannelType() in TIMESERIES_CHANNELS:
+      count += 1
+    else:
+      count += len ( db.slabBoxes ( ch, args.getCorner(), args.getDim(), args.getResolution() ) )
+  return count
+
+
+def run ( jobid ):
+  """Run a queued job"""
+
+  status = readStatus ( jobid )
+  service = status['format']
+  result = resultPath ( jobid, service )
+
+  status.update ( { 'state' : RUNNING, 'started' : time.time(), 'slabsdone' : 0 } )
+  writeStatus ( status )
+
+  try:
+    with closing ( ocpcaproj.OCPCAProjectsDB() ) as projdb:
+      proj = projdb.loadToken ( status['token'] )
+    channel_list, imageargs, args = ocpcarest.streamArgs ( status['args'], proj )
+
+    with closing ( ocpcadb.OCPCADB(proj) ) as db:
+
+      status['slabs'] = countSlabs ( proj, channel_list, args, db )
+      writeStatus ( status )
+
+      with closing ( SlabReader ( proj, status, getattr ( settings, 'ASYNC_CUTOUT_WORKERS', 4 ) ) ) as slabs:
+
+        if service == 'hdf5':
+          channels = [ ( channel_name, proj.getChannelObj(channel_name) ) for channel_name in channel_list ]
+          ocpcarest.HDF5Write ( channels, args, db, result+'.part', slabs )
+        elif service == 'npz':
+          with open ( result+'.part', 'wb' ) as f:
+            for chunk in ocpcarest.numpyZipChunks ( ocpcarest.numpyChannels ( channel_list, proj ), args, db, slabs ):
+              f.write ( chunk )
+        elif service == 'blosc':
+          with open ( result+'.part', 'wb' ) as f:
+            f.write ( ocpcarest.bloscPack ( channel_list, proj, args, db, slabs ) )
+
+    os.rename ( result+'.part', result )
+
+  except Exception, e:
+    logger.exception ( "Cutout job {} failed".format(jobid) )
+    if os.path.exists ( result+'.part' ):
+      os.remove ( result+'.part' )
+    status.update ( { 'state' : FAILED, 'error' : str(e), 'finished' : time.time() } )
+    writeStatus ( status )
+    raise
+
+  status.update ( { 'state' : DONE, 'bytes' : os.path.getsize(result), 'finished' : time.time() } )
+  writeStatus ( status )
+
+
+def getStatus ( jobid ):
+  """The status of a job as JSON"""
+  return json.dumps ( readStatus ( jobid ) )
+
+def getResult ( jobid ):
+  """Return ( open result file, content type, file name ) of a finished job"""
+
+  status = readStatus ( jobid )
+  if status['state'] != DONE:
+    raise OCPCAError ( "Cutout job {} is {}".format(jobid, status['state']) )
+
+  path = resultPath ( jobid, status['format'] )
+  return open ( path, 'rb' ), FORMATS[status['format']][1], os.path.basename(path)
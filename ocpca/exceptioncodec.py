@@ -0,0 +1,81 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import zlib
+
+import ocplib
+
+from ocpcaerror import OCPCAError
+import logging
+logger=logging.getLogger("ocp")
+
+"""
+  The exceptions of every annotation in a cuboid as one blob.
+
+  Exceptions are { annid : (N,3) uint32 xyz offsets in the cuboid }.  A blob
+    starts with MAGIC and holds the zlib compressed number of ids, the ids,
+    the number of voxels of each id and then all of the voxels in id order.
+"""
+
+MAGIC = '\x93OCPX'
+
+
+def encode ( exceptions ):
+  """Compress the exceptions of a cuboid.  Ids without voxels are left out."""
+
+  annids = sorted ( [ annid for annid, voxels in exceptions.iteritems() if len(voxels) ] )
+  voxels = [ np.asarray ( exceptions[annid], dtype='<u4' ).reshape(-1,3) for annid in annids ]
+
+  header = np.empty ( 1+2*len(annids), dtype='<u8' )
+  header[0] = len(annids)
+  header[1:len(annids)+1] = annids
+  header[len(annids)+1:] = [ len(v) for v in voxels ]
+
+  body = np.concatenate ( voxels ) if voxels else np.zeros ( (0,3), dtype='<u4' )
+  return MAGIC + zlib.compress ( header.tostring() + body.tostring() )
+
+def decode ( excstr ):
+  """The exceptions of a cuboid as { annid : voxels }.  Empty for a missing blob."""
+
+  if not excstr:
+    return {}
+  if not excstr.startswith ( MAGIC ):
+    raise OCPCAError ( "Not a cuboid exceptions blob" )
+
+  data = zlib.decompress ( excstr[len(MAGIC):] )
+  nids = int ( np.fromstring ( data[:8], dtype='<u8' )[0] )
+  header = np.fromstring ( data[8:8+16*nids], dtype='<u8' )
+  body = np.fromstring ( data[8+16*nids:], dtype='<u4' ).reshape(-1,3).astype(np.uint32)
+
+  ends = np.cumsum ( header[nids:] ).astype(np.int64)
+  starts = ends - header[nids:].astype(np.int64)
+  return dict ( [ ( int(annid), body[start:end] ) for annid, start, end in zip ( header[:nids], starts, ends ) ] )
+
+
+def merge ( voxels1, voxels2 ):
+  """The union of two lists of voxels"""
+
+  if len(voxels1) == 0:
+    return np.asarray ( voxels2, dtype=np.uint32 )
+  if len(voxels2) == 0:
+    return np.asarray ( voxels1, dtype=np.uint32 )
+  return ocplib.MortonXYZBatch ( np.union1d ( ocplib.XYZMortonBatch ( voxels1 ), ocplib.XYZMortonBatch ( voxels2 ) ) )
+
+def remove ( voxels1, voxels2 ):
+  """The voxels of voxels1 that are not in voxels2"""
+
+  if len(voxels1) == 0 or len(voxels2) == 0:
+    return np.asarray ( voxels1, dtype=np.uint32 )
+  return ocplib.MortonXYZBatch ( np.setdiff1d ( ocplib.XYZMortonBatch ( voxels1 ), ocplib.XYZMortonBatch ( voxels2 ) ) )
@@ -0,0 +1,645 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import errno
+import fcntl
+import mmap
+import shutil
+import threading
+import numpy as np
+from collections import defaultdict
+
+from django.conf import settings
+
+from ocpcaerror import OCPCAError
+import cubeexists
+
+import logging
+logger=logging.getLogger("ocp")
+
+"""
+  Key/value store in local files.
+
+  A project is a directory under FILE_KV_ROOT with one directory per channel.
+    Each channel has an append only log of values (compressed cuboids,
+    time cuboids, annotation indexes and exceptions) and a memory mapped
+    hash table from ( kind, resolution, key0, key1 ) to the offset and
+    length of the latest value in the log.
+
+  Processes serialize on a flock of the project's lock file.  Readers hold
+    it shared while they look up offsets.  Values in the log are never
+    rewritten so they are read from a memory map without the lock.
+
+  Overwritten and deleted values stay in the log.  Once they are more than
+    FILE_KV_COMPACT_GARBAGE of it the live values are copied to a log of the
+    next generation and a new table that points into it replaces the old one.
+    Lookups return the log they looked in so reads in flight are unaffected.
+"""
+
+# kinds of values
+CUBE = 1
+NEARISO = 2
+TIMECUBE = 3
+INDEX = 4
+EXCEPTIONS = 5
+EXISTS = 6
+
+# hash table slot states
+EMPTY = 0
+LIVE = 1
+DELETED = 2
+
+MAGIC = 0x4f4350464b564958
+INITIAL_CAPACITY = 1024
+
+TABLE_DTYPE = np.dtype ( [ ('magic', np.uint64), ('capacity', np.uint64), ('used', np.uint64), ('generation', np.uint64), ('garbage', np.uint64) ] )
+ENTRY_DTYPE = np.dtype ( [ ('key0', np.uint64), ('key1', np.uint64), ('offset', np.uint64), ('length', np.uint64), ('kind', np.uint16), ('state', np.uint16), ('resolution', np.uint32) ] )
+
+# entries start after the table header
+ENTRYOFFSET = 64
+
+
+def projectPath ( dbname, root=None ):
+  """Directory that holds a project.  root defaults to FILE_KV_ROOT."""
+  if root is None:
+    root = getattr ( settings, 'FILE_KV_ROOT', '/data/ocpfilekv' )
+  return os.path.join ( root, dbname )
+
+def channelPath ( dbname, channame ):
+  """Directory that holds a channel"""
+  return os.path.join ( projectPath ( dbname ), channame )
+
+def makeDirs ( path ):
+  """Create a directory and its parents if they don't exist"""
+  try:
+    os.makedirs ( path )
+  except OSError, e:
+    if e.errno != errno.EEXIST:
+      raise
+
+def deletePath ( path ):
+  """Remove a project or channel directory and forget this process' stores in it"""
+
+  shutil.rmtree ( path, ignore_errors=True )
+  with _stores_lock:
+    for storepath in _stores.keys():
+      if storepath == path or storepath.startswith ( os.path.join ( path, '' ) ):
+        del _stores[storepath]
+
+
+def existsKey ( resolution, block ):
+  """Key of a cuboid existence bitmap.  key1 tells the READY record from block 0."""
+  if block == cubeexists.READY:
+    return ( EXISTS, resolution, 0, 1 )
+  return ( EXISTS, resolution, block, 0 )
+
+def markExistsReady ( dbname, channame, resolutions ):
+  """Mark the existence bitmaps of a new channel complete"""
+
+  path = projectPath ( dbname )
+  makeDirs ( path )
+  lockfd = os.open ( os.path.join ( path, 'lock' ), os.O_RDWR | os.O_CREAT, 0644 )
+  try:
+    fcntl.flock ( lockfd, fcntl.LOCK_EX )
+    getStore ( os.path.join ( path, channame ) ).write ( [ ( existsKey ( res, cubeexists.READY ), '' ) for res in resolutions ] )
+  finally:
+    os.close ( lockfd )
+
+
+def _hash ( kind, resolution, key0, key1 ):
+  """64 bit hash of a key"""
+  h = ( key0 * 0x9E3779B97F4A7C15 ^ key1 * 0xC2B2AE3D27D4EB4F ^ ( (kind<<32) | resolution ) * 0x165667B19E3779F9 ) & 0xFFFFFFFFFFFFFFFF
+  return h ^ ( h >> 31 )
+
+def _probe ( entries, kind, resolution, key0, key1 ):
+  """Linear probe for a key.  Returns ( slot, found ).  When not found slot is where to insert."""
+
+  mask = len(entries)-1
+  slot = _hash ( kind, resolution, key0, key1 ) & mask
+  free = None
+
+  # the table is never more than half full so this ends at an empty slot
+  while True:
+    entry = entries[slot]
+    if entry['state'] == EMPTY:
+      return ( slot if free is None else free ), False
+    elif entry['state'] == DELETED:
+      if free is None:
+        free = slot
+    elif entry['key0'] == key0 and entry['key1'] == key1 and entry['kind'] == kind and entry['resolution'] == resolution:
+      return slot, True
+    slot = ( slot + 1 ) & mask
+
+def _newTable ( path, capacity, generation=0 ):
+  """Create an empty hash table file of capacity entries and map it"""
+
+  with open ( path, 'wb' ) as f:
+    f.truncate ( ENTRYOFFSET + capacity*ENTRY_DTYPE.itemsize )
+
+  arena = np.memmap ( path, dtype=np.uint8, mode='r+' )
+  header = arena[0:TABLE_DTYPE.itemsize].view(TABLE_DTYPE)
+  header['capacity'] = capacity
+  header['used'] = 0
+  header['generation'] = generation
+  header['garbage'] = 0
+  header['magic'] = MAGIC
+  return arena, header, arena[ENTRYOFFSET:].view(ENTRY_DTYPE)
+
+def _logName ( generation ):
+  """File name of the log of a generation.  Tables from before compaction are generation 0."""
+  return 'values.log' if generation == 0 else 'values.log.{}'.format(generation)
+
+
+class ValueLog:
+  """An open log.  It stays readable after a compaction replaces it until the last reader drops it."""
+
+  def __init__ ( self, path ):
+
+    self.path = path
+    self.fd = os.open ( path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0644 )
+    self.inode = os.fstat ( self.fd ).st_ino
+    self.map = None
+    self._mutex = threading.Lock()
+
+  def __del__ ( self ):
+    if self.map is not None:
+      self.map.close()
+    os.close ( self.fd )
+
+  def size ( self ):
+    return os.fstat ( self.fd ).st_size
+
+  def replaced ( self ):
+    """True if the file at the log's path is not this log"""
+    try:
+      return os.stat ( self.path ).st_ino != self.inode
+    except OSError:
+      return True
+
+  def read ( self, offset, length ):
+    """Read a value out of the log"""
+
+    if length == 0:
+      return ''
+
+    with self._mutex:
+      # the log only grows so remap when the value is past the end of the map
+      if self.map is None or len(self.map) < offset+length:
+        if self.map is not None:
+          self.map.close()
+        self.map = mmap.mmap ( self.fd, 0, access=mmap.ACCESS_READ )
+      return self.map[offset:offset+length]
+
+
+class ChannelStore:
+  """The log and hash table of one channel.  Callers hold the project lock."""
+
+  def __init__ ( self, path ):
+
+    makeDirs ( path )
+    self.path = path
+    self.tablepath = os.path.join ( path, 'values.idx' )
+
+    # the log of the mapped table's generation
+    self.log = None
+    self.generation = None
+
+    self.arena = None
+    self.inode = None
+
+    # threads in a process share the store
+    self._mutex = threading.Lock()
+
+  def _mapTable ( self, create ):
+    """Map the hash table if it is new or has been rebuilt by another process"""
+
+    try:
+      inode = os.stat ( self.tablepath ).st_ino
+    except OSError:
+      if not create:
+        self.arena = self.inode = None
+        return
+      # the channel may have been deleted and created again
+      makeDirs ( self.path )
+      arena, header, entries = _newTable ( self.tablepath+'.new', INITIAL_CAPACITY )
+      arena.flush()
+      os.rename ( self.tablepath+'.new', self.tablepath )
+      inode = os.stat ( self.tablepath ).st_ino
+
+    if inode != self.inode:
+      self.arena = np.memmap ( self.tablepath, dtype=np.uint8, mode='r+' )
+      self.header = self.arena[0:TABLE_DTYPE.itemsize].view(TABLE_DTYPE)
+      self.entries = self.arena[ENTRYOFFSET:].view(ENTRY_DTYPE)
+      self.inode = inode
+      if self.header['magic'][0] != MAGIC:
+        raise OCPCAError ( "Corrupt key/value table {}".format(self.tablepath) )
+
+      # a compaction moved the values to the next generation's log or the channel was created again
+      generation = int ( self.header['generation'][0] )
+      if generation != self.generation or self.log.replaced():
+        self.log = ValueLog ( os.path.join ( self.path, _logName(generation) ) )
+        self.generation = generation
+
+  def lookup ( self, keys ):
+    """Return ( log, offset, length ) or None for each ( kind, resolution, key0, key1 )"""
+
+    with self._mutex:
+      self._mapTable ( False )
+      if self.arena is None:
+        return [ None ] * len(keys)
+
+      locs = []
+      for key in keys:
+        slot, found = _probe ( self.entries, *key )
+        if found:
+          locs.append ( ( self.log, int(self.entries['offset'][slot]), int(self.entries['length'][slot]) ) )
+        else:
+          locs.append ( None )
+      return locs
+
+  def read ( self, log, offset, length ):
+    """Read a value out of the log that lookup found it in"""
+    return log.read ( offset, length )
+
+  def write ( self, items ):
+    """Store a list of ( ( kind, resolution, key0, key1 ), value ).  A value of None deletes the key."""
+
+    with self._mutex:
+      self._mapTable ( True )
+
+      # append the values before they are indexed so readers never see a partial value
+      offset = self.log.size()
+      locs = []
+      for key, value in items:
+        if value is None:
+          locs.append ( None )
+        else:
+          value = str(value)
+          written = 0
+          while written < len(value):
+            written += os.write ( self.log.fd, value[written:] )
+          locs.append ( ( offset, len(value) ) )
+          offset += len(value)
+
+      if getattr ( settings, 'FILE_KV_FSYNC', True ):
+        os.fsync ( self.log.fd )
+
+      for ( key, value ), loc in zip ( items, locs ):
+        slot, found = _probe ( self.entries, *key )
+        # the value being replaced is garbage in the log
+        if found:
+          self.header['garbage'] += self.entries['length'][slot]
+        if loc is None:
+          if found:
+            self.entries['state'][slot] = DELETED
+          continue
+
+        if not found:
+          if self.entries['state'][slot] == EMPTY:
+            self.header['used'] += 1
+          ( kind, resolution, key0, key1 ) = key
+          self.entries['kind'][slot] = kind
+          self.entries['resolution'][slot] = resolution
+          self.entries['key0'][slot] = key0
+          self.entries['key1'][slot] = key1
+        self.entries['offset'][slot] = loc[0]
+        self.entries['length'][slot] = loc[1]
+        self.entries['state'][slot] = LIVE
+
+        if self.header['used'][0] * 2 > self.header['capacity'][0]:
+          self._rebuild()
+
+      self.arena.flush()
+
+      garbage = getattr ( settings, 'FILE_KV_COMPACT_GARBAGE', 0.5 )
+      logbytes = self.log.size()
+      if garbage and logbytes >= getattr ( settings, 'FILE_KV_COMPACT_BYTES', 2**26 ) and self.header['garbage'][0] > garbage*logbytes:
+        self._compact()
+
+  def compact ( self ):
+    """Copy the live values to a new log.  Returns the bytes reclaimed.  Callers hold the project lock exclusively."""
+
+    with self._mutex:
+      self._mapTable ( False )
+      if self.arena is None:
+        return 0
+      return self._compact()
+
+  def _compact ( self ):
+
+    live = self.entries[self.entries['state']==LIVE]
+    oldlog = self.log
+    generation = self.generation + 1
+    logpath = os.path.join ( self.path, _logName(generation) )
+
+    # copy in log order so the old log is read sequentially.  a log left by a failed compaction is overwritten.
+    offset = 0
+    with open ( logpath, 'wb' ) as f:
+      for i in np.argsort ( live['offset'], kind='mergesort' ):
+        length = int ( live['length'][i] )
+        f.write ( oldlog.read ( int(live['offset'][i]), length ) )
+        live['offset'][i] = offset
+        offset += length
+      f.flush()
+      if getattr ( settings, 'FILE_KV_FSYNC', True ):
+        os.fsync ( f.fileno() )
+
+    # the new table names the new log so the swap is one rename
+    self._replaceTable ( live, generation, 0 )
+    logger.info ( "Compacted {} from {} to {} bytes".format(self.path, oldlog.size(), offset) )
+    reclaimed = oldlog.size() - offset
+
+    # readers holding the old log keep it open until they are done
+    for name in os.listdir ( self.path ):
+      if name.startswith('values.log') and name != _logName(generation):
+        os.unlink ( os.path.join ( self.path, name ) )
+    return reclaimed
+
+  def _rebuild ( self ):
+    """Rehash the live entries into a new table at least four times their number"""
+    self._replaceTable ( self.entries[self.entries['state']==LIVE], self.generation, self.header['garbage'][0] )
+
+  def _replaceTable ( self, live, generation, garbage ):
+    """Write the entries to a new table and swap it in"""
+
+    capacity = INITIAL_CAPACITY
+    while capacity < 4*len(live):
+      capacity *= 2
+
+    arena, header, entries = _newTable ( self.tablepath+'.new', capacity, generation )
+    for entry in live:
+      slot, found = _probe ( entries, int(entry['kind']), int(entry['resolution']), int(entry['key0']), int(entry['key1']) )
+      entries[slot] = entry
+    header['used'] = len(live)
+    header['garbage'] = garbage
+    arena.flush()
+
+    # other processes notice the new inode and remap
+    os.rename ( self.tablepath+'.new', self.tablepath )
+    self._mapTable ( False )
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def getStore ( path ):
+  """Return the process wide store for a channel directory"""
+
+  with _stores_lock:
+    store = _stores.get ( path )
+    if store is None:
+      store = _stores[path] = ChannelStore ( path )
+  return store
+
+
+class FileKVIO:
+
+  def __init__ ( self, db, root=None ):
+    """Open the project directory under root or FILE_KV_ROOT"""
+
+    self.db = db
+    self.path = projectPath ( self.db.proj.getDBName(), root )
+    makeDirs ( self.path )
+
+    # each instance locks through its own file description so threads exclude each other too
+    self.lockfd = os.open ( os.path.join ( self.path, 'lock' ), os.O_RDWR | os.O_CREAT, 0644 )
+
+    # writes in a transaction are buffered until commit
+    self.txn = False
+    self.txnlocked = False
+    self.pending = {}
+
+  def close ( self ):
+    """Drop any uncommitted writes and release the lock"""
+    if self.lockfd is not None:
+      self.rollback()
+      os.close ( self.lockfd )
+      self.lockfd = None
+
+  def startTxn ( self ):
+    """Start a transaction.  Writes are buffered until commit."""
+    self.txn = True
+    self.pending = {}
+
+  def commit ( self ):
+    """Write the buffered values and release the lock"""
+
+    try:
+      if self.pending:
+        taken = self._acquire ( True )
+        try:
+          bychannel = defaultdict(list)
+          for ( channame, key ), value in self.pending.iteritems():
+            bychannel[channame].append ( ( key, value ) )
+          for channame, items in bychannel.iteritems():
+            self._store ( channame ).write ( items )
+        finally:
+          self._release ( taken )
+    finally:
+      self._endTxn()
+
+  def rollback ( self ):
+    """Drop the buffered values and release the lock"""
+    self._endTxn()
+
+  def _endTxn ( self ):
+    self.pending = {}
+    self.txn = False
+    if self.txnlocked:
+      fcntl.flock ( self.lockfd, fcntl.LOCK_UN )
+      self.txnlocked = False
+
+  def _acquire ( self, exclusive ):
+    """Take the project lock unless the transaction holds it.  Returns True if taken."""
+
+    if self.txnlocked:
+      return False
+    fcntl.flock ( self.lockfd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH )
+    return True
+
+  def _release ( self, taken ):
+    if taken:
+      fcntl.flock ( self.lockfd, fcntl.LOCK_UN )
+
+  def _store ( self, channame ):
+    return getStore ( os.path.join ( self.path, channame ) )
+
+  def _get ( self, ch, keys, update=False ):
+    """Return the value or None for each ( kind, resolution, key0, key1 )"""
+
+    # a locking read holds the lock exclusively until the end of the transaction
+    if update and self.txn and not self.txnlocked:
+      fcntl.flock ( self.lockfd, fcntl.LOCK_EX )
+      self.txnlocked = True
+
+    channame = ch.getChannelName()
+    store = self._store ( channame )
+
+    taken = self._acquire ( False )
+    try:
+      locs = store.lookup ( keys )
+    finally:
+      self._release ( taken )
+
+    values = []
+    for key, loc in zip ( keys, locs ):
+      if ( channame, key ) in self.pending:
+        values.append ( self.pending[(channame, key)] )
+      elif loc is None:
+        values.append ( None )
+      else:
+        values.append ( store.read ( *loc ) )
+    return values
+
+  def _put ( self, ch, items ):
+    """Store a list of ( ( kind, resolution, key0, key1 ), value ).  A value of None deletes the key."""
+
+    channame = ch.getChannelName()
+    if self.txn:
+      for key, value in items:
+        self.pending[(channame, key)] = value
+      return
+
+    taken = self._acquire ( True )
+    try:
+      self._store ( channame ).write ( items )
+    finally:
+      self._release ( taken )
+
+  def getCube ( self, ch, zidx, resolution, update=False ):
+    """Retrieve a cube by resolution and zidx"""
+    return self._get ( ch, [ ( CUBE, resolution, int(zidx), 0 ) ], update )[0]
+
+  def getTimeCube ( self, ch, zidx, timestamp, resolution, update=False ):
+    """Retrieve a cube by resolution, timestamp and zidx"""
+    return self._get ( ch, [ ( TIMECUBE, resolution, int(zidx), int(timestamp) ) ], update )[0]
+
+  def getCubes ( self, ch, listofidxs, resolution, neariso=False, update=False ):
+    """Retrieve a list of cubes in Morton order"""
+
+    kind = NEARISO if neariso else CUBE
+    listofidxs = sorted ( [ int(zidx) for zidx in listofidxs ] )
+    values = self._get ( ch, [ ( kind, resolution, zidx, 0 ) for zidx in listofidxs ], update )
+    for zidx, value in zip ( listofidxs, values ):
+      if value is not None:
+        yield ( zidx, value )
+
+  def getCubeRanges ( self, ch, ranges, resolution, neariso=False ):
+    """Retrieve the cubes in a list of inclusive [start,end] zindex ranges"""
+
+    listofidxs = [ zidx for ( start, end ) in np.asarray(ranges, dtype=np.uint64).tolist() for zidx in xrange(start, end+1) ]
+    return self.getCubes ( ch, listofidxs, resolution, neariso )
+
+  def getTimeCubes ( self, ch, idx, listoftimestamps, resolution ):
+    """Retrieve the cubes at zidx for a list of timestamps"""
+
+    values = self._get ( ch, [ ( TIMECUBE, resolution, int(idx), int(timestamp) ) for timestamp in listoftimestamps ] )
+    for timestamp, value in zip ( listoftimestamps, values ):
+      if value is not None:
+        yield ( idx, timestamp, value )
+
+  def putCubes ( self, ch, listofidxs, resolution, listofcubes, update=False ):
+    """Store multiple cubes"""
+    self._put ( ch, [ ( ( CUBE, resolution, int(zidx), 0 ), cubestr ) for zidx, cubestr in zip ( listofidxs, listofcubes ) ] )
+
+  def putCube ( self, ch, zidx, resolution, cubestr, update=False ):
+    """Store a cube"""
+    self._put ( ch, [ ( ( CUBE, resolution, int(zidx), 0 ), cubestr ) ] )
+
+  def putTimeCube ( self, ch, zidx, timestamp, resolution, cubestr, update=False ):
+    """Store a cube at a timestamp"""
+    self._put ( ch, [ ( ( TIMECUBE, resolution, int(zidx), int(timestamp) ), cubestr ) ] )
+
+  def getIndex ( self, ch, annid, resolution, update=False ):
+    """Retrieve the index of an annotation"""
+
+    indexstr = self._get ( ch, [ ( INDEX, resolution, int(annid), 0 ) ], update )[0]
+    # If we can't find a index, they don't exist
+    if indexstr is None:
+      return []
+    return indexstr
+
+  def putIndex ( self, ch, annid, resolution, indexstr, update=False ):
+    """Store the index of an annotation"""
+    self._put ( ch, [ ( ( INDEX, resolution, int(annid), 0 ), indexstr ) ] )
+
+  def deleteIndex ( self, ch, annid, resolution ):
+    """Delete the index of an annotation"""
+    self._put ( ch, [ ( ( INDEX, resolution, int(annid), 0 ), None ) ] )
+
+  def getIndexes ( self, ch, listofannids, resolution, update=False ):
+    """Retrieve the indexes of a list of annotations in order.  None for missing indexes."""
+    return self._get ( ch, [ ( INDEX, resolution, int(annid), 0 ) for annid in listofannids ], update )
+
+  def putIndexes ( self, ch, resolution, listofindexes ):
+    """Store the indexes of a list of ( annid, indexstr )"""
+    self._put ( ch, [ ( ( INDEX, resolution, int(annid), 0 ), indexstr ) for annid, indexstr in listofindexes ] )
+
+  def deleteIndexes ( self, ch, resolution, listofannids ):
+    """Delete the indexes of a list of annotations"""
+    self._put ( ch, [ ( ( INDEX, resolution, int(annid), 0 ), None ) for annid in listofannids ] )
+
+  def getExceptions ( self, ch, zidx, resolution, annid ):
+    """Load the list of exceptions for this cube"""
+
+    excstr = self._get ( ch, [ ( EXCEPTIONS, resolution, int(zidx), int(annid) ) ] )[0]
+    # If we can't find a list of exceptions, they don't exist
+    if excstr is None:
+      return []
+    return excstr
+
+  def deleteExceptions ( self, ch, zidx, resolution, annid ):
+    """Delete the list of exceptions for this cuboid"""
+    self._put ( ch, [ ( ( EXCEPTIONS, resolution, int(zidx), int(annid) ), None ) ] )
+
+  def putExceptions ( self, ch, zidx, resolution, annid, excstr, update=False ):
+    """Store a list of exceptions"""
+    self._put ( ch, [ ( ( EXCEPTIONS, resolution, int(zidx), int(annid) ), excstr ) ] )
+
+  def getExistsBlocks ( self, ch, resolution, listofblocks ):
+    """Existence bitmaps of the blocks that have one.  None if the channel's bitmaps are incomplete."""
+
+    keys = [ existsKey ( resolution, cubeexists.READY ) ] + [ existsKey ( resolution, block ) for block in listofblocks ]
+    values = self._get ( ch, keys )
+    if values[0] is None:
+      return None
+    return dict ( [ ( block, value ) for block, value in zip ( listofblocks, values[1:] ) if value is not None ] )
+
+  def compactLog ( self, ch ):
+    """Copy the live values of a channel to a new log.  Returns the bytes reclaimed."""
+
+    taken = self._acquire ( True )
+    try:
+      return self._store ( ch.getChannelName() ).compact()
+    finally:
+      self._release ( taken )
+
+  def mergeExistsBlocks ( self, ch, resolution, bitmaps ):
+    """OR bitmaps into the existence bitmaps.  Written right away, outside any transaction."""
+
+    blocks = bitmaps.keys()
+    keys = [ existsKey ( resolution, block ) for block in blocks ]
+    store = self._store ( ch.getChannelName() )
+
+    taken = self._acquire ( True )
+    try:
+      locs = store.lookup ( keys )
+      items = []
+      for block, key, loc in zip ( blocks, keys, locs ):
+        bitmap = '' if loc is None else store.read ( *loc )
+        items.append ( ( key, cubeexists.orBitmaps ( bitmap, bitmaps[block] ) ) )
+      store.write ( items )
+    finally:
+      self._release ( taken )
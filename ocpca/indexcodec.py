@@ -0,0 +1,149 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import cStringIO
+import zlib
+import blosc
+
+import ocplib
+
+import logging
+logger=logging.getLogger("ocp")
+
+"""
+  Annotation indexes as sorted runs of cuboids.
+
+  An index is an (N,2) array of inclusive [start,end] zindex ranges like
+    ocplib.IndexRanges returns.  The ranges are sorted, disjoint and not
+    adjacent so every set of cuboids has exactly one form.  Segments fill
+    long Morton runs so large indexes have few ranges.
+
+  An encoded index starts with MAGIC and holds the zlib compressed gaps
+    and lengths of the runs.  Indexes without MAGIC are the legacy cuboid
+    arrays, np.save for MySQL and blosc.pack_array for the others.
+"""
+
+MAGIC = '\x93OCPI'
+
+
+def empty ():
+  return np.zeros ( (0,2), dtype=np.uint64 )
+
+def toRanges ( listofidxs ):
+  """The ranges of a list of zindexes"""
+  return ocplib.IndexRanges ( listofidxs )
+
+def toZidxs ( ranges ):
+  """The sorted zindexes of a list of ranges"""
+
+  if len(ranges) == 0:
+    return np.zeros ( 0, dtype=np.uint64 )
+
+  starts = ranges[:,0]
+  lengths = ( ranges[:,1] - starts + 1 ).astype(np.int64)
+  # each zindex is the start of its run plus its position in the run
+  firsts = np.cumsum ( lengths ) - lengths
+  return np.repeat ( starts, lengths ) + ( np.arange ( lengths.sum(), dtype=np.uint64 ) - np.repeat ( firsts, lengths ).astype(np.uint64) )
+
+def count ( ranges ):
+  """Number of cuboids in a list of ranges"""
+  return int ( ( ranges[:,1] - ranges[:,0] + 1 ).sum() ) if len(ranges) else 0
+
+
+def union ( listofranges ):
+  """The union of any number of range lists"""
+
+  listofranges = [ ranges for ranges in listofranges if len(ranges) ]
+  if len(listofranges) == 0:
+    return empty()
+  if len(listofranges) == 1:
+    return listofranges[0]
+
+  ranges = np.concatenate ( listofranges )
+  ranges = ranges[np.argsort ( ranges[:,0], kind='mergesort' )]
+
+  # a run starts where it doesn't touch any earlier run
+  ends = np.maximum.accumulate ( ranges[:,1] )
+  breaks = np.flatnonzero ( ranges[1:,0] > ends[:-1] + 1 ) + 1
+  starts = np.r_[ 0, breaks ]
+  lasts = np.r_[ breaks-1, len(ranges)-1 ]
+  return np.column_stack ( ( ranges[starts,0], ends[lasts] ) ).astype(np.uint64)
+
+def intersect ( ranges1, ranges2 ):
+  """The intersection of two range lists"""
+
+  if len(ranges1) == 0 or len(ranges2) == 0:
+    return empty()
+
+  # the runs of each list are disjoint so the cuboids in both are covered twice
+  bounds = np.concatenate ( ( ranges1[:,0], ranges1[:,1]+1, ranges2[:,0], ranges2[:,1]+1 ) )
+  steps = np.concatenate ( ( np.ones(len(ranges1),dtype=np.int64), -np.ones(len(ranges1),dtype=np.int64), np.ones(len(ranges2),dtype=np.int64), -np.ones(len(ranges2),dtype=np.int64) ) )
+  order = np.argsort ( bounds, kind='mergesort' )
+  bounds = bounds[order]
+  steps = steps[order]
+
+  # sum the steps at each distinct bound
+  firsts = np.r_[ 0, np.flatnonzero ( np.diff(bounds) ) + 1 ]
+  covered = np.cumsum ( np.add.reduceat ( steps, firsts ) )
+  bounds = bounds[firsts]
+
+  both = np.flatnonzero ( covered[:-1] == 2 )
+  if len(both) == 0:
+    return empty()
+  return union ( [ np.column_stack ( ( bounds[both], bounds[both+1]-1 ) ).astype(np.uint64) ] )
+
+def contains ( ranges, listofidxs ):
+  """Which of listofidxs are in the ranges"""
+
+  zidxs = np.asarray ( listofidxs, dtype=np.uint64 )
+  if len(ranges) == 0:
+    return np.zeros ( len(zidxs), dtype=bool )
+  run = np.searchsorted ( ranges[:,0], zidxs, side='right' ) - 1
+  inrun = run >= 0
+  result = np.zeros ( len(zidxs), dtype=bool )
+  result[inrun] = zidxs[inrun] <= ranges[run[inrun],1]
+  return result
+
+
+def encode ( ranges ):
+  """Compress a list of ranges"""
+
+  if len(ranges) == 0:
+    return MAGIC
+
+  # the gap before each run and its length are small numbers
+  nexts = np.concatenate ( ( np.zeros(1,dtype=np.uint64), ranges[:-1,1]+np.uint64(1) ) )
+  runs = np.empty ( (len(ranges),2), dtype='<u8' )
+  runs[:,0] = ranges[:,0] - nexts
+  runs[:,1] = ranges[:,1] - ranges[:,0]
+  return MAGIC + zlib.compress ( runs.tostring() )
+
+def decode ( idxstr, npz ):
+  """The ranges of an encoded index or a legacy cuboid array"""
+
+  if not idxstr:
+    return empty()
+
+  if idxstr.startswith ( MAGIC ):
+    if len(idxstr) == len(MAGIC):
+      return empty()
+    runs = np.fromstring ( zlib.decompress ( idxstr[len(MAGIC):] ), dtype='<u8' ).reshape(-1,2).astype(np.uint64)
+    ends = np.cumsum ( runs[:,0] + runs[:,1] + 1 ) - 1
+    return np.column_stack ( ( ends - runs[:,1], ends ) ).astype(np.uint64)
+
+  if npz:
+    return toRanges ( np.load ( cStringIO.StringIO ( idxstr ) ) )
+  else:
+    return toRanges ( blosc.unpack_array ( idxstr ) )
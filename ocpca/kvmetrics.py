@@ -0,0 +1,258 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import types
+import bisect
+import threading
+import functools
+
+from django.conf import settings
+
+import cubecache
+
+import logging
+logger=logging.getLogger("ocp")
+
+"""
+  Counters of key/value I/O, cuboid codecs and cutout assembly.
+
+  A metric is named <stage>.<operation>, e.g. kv.getCubes or decompress.fromCodec.
+    Each keeps the number of calls, a latency histogram, bytes read and
+    written and the number of rows read.  Totals are per process.
+
+  A request that calls startRequest and endRequest also sums the time of
+    each stage and the cuboids it read for a Server-Timing header.  Work
+    done in other threads, e.g. by CUTOUT_WORKERS, counts toward the
+    process totals only.
+
+  The exposition also reports the counters of the process' cuboid cache.
+
+  Nothing is recorded unless KV_METRICS is set.
+"""
+
+# upper bounds in seconds of the latency buckets.  The last bucket is unbounded.
+LATENCY_BUCKETS = [ 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0 ]
+# upper bounds of the cuboids per request buckets
+CUBOID_BUCKETS = [ 0, 1, 4, 16, 64, 256, 1024, 4096, 16384, 65536 ]
+
+_enabled = None
+
+def enabled():
+  """Is KV_METRICS set"""
+  global _enabled
+  if _enabled is None:
+    _enabled = getattr ( settings, 'KV_METRICS', False )
+  return _enabled
+
+
+class Metric:
+  """Counters of one operation"""
+
+  def __init__ ( self ):
+    self.calls = 0
+    self.seconds = 0.0
+    self.buckets = [0] * ( len(LATENCY_BUCKETS)+1 )
+    self.bytesin = 0
+    self.bytesout = 0
+    self.rows = 0
+
+
+_metrics = {}
+_cuboids = [0] * ( len(CUBOID_BUCKETS)+1 )
+_cuboidsum = 0
+_requests = 0
+_lock = threading.Lock()
+
+# the stage times of the request running in this thread
+_request = threading.local()
+
+
+def record ( name, seconds, bytesin=0, bytesout=0, rows=0 ):
+  """Add a call to the metric name"""
+
+  with _lock:
+    metric = _metrics.get ( name )
+    if metric is None:
+      metric = _metrics[name] = Metric()
+    metric.calls += 1
+    metric.seconds += seconds
+    metric.buckets[bisect.bisect_left ( LATENCY_BUCKETS, seconds )] += 1
+    metric.bytesin += bytesin
+    metric.bytesout += bytesout
+    metric.rows += rows
+
+  timings = getattr ( _request, 'timings', None )
+  if timings is not None:
+    stage = name.split('.')[0]
+    timing = timings.get ( stage )
+    if timing is None:
+      timing = timings[stage] = [ 0, 0.0 ]
+    timing[0] += 1
+    timing[1] += seconds
+    if name.startswith('kv.get') and 'Cube' in name:
+      _request.cuboids += rows
+
+
+def size ( value ):
+  """Bytes in a value, a row or a list of values.  Other objects count as 0."""
+
+  if isinstance ( value, ( str, bytearray, buffer ) ):
+    return len(value)
+  elif isinstance ( value, ( list, tuple ) ):
+    return sum ( [ len(item) for item in value if isinstance ( item, ( str, bytearray, buffer ) ) ] )
+  return 0
+
+
+def meterIter ( name, iterator, start, bytesout=0 ):
+  """Count the rows of a generator and the time spent producing them"""
+
+  seconds = time.time() - start
+  bytesin = 0
+  rows = 0
+  try:
+    while True:
+      start = time.time()
+      try:
+        row = next ( iterator )
+      except StopIteration:
+        seconds += time.time() - start
+        return
+      seconds += time.time() - start
+      rows += 1
+      bytesin += size ( row )
+      yield row
+  finally:
+    record ( name, seconds, bytesin, bytesout, rows )
+
+
+def timed ( name ):
+  """Decorator that records the calls to a function when metrics are on"""
+
+  def decorator ( func ):
+    @functools.wraps ( func )
+    def wrapper ( *args, **kwargs ):
+      if not enabled():
+        return func ( *args, **kwargs )
+      start = time.time()
+      try:
+        return func ( *args, **kwargs )
+      finally:
+        record ( name, time.time()-start )
+    return wrapper
+  return decorator
+
+
+class MeteredKVIO:
+  """Records every call to a kvio"""
+
+  def __init__ ( self, kvio ):
+    self.kvio = kvio
+
+  def __getattr__ ( self, name ):
+
+    attr = getattr ( self.kvio, name )
+    if name.startswith('_') or not callable ( attr ):
+      return attr
+
+    metricname = 'kv.{}'.format(name)
+
+    def call ( *args, **kwargs ):
+      bytesout = sum ( [ size(arg) for arg in args ] )
+      start = time.time()
+      result = attr ( *args, **kwargs )
+      if isinstance ( result, types.GeneratorType ):
+        return meterIter ( metricname, result, start, bytesout )
+      record ( metricname, time.time()-start, size(result), bytesout, 0 if result is None else 1 )
+      return result
+
+    # later lookups find the wrapper without coming back here
+    self.__dict__[name] = call
+    return call
+
+
+def startRequest ():
+  """Start summing stage times for the request in this thread"""
+  _request.timings = {}
+  _request.cuboids = 0
+
+def endRequest ():
+  """Stop summing and return the request's { stage : [ calls, seconds ] } and cuboids read"""
+
+  global _requests, _cuboidsum
+
+  timings = getattr ( _request, 'timings', None )
+  cuboids = getattr ( _request, 'cuboids', 0 )
+  _request.timings = None
+  if timings is None:
+    return {}, 0
+
+  with _lock:
+    _requests += 1
+    _cuboidsum += cuboids
+    _cuboids[bisect.bisect_left ( CUBOID_BUCKETS, cuboids )] += 1
+
+  return timings, cuboids
+
+def serverTiming ( timings, cuboids ):
+  """Server-Timing header value of a request's stage times"""
+
+  entries = [ '{};dur={:.3f};desc="{} calls"'.format(stage, seconds*1000, calls) for stage, ( calls, seconds ) in sorted ( timings.iteritems() ) ]
+  entries.append ( 'cuboids;desc="{}"'.format(cuboids) )
+  return ', '.join ( entries )
+
+
+def exposition ():
+  """All metrics in the Prometheus text format"""
+
+  with _lock:
+    metrics = [ ( name, metric.calls, metric.seconds, list(metric.buckets), metric.bytesin, metric.bytesout, metric.rows ) for name, metric in sorted ( _metrics.iteritems() ) ]
+    cuboids = list ( _cuboids )
+    cuboidsum = _cuboidsum
+    requests = _requests
+
+  lines = []
+  lines.append ( "# TYPE ocp_seconds histogram" )
+  for name, calls, seconds, buckets, bytesin, bytesout, rows in metrics:
+    count = 0
+    for bound, n in zip ( LATENCY_BUCKETS + [ '+Inf' ], buckets ):
+      count += n
+      lines.append ( 'ocp_seconds_bucket{{op="{}",le="{}"}} {}'.format(name, bound, count) )
+    lines.append ( 'ocp_seconds_sum{{op="{}"}} {}'.format(name, seconds) )
+    lines.append ( 'ocp_seconds_count{{op="{}"}} {}'.format(name, calls) )
+
+  for counter, column in [ ( 'ocp_bytes_in_total', 4 ), ( 'ocp_bytes_out_total', 5 ), ( 'ocp_rows_total', 6 ) ]:
+    lines.append ( "# TYPE {} counter".format(counter) )
+    for metric in metrics:
+      if metric[0].startswith('kv.'):
+        lines.append ( '{}{{op="{}"}} {}'.format(counter, metric[0], metric[column]) )
+
+  lines.append ( "# TYPE ocp_request_cuboids histogram" )
+  count = 0
+  for bound, n in zip ( CUBOID_BUCKETS + [ '+Inf' ], cuboids ):
+    count += n
+    lines.append ( 'ocp_request_cuboids_bucket{{le="{}"}} {}'.format(bound, count) )
+  lines.append ( 'ocp_request_cuboids_sum {}'.format(cuboidsum) )
+  lines.append ( 'ocp_request_cuboids_count {}'.format(requests) )
+
+  stats = cubecache.cacheStats()
+  if stats is not None:
+    for name in [ 'hits', 'misses', 'evictions', 'stale' ]:
+      lines.append ( "# TYPE ocp_cube_cache_{}_total counter".format(name) )
+      lines.append ( 'ocp_cube_cache_{}_total {}'.format(name, stats[name]) )
+    for name in [ 'cuboids', 'bytes', 'maxbytes' ]:
+      lines.append ( "# TYPE ocp_cube_cache_{} gauge".format(name) )
+      lines.append ( 'ocp_cube_cache_{} {}'.format(name, stats[name]) )
+
+  return '\n'.join ( lines ) + '\n'
@@ -0,0 +1,50 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from concurrent import futures
+
+from django.conf import settings
+
+import logging
+logger=logging.getLogger("ocp")
+
+"""
+  Process wide thread pool for key/value clients without a batch call.
+
+  Tasks must not submit to the pool themselves or a full pool can deadlock.
+"""
+
+_kvpool = None
+_kvpool_lock = threading.Lock()
+
+def getKVPool ():
+  """Return the shared pool of KV_CONCURRENCY threads. Created on first use."""
+
+  global _kvpool
+  with _kvpool_lock:
+    if _kvpool is None:
+      _kvpool = futures.ThreadPoolExecutor ( max_workers=getattr(settings, 'KV_CONCURRENCY', 16) )
+  return _kvpool
+
+def parallelMap ( fn, items ):
+  """Apply fn to each item in the pool.  Results are in the order of items and the first error is raised."""
+
+  items = list ( items )
+
+  # not worth a thread hop
+  if len(items) < 2:
+    return [ fn(item) for item in items ]
+
+  return list ( getKVPool().map ( fn, items ) )
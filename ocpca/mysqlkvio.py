@@ -16,10 +16,16 @@ import numpy as np
 import cStringIO
 import zlib
 import MySQLdb
+import MySQLdb.cursors
 import re
 from collections import defaultdict
 import itertools
 
+from django.conf import settings
+
+import ocplib
+import mysqlpool
+import cubeexists
 from ocptype import OLDCHANNEL
 
 import logging
@@ -39,7 +45,7 @@ class MySQLKVIO:
     
     # Connection info 
     try:
-      self.conn = MySQLdb.connect (host = self.db.proj.getDBHost(), user = self.db.proj.getDBUser(), passwd = self.db.proj.getDBPasswd(), db = self.db.proj.getDBName())
+      self.conn = mysqlpool.connect (host = self.db.proj.getDBHost(), user = self.db.proj.getDBUser(), passwd = self.db.proj.getDBPasswd(), db = self.db.proj.getDBName())
 
     except MySQLdb.Error, e:
       self.conn = None
@@ -49,10 +55,17 @@ class MySQLKVIO:
     # start with no cursor
     self.txncursor = None
 
+    # stream multi-cube reads with an unbuffered cursor
+    self.stream = getattr ( settings, 'MYSQL_STREAM_CUBES', True )
+    # rows per fetchmany and ranges or keys per query
+    self.fetchrows = getattr ( settings, 'MYSQL_FETCH_ROWS', 64 )
+    self.querykeys = getattr ( settings, 'MYSQL_QUERY_KEYS', 1024 )
+
   def close ( self ):
-    """Close the connection"""
+    """Return the connection to the pool"""
     if self.conn:
-      self.conn.close()
+      mysqlpool.release ( self.conn, host = self.db.proj.getDBHost(), user = self.db.proj.getDBUser(), passwd = self.db.proj.getDBPasswd(), db = self.db.proj.getDBName() )
+      self.conn = None
 
   def startTxn ( self ):
     """Start a transaction.  Ensure database is in multi-statement mode."""
@@ -169,82 +182,103 @@ class MySQLKVIO:
       return row[0]
   
   
-  def getCubes(self, ch, listofidxs, resolution, neariso=False):
-
-    # if in a TxN us the transaction cursor.  Otherwise create one.
-    if self.txncursor is None:
-      cursor = self.conn.cursor()
+  def getCubes(self, ch, listofidxs, resolution, neariso=False, update=False):
+    """Retrieve a list of cubes with range scans over the zindex"""
+
+    # a locking read doesn't merge ranges so it only locks the cubes asked for
+    rangegap = 0 if update else self.db.rangegap
+    ranges = ocplib.IndexRanges ( listofidxs, rangegap )
+
+    # merged ranges pick up cubes that weren't asked for
+    if rangegap > 0:
+      wanted = set ( [ int(idx) for idx in listofidxs ] )
+      for retval in self.getCubeRanges ( ch, ranges, resolution, neariso ):
+        if int(retval[0]) in wanted:
+          yield ( retval )
     else:
-      cursor = self.txncursor
+      for retval in self.getCubeRanges ( ch, ranges, resolution, neariso, update ):
+        yield ( retval )
+
+  def getCubeRanges(self, ch, ranges, resolution, neariso=False, update=False):
+    """Retrieve the cubes in a list of inclusive [start,end] zindex ranges"""
+
+    if len(ranges) == 0:
+      return
 
     if ch.getChannelType() == OLDCHANNEL:
       channel_id = self.getChannelId(ch)
-      sql = "SELECT zindex,cube FROM {} where channel={} and zindex in (%s)".format( ch.getTable(resolution), channel_id)
+      sql = "SELECT zindex,cube FROM {} where channel={} and ({})".format( ch.getTable(resolution), channel_id, '{}' )
     else:
       if neariso:
-        sql = "SELECT zindex, cube FROM {} WHERE zindex in (%s)".format( ch.getNearIsoTable(resolution) ) 
+        sql = "SELECT zindex, cube FROM {} WHERE {}".format( ch.getNearIsoTable(resolution), '{}' ) 
       else:
-        sql = "SELECT zindex, cube FROM {} WHERE zindex in (%s)".format( ch.getTable(resolution) ) 
-
-    # creats a %s for each list element
-    in_p=', '.join(map(lambda x: '%s', listofidxs))
-    # replace the single %s with the in_p string
-    sql = sql % in_p
+        sql = "SELECT zindex, cube FROM {} WHERE {}".format( ch.getTable(resolution), '{}' ) 
+
+    # one BETWEEN for each range so InnoDB scans the primary key in order
+    ranges = [ [ int(start), int(end) ] for start, end in ranges ]
+    queries = []
+    for i in range ( 0, len(ranges), self.querykeys ):
+      chunk = ranges[i:i+self.querykeys]
+      between = ' OR '.join ( ["zindex BETWEEN %s AND %s"]*len(chunk) )
+      if update:
+        queries.append ( ( sql.format(between) + " FOR UPDATE", list ( itertools.chain.from_iterable(chunk) ) ) )
+      else:
+        queries.append ( ( sql.format(between), list ( itertools.chain.from_iterable(chunk) ) ) )
 
-    try:
-      rc = cursor.execute(sql, listofidxs)
-    
-      # Get the objects and add to the cube
-      while ( True ):
-        try: 
-          retval = cursor.fetchone() 
-        except:
-          break
-        if retval is not None:
-          yield ( retval )
-        else:
-          return
- 
-    finally:
-      # close the local cursor if not in a transaction
-      if self.txncursor is None:
-        cursor.close()
+    for retval in self.fetchRows ( queries ):
+      yield ( retval )
 
-  
   def getTimeCubes(self, ch, idx, listoftimestamps, resolution):
+    """Retrieve the cubes of a zindex at a list of timestamps"""
 
-    # if in a TxN us the transaction cursor.  Otherwise create one.
-    if self.txncursor is None:
+    listoftimestamps = list ( listoftimestamps )
+
+    queries = []
+    for i in range ( 0, len(listoftimestamps), self.querykeys ):
+      chunk = listoftimestamps[i:i+self.querykeys]
+      # creats a %s for each list element
+      in_p = ', '.join ( ['%s']*len(chunk) )
+      queries.append ( ( "SELECT zindex,timestamp,cube FROM {} WHERE zindex={} and timestamp in ({})".format(ch.getTable(resolution), idx, in_p), chunk ) )
+
+    for retval in self.fetchRows ( queries ):
+      yield ( retval )
+
+  def fetchRows ( self, queries ):
+    """Run a list of ( sql, args ) queries and yield the rows in batches of fetchmany.
+
+      A streaming cursor holds the connection until all rows have been read
+      so the caller must not issue other queries while it iterates.
+    """
+
+    # the transaction belongs to the connection so a separate cursor sees it
+    if self.stream:
+      cursor = self.conn.cursor ( MySQLdb.cursors.SSCursor )
+    elif self.txncursor is None:
       cursor = self.conn.cursor()
     else:
       cursor = self.txncursor
 
-    sql = "SELECT zindex,timestamp,cube FROM {} WHERE zindex={} and timestamp in (%s)".format(ch.getTable(resolution), idx)
+    try:
+      for sql, args in queries:
 
-    # creats a %s for each list element
-    in_p=', '.join(map(lambda x: '%s', listoftimestamps))
-    # replace the single %s with the in_p string
-    sql = sql % in_p
+        try:
+          cursor.execute ( sql, args )
+        except MySQLdb.Error, e:
+          logger.error ( "Failed to retrieve data cubes: {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+          raise
+
+        while True:
+          rows = cursor.fetchmany ( self.fetchrows )
+          if not rows:
+            break
+          for row in rows:
+            yield ( row )
 
-    try:
-      rc = cursor.execute(sql, listoftimestamps)
-    
-      # Get the objects and add to the cube
-      while ( True ):
-        try: 
-          retval = cursor.fetchone() 
-        except:
-          break
-        if retval is not None:
-          yield ( retval )
-        else:
-          return
- 
     finally:
       # close the local cursor if not in a transaction
-      if self.txncursor is None:
+      if self.stream or self.txncursor is None:
         cursor.close()
- 
+
   def putCubes ( self, ch, listofidxs, resolution, listofcubes, update=False):
     """Store multiple cubes into the database"""
 
@@ -567,6 +601,188 @@ class MySQLKVIO:
       self.conn.commit()
 
 
+  def getIndexes ( self, ch, listofannids, resolution, update=False ):
+    """Fetch the indexes of a list of annotations.  Returns a list in the order of listofannids with None for missing indexes."""
+
+    # if in a TxN us the transaction cursor.  Otherwise create one.
+    if self.txncursor is None:
+      cursor = self.conn.cursor()
+    else:
+      cursor = self.txncursor
+
+    # lock in annid order so concurrent writers don't deadlock
+    annids = sorted ( set ( [ int(annid) for annid in listofannids ] ) )
+    indexes = {}
+
+    try:
+      for i in range ( 0, len(annids), self.querykeys ):
+        chunk = annids[i:i+self.querykeys]
+        sql = "SELECT annid, cube FROM {} WHERE annid IN ({})".format( ch.getIdxTable(resolution), ','.join(['%s']*len(chunk)) )
+        if update:
+          sql += " FOR UPDATE"
+        cursor.execute ( sql, chunk )
+        for annid, indexstr in cursor.fetchall():
+          indexes[int(annid)] = indexstr
+    except MySQLdb.Error, e:
+      logger.warning ("Failed to retrieve indexes {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise
+    finally:
+      # close the local cursor if not in a transaction
+      if self.txncursor is None:
+        cursor.close()
+
+    return [ indexes.get ( int(annid) ) for annid in listofannids ]
+
+  def putIndexes ( self, ch, resolution, listofindexes ):
+    """Insert or replace the indexes of a list of ( annid, indexstr )"""
+
+    # if in a TxN us the transaction cursor.  Otherwise create one.
+    if self.txncursor is None:
+      cursor = self.conn.cursor()
+    else:
+      cursor = self.txncursor
+
+    sql = "INSERT INTO {} ( annid, cube ) VALUES ( %s, %s ) ON DUPLICATE KEY UPDATE cube=VALUES(cube)".format( ch.getIdxTable(resolution) )
+    rows = sorted ( [ ( int(annid), indexstr ) for annid, indexstr in listofindexes ] )
+
+    try:
+      # executemany sends each chunk as one multi-row insert
+      for i in range ( 0, len(rows), self.querykeys ):
+        cursor.executemany ( sql, rows[i:i+self.querykeys] )
+    except MySQLdb.Error, e:
+      logger.warning("Error updating indexes {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise
+    finally:
+      # close the local cursor if not in a transaction
+      if self.txncursor is None:
+        cursor.close()
+
+    # commit if not in a txn
+    if self.txncursor is None:
+      self.conn.commit()
+
+  def deleteIndexes ( self, ch, resolution, listofannids ):
+    """Delete the indexes of a list of annotations"""
+
+    # if in a TxN us the transaction cursor.  Otherwise create one.
+    if self.txncursor is None:
+      cursor = self.conn.cursor()
+    else:
+      cursor = self.txncursor
+
+    annids = sorted ( set ( [ int(annid) for annid in listofannids ] ) )
+
+    try:
+      for i in range ( 0, len(annids), self.querykeys ):
+        chunk = annids[i:i+self.querykeys]
+        sql = "DELETE FROM {} WHERE annid IN ({})".format( ch.getIdxTable(resolution), ','.join(['%s']*len(chunk)) )
+        cursor.execute ( sql, chunk )
+    except MySQLdb.Error, e:
+      logger.error("Error deleting the indexes {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise
+    finally:
+      # close the local cursor if not in a transaction
+      if self.txncursor is None:
+        cursor.close()
+
+    # commit if not in a txn
+    if self.txncursor is None:
+      self.conn.commit()
+
+
+  def putIndexDeltas ( self, ch, resolution, listofdeltas ):
+    """Append a list of ( annid, deltastr ) to the index delta log.  False if the channel has no log."""
+
+    # if in a TxN us the transaction cursor.  Otherwise create one.
+    if self.txncursor is None:
+      cursor = self.conn.cursor()
+    else:
+      cursor = self.txncursor
+
+    sql = "INSERT INTO {} ( annid, delta ) VALUES ( %s, %s )".format( ch.getIdxLogTable(resolution) )
+    rows = [ ( int(annid), deltastr ) for annid, deltastr in listofdeltas ]
+
+    try:
+      for i in range ( 0, len(rows), self.querykeys ):
+        cursor.executemany ( sql, rows[i:i+self.querykeys] )
+    except MySQLdb.Error, e:
+      # channels created before the log don't have the table
+      if e.args[0] == 1146:
+        return False
+      logger.warning("Error appending index deltas {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise
+    finally:
+      # close the local cursor if not in a transaction
+      if self.txncursor is None:
+        cursor.close()
+
+    # commit if not in a txn
+    if self.txncursor is None:
+      self.conn.commit()
+    return True
+
+  def getIndexDeltas ( self, ch, listofannids, resolution, update=False ):
+    """The index deltas of a list of annotations as { annid : [ ( seq, deltastr ) ] } in the order they were written.
+       Annotations without deltas are left out.  None if the channel has no log."""
+
+    # if in a TxN us the transaction cursor.  Otherwise create one.
+    if self.txncursor is None:
+      cursor = self.conn.cursor()
+    else:
+      cursor = self.txncursor
+
+    annids = sorted ( set ( [ int(annid) for annid in listofannids ] ) )
+    deltas = {}
+
+    try:
+      for i in range ( 0, len(annids), self.querykeys ):
+        chunk = annids[i:i+self.querykeys]
+        sql = "SELECT annid, seq, delta FROM {} WHERE annid IN ({}) ORDER BY annid, seq".format( ch.getIdxLogTable(resolution), ','.join(['%s']*len(chunk)) )
+        if update:
+          sql += " FOR UPDATE"
+        cursor.execute ( sql, chunk )
+        for annid, seq, deltastr in cursor.fetchall():
+          deltas.setdefault ( int(annid), [] ).append ( ( seq, deltastr ) )
+    except MySQLdb.Error, e:
+      if e.args[0] == 1146:
+        return None
+      logger.warning("Failed to retrieve index deltas {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise
+    finally:
+      # close the local cursor if not in a transaction
+      if self.txncursor is None:
+        cursor.close()
+
+    return deltas
+
+  def deleteIndexDeltas ( self, ch, resolution, listofdeltas ):
+    """Delete index deltas for a list of ( annid, lastseq ).  All of an annotation's deltas when lastseq is None."""
+
+    # if in a TxN us the transaction cursor.  Otherwise create one.
+    if self.txncursor is None:
+      cursor = self.conn.cursor()
+    else:
+      cursor = self.txncursor
+
+    sql = "DELETE FROM {} WHERE annid = %s AND seq <= %s".format( ch.getIdxLogTable(resolution) )
+    rows = sorted ( [ ( int(annid), 2**63-1 if lastseq is None else int(lastseq) ) for annid, lastseq in listofdeltas ] )
+
+    try:
+      cursor.executemany ( sql, rows )
+    except MySQLdb.Error, e:
+      if e.args[0] != 1146:
+        logger.error("Error deleting index deltas {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+        raise
+    finally:
+      # close the local cursor if not in a transaction
+      if self.txncursor is None:
+        cursor.close()
+
+    # commit if not in a txn
+    if self.txncursor is None:
+      self.conn.commit()
+
+
   def getExceptions ( self, ch, zidx, resolution, annid ):
     """Load a the list of excpetions for this cube."""
 
@@ -658,3 +874,159 @@ class MySQLKVIO:
     if self.txncursor is None:
       self.conn.commit()
       cursor.close()
+
+
+  def getCubeExceptions ( self, ch, listofidxs, resolution, update=False ):
+    """The exception blobs of a list of cuboids as { zidx : excstr }.  None if the channel doesn't keep them."""
+
+    # if in a TxN us the transaction cursor.  Otherwise create one.
+    if self.txncursor is None:
+      cursor = self.conn.cursor()
+    else:
+      cursor = self.txncursor
+
+    listofidxs = sorted ( set ( [ int(zidx) for zidx in listofidxs ] ) )
+    blobs = {}
+
+    try:
+      for i in range ( 0, len(listofidxs), self.querykeys ):
+        chunk = listofidxs[i:i+self.querykeys]
+        sql = "SELECT zindex, exlist FROM {} WHERE zindex IN ({})".format( ch.getCubeExceptionsTable(resolution), ','.join(['%s']*len(chunk)) )
+        if update:
+          sql += " FOR UPDATE"
+        cursor.execute ( sql, chunk )
+        for zidx, excstr in cursor.fetchall():
+          blobs[int(zidx)] = excstr
+    except MySQLdb.Error, e:
+      # channels created before the blobs don't have the table
+      if e.args[0] == 1146:
+        return None
+      logger.error ( "Error reading exceptions {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise
+    finally:
+      # close the local cursor if not in a transaction
+      if self.txncursor is None:
+        cursor.close()
+
+    return blobs
+
+  def putCubeExceptions ( self, ch, resolution, listofblobs ):
+    """Insert or replace the exception blobs of a list of ( zidx, excstr )"""
+
+    # if in a TxN us the transaction cursor.  Otherwise create one.
+    if self.txncursor is None:
+      cursor = self.conn.cursor()
+    else:
+      cursor = self.txncursor
+
+    sql = "INSERT INTO {} ( zindex, exlist ) VALUES ( %s, %s ) ON DUPLICATE KEY UPDATE exlist=VALUES(exlist)".format( ch.getCubeExceptionsTable(resolution) )
+    rows = sorted ( [ ( int(zidx), excstr ) for zidx, excstr in listofblobs ] )
+
+    try:
+      for i in range ( 0, len(rows), self.querykeys ):
+        cursor.executemany ( sql, rows[i:i+self.querykeys] )
+    except MySQLdb.Error, e:
+      logger.error ( "Error inserting exceptions {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise
+    finally:
+      # close the local cursor if not in a transaction
+      if self.txncursor is None:
+        cursor.close()
+
+    # commit if not in a txn
+    if self.txncursor is None:
+      self.conn.commit()
+
+  def deleteCubeExceptions ( self, ch, resolution, listofidxs ):
+    """Delete the exception blobs of a list of cuboids"""
+
+    # if in a TxN us the transaction cursor.  Otherwise create one.
+    if self.txncursor is None:
+      cursor = self.conn.cursor()
+    else:
+      cursor = self.txncursor
+
+    listofidxs = sorted ( set ( [ int(zidx) for zidx in listofidxs ] ) )
+
+    try:
+      for i in range ( 0, len(listofidxs), self.querykeys ):
+        chunk = listofidxs[i:i+self.querykeys]
+        sql = "DELETE FROM {} WHERE zindex IN ({})".format( ch.getCubeExceptionsTable(resolution), ','.join(['%s']*len(chunk)) )
+        cursor.execute ( sql, chunk )
+    except MySQLdb.Error, e:
+      logger.error ( "Error deleting exceptions {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise
+    finally:
+      # close the local cursor if not in a transaction
+      if self.txncursor is None:
+        cursor.close()
+
+    # commit if not in a txn
+    if self.txncursor is None:
+      self.conn.commit()
+
+
+  def existsConnect ( self ):
+    """Existence bitmaps use their own connection so they are read and written outside the transaction"""
+    return mysqlpool.connect ( host = self.db.proj.getDBHost(), user = self.db.proj.getDBUser(), passwd = self.db.proj.getDBPasswd(), db = self.db.proj.getDBName() )
+
+  def existsRelease ( self, conn ):
+    mysqlpool.release ( conn, host = self.db.proj.getDBHost(), user = self.db.proj.getDBUser(), passwd = self.db.proj.getDBPasswd(), db = self.db.proj.getDBName() )
+
+  def getExistsBlocks ( self, ch, resolution, listofblocks ):
+    """Existence bitmaps of the blocks that have one.  None if the channel's bitmaps are incomplete."""
+
+    blocks = [ cubeexists.READY ] + [ int(block) for block in listofblocks ]
+    sql = "SELECT block, bitmap FROM {} WHERE resolution=%s AND block IN ({})".format( ch.getExistsTable(), ','.join(['%s']*len(blocks)) )
+
+    conn = self.existsConnect()
+    cursor = conn.cursor()
+    try:
+      cursor.execute ( sql, [ resolution ] + blocks )
+      rows = cursor.fetchall()
+      conn.commit()
+    except MySQLdb.Error, e:
+      conn.rollback()
+      # channels created before bitmaps don't have the table
+      if e.args[0] == 1146:
+        return None
+      logger.error ( "Failed to retrieve existence bitmaps: {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise
+    finally:
+      cursor.close()
+      self.existsRelease ( conn )
+
+    bitmaps = dict ( [ ( int(block), bitmap ) for block, bitmap in rows ] )
+    if bitmaps.pop ( cubeexists.READY, None ) is None:
+      return None
+    return bitmaps
+
+  def mergeExistsBlocks ( self, ch, resolution, bitmaps ):
+    """OR bitmaps into the existence bitmaps and commit right away"""
+
+    blocks = sorted ( bitmaps.keys() )
+    table = ch.getExistsTable()
+
+    conn = self.existsConnect()
+    cursor = conn.cursor()
+    try:
+      # create missing rows first so the locking read below finds every block
+      cursor.executemany ( "INSERT IGNORE INTO {} (resolution,block,bitmap) VALUES (%s,%s,'')".format(table), [ ( resolution, block ) for block in blocks ] )
+      conn.commit()
+
+      # lock in block order so concurrent writers don't deadlock
+      cursor.execute ( "START TRANSACTION" )
+      cursor.execute ( "SELECT block, bitmap FROM {} WHERE resolution=%s AND block IN ({}) ORDER BY block FOR UPDATE".format(table, ','.join(['%s']*len(blocks))), [ resolution ] + blocks )
+      merged = [ ( cubeexists.orBitmaps ( bitmap, bitmaps[int(block)] ), resolution, block ) for block, bitmap in cursor.fetchall() ]
+      cursor.executemany ( "UPDATE {} SET bitmap=%s WHERE resolution=%s AND block=%s".format(table), merged )
+      conn.commit()
+
+    except MySQLdb.Error, e:
+      conn.rollback()
+      if e.args[0] == 1146:
+        return
+      logger.error ( "Failed to update existence bitmaps: {}: {}.".format(e.args[0], e.args[1]))
+      raise
+    finally:
+      cursor.close()
+      self.existsRelease ( conn )
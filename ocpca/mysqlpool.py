@@ -0,0 +1,180 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import threading
+import MySQLdb
+
+from django.conf import settings
+
+from ocpcaerror import OCPCAError
+
+import logging
+logger=logging.getLogger("ocp")
+
+"""
+  Per process pools of MySQL connections keyed by ( host, db, user ).
+
+  A pool has at most maxsize connections open, borrowed or idle.  Borrowing
+    blocks while all of them are borrowed and fails after waittimeout
+    seconds.  A request holds up to three connections to a project's
+    database, its own, the kvio's and one for concurrent reads, so size
+    the pool for three per thread.  Idle connections are closed after
+    idletimeout seconds and pinged before reuse if they have been idle for
+    more than PING_AFTER seconds.
+"""
+
+# seconds a connection may sit idle before it is checked with a ping
+PING_AFTER = 30
+
+
+class ConnectionPool:
+
+  def __init__ ( self, host, user, passwd, db, maxsize, idletimeout, waittimeout ):
+    """Create an empty pool for one database"""
+
+    self.host = host
+    self.user = user
+    self.passwd = passwd
+    self.db = db
+    self.maxsize = maxsize
+    self.idletimeout = idletimeout
+    self.waittimeout = waittimeout
+
+    # ( connection, time returned ) most recently returned last
+    self._idle = []
+    # connections borrowed or idle
+    self._open = 0
+    self._lock = threading.Lock()
+    # signalled when a connection is returned or closed
+    self._available = threading.Condition ( self._lock )
+
+  def _connect ( self ):
+    """Open a new connection"""
+    return MySQLdb.connect ( host = self.host, user = self.user, passwd = self.passwd, db = self.db )
+
+  def get ( self ):
+    """Borrow a live connection.  Opens one if no idle connection is usable and waits when maxsize are borrowed."""
+
+    deadline = time.time() + self.waittimeout
+
+    while True:
+
+      with self._lock:
+        while not self._idle and self._open >= self.maxsize:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            logger.warning ( "Timed out waiting for one of {} connections to {}, {}".format(self.maxsize, self.host, self.db) )
+            raise OCPCAError ( "Timed out waiting for a database connection" )
+          self._available.wait ( remaining )
+
+        if not self._idle:
+          # reserve the connection before opening it outside the lock
+          self._open += 1
+          break
+        conn, returned = self._idle.pop()
+
+      idle = time.time() - returned
+      if idle > self.idletimeout:
+        self._discard ( conn )
+        continue
+
+      if idle > PING_AFTER:
+        try:
+          conn.ping()
+        except MySQLdb.Error, e:
+          logger.warning ( "Dropping dead pooled connection to {}, {}: {}".format(self.host, self.db, e) )
+          self._discard ( conn )
+          continue
+
+      return conn
+
+    try:
+      return self._connect()
+    except:
+      self._closed()
+      raise
+
+  def put ( self, conn ):
+    """Return a connection.  Any open transaction is rolled back."""
+
+    try:
+      conn.rollback()
+    except MySQLdb.Error, e:
+      self._discard ( conn )
+      return
+
+    with self._lock:
+      self._idle.append ( ( conn, time.time() ) )
+      self._available.notify()
+
+  def _discard ( self, conn ):
+    """Close a connection that is not going back in the pool"""
+    try:
+      conn.close()
+    except MySQLdb.Error:
+      pass
+    self._closed()
+
+  def _closed ( self ):
+    """Free the place of a connection that was closed or failed to open"""
+    with self._lock:
+      self._open -= 1
+      self._available.notify()
+
+  def clear ( self ):
+    """Close all idle connections"""
+
+    with self._lock:
+      idle = self._idle
+      self._idle = []
+
+    for conn, returned in idle:
+      self._discard ( conn )
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def getPool ( host, user, passwd, db ):
+  """Return the process wide pool for ( host, db, user ) or None if MYSQL_POOL_SIZE is 0"""
+
+  maxsize = getattr ( settings, 'MYSQL_POOL_SIZE', 48 )
+  if not maxsize:
+    return None
+
+  with _pools_lock:
+    pool = _pools.get ( (host, db, user) )
+    if pool is None:
+      idletimeout = getattr ( settings, 'MYSQL_POOL_IDLE_TIMEOUT', 300 )
+      waittimeout = getattr ( settings, 'MYSQL_POOL_WAIT_TIMEOUT', 30 )
+      pool = _pools[(host, db, user)] = ConnectionPool ( host, user, passwd, db, maxsize, idletimeout, waittimeout )
+  return pool
+
+def connect ( host, user, passwd, db ):
+  """Borrow a connection from the pool or open one if pooling is off"""
+
+  pool = getPool ( host, user, passwd, db )
+  if pool is None:
+    return MySQLdb.connect ( host = host, user = user, passwd = passwd, db = db )
+  return pool.get()
+
+def release ( conn, host, user, passwd, db ):
+  """Return a connection borrowed with connect"""
+
+  pool = getPool ( host, user, passwd, db )
+  if pool is None:
+    conn.close()
+  else:
+    pool.put ( conn )
@@ -21,11 +21,14 @@ import MySQLdb
 import re
 import tempfile
 import h5py
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 import itertools
+import threading
 import blosc
+from concurrent import futures
 from contextlib import closing
 from operator import add, sub, div, mod
+from django.conf import settings
 
 import annotation
 import annindex
@@ -33,7 +36,15 @@ from cube import Cube
 import imagecube
 import anncube
 import ocplib
-from ocptype import ANNOTATION_CHANNELS, EXCEPTION_TRUE, PROPAGATED, NOT_PROPAGATED, UNDER_PROPAGATION
+import cubecache
+import cubecodec
+import cubeexists
+import exceptioncodec
+import indexcodec
+import kvmetrics
+import shmcache
+import mysqlpool
+from ocptype import ANNOTATION_CHANNELS, TIMESERIES_CHANNELS, EXCEPTION_TRUE, PROPAGATED, NOT_PROPAGATED, UNDER_PROPAGATION
 
 from ocpcaerror import OCPCAError
 import logging
@@ -54,6 +65,21 @@ except:
   Manipulate/create/read from the Morton-order cube store
 """
 
+# Process wide thread pool that decompresses cuboids during a cutout and
+#  codes and labels the cuboids of batched writes.  zlib, blosc and ocplib
+#  release the GIL so the threads run concurrently.
+_cutout_pool = None
+_cutout_pool_lock = threading.Lock()
+
+def getCutoutPool ():
+  """Return the shared cutout pool of CUTOUT_WORKERS threads. Created on first use."""
+
+  global _cutout_pool
+  with _cutout_pool_lock:
+    if _cutout_pool is None:
+      _cutout_pool = futures.ThreadPoolExecutor ( max_workers=getattr ( settings, 'CUTOUT_WORKERS', 1 ) )
+  return _cutout_pool
+
 class OCPCADB: 
 
   def __init__ (self, proj):
@@ -62,6 +88,36 @@ class OCPCADB:
     self.datasetcfg = proj.datasetcfg 
     self.proj = proj
 
+    # number of threads that decompress cuboids in cutout. 1 is serial.
+    self.cutout_workers = getattr ( settings, 'CUTOUT_WORKERS', 1 )
+
+    # cuboids locked and read with one batch by annotate and shave
+    self.updatecubes = getattr ( settings, 'UPDATE_BATCH_CUBES', 256 )
+
+    # cuboids that range scans may read past to merge two ranges
+    self.rangegap = getattr ( settings, 'KV_RANGE_GAP', 8 )
+
+    # skip reads of cuboids that the existence bitmaps say were never written
+    self.useexists = getattr ( settings, 'CUBE_EXISTS_BITMAPS', True )
+
+    # process wide and host wide caches of decompressed cuboids. None when disabled.
+    self.cubecache = cubecache.getCubeCache()
+    self.shmcache = shmcache.getShmCache()
+    self.usecache = self.cubecache is not None or self.shmcache is not None
+    # host wide invalidation epochs.  a cuboid is only cached if its epoch didn't move while it was read.
+    self.epochs = shmcache.getEpochTable() if self.usecache else None
+
+    # cubes written in a key/value transaction are buffered decompressed until it commits
+    self.kvtxns = 0
+    self.dirtycubes = None
+    self.dirtybytes = 0
+    self.maxdirtybytes = getattr ( settings, 'DIRTY_CUBE_BYTES', 2**28 )
+    # cache keys of the cuboids written in the transaction.  invalidated again when it commits.
+    self.writtenkeys = set()
+
+    # names of the channels that keep exceptions per cuboid and id instead of one blob per cuboid
+    self.noexcblobs = set()
+
     # Are there exceptions?
     #self.EXCEPT_FLAG = self.proj.getExceptions()
     self.KVENGINE = self.proj.getKVEngine()
@@ -73,7 +129,7 @@ class OCPCADB:
       self.NPZ = True
       # Connection info for the metadata
       try:
-        self.conn = MySQLdb.connect (host = self.proj.getDBHost(), user = self.proj.getDBUser(), passwd = self.proj.getDBPasswd(), db = self.proj.getDBName())
+        self.conn = mysqlpool.connect (host = self.proj.getDBHost(), user = self.proj.getDBUser(), passwd = self.proj.getDBPasswd(), db = self.proj.getDBName())
         # start with no cursor
         self.cursor = None
       except MySQLdb.Error, e:
@@ -93,16 +149,41 @@ class OCPCADB:
       self.cursor = None
       self.kvio = casskvio.CassandraKVIO(self)
       self.NPZ = False
+
+    elif self.proj.getKVEngine() == 'File':
+      import filekvio
+      self.conn = None
+      self.cursor = None
+      self.kvio = filekvio.FileKVIO(self)
+      self.NPZ = False
+
+    elif self.proj.getKVEngine() == 'Aerospike':
+      import askvio
+      self.conn = None
+      self.cursor = None
+      self.kvio = askvio.AerospikeKVIO(self)
+      self.NPZ = False
     else:
       raise OCPCAError ("Unknown key/value store. Engine = {}".format(self.proj.getKVEngine()))
 
+    # count the calls to the engine
+    if kvmetrics.enabled():
+      self.kvio = kvmetrics.MeteredKVIO(self.kvio)
+
+    # serve hot cuboids from a local store in front of the engine
+    if self.proj.getKVTier() == 'File' and self.proj.getKVEngine() != 'File':
+      import tieredkvio
+      self.kvio = tieredkvio.TieredKVIO(self, self.kvio)
+
+    # index compactions are queued when the key/value transaction commits
     #if (self.proj.getChannelType() in ocpcaproj.ANNOTATION_CHANNELS):
-    self.annoIdx = annindex.AnnotateIndex ( self.kvio, self.proj )
+    self.annoIdx = annindex.AnnotateIndex ( self.kvio, self.proj, lambda: self.kvtxns > 0 )
 
   def close ( self ):
-    """Close the connection"""
+    """Return the connection to the pool"""
     if self.conn:
-      self.conn.close()
+      mysqlpool.release ( self.conn, host = self.proj.getDBHost(), user = self.proj.getDBUser(), passwd = self.proj.getDBPasswd(), db = self.proj.getDBName() )
+      self.conn = None
     self.kvio.close()
 
 #
@@ -134,6 +215,7 @@ class OCPCADB:
   def commit ( self ):
     """Commit the transaction. Moved out of __del__ to make explicit.""" 
 
+    self.kvCommit()
     if self.cursor is not None:
       self.cursor.close()
       self.conn.commit()
@@ -145,14 +227,97 @@ class OCPCADB:
       self.cursor = self.conn.cursor()
       sql = "START TRANSACTION"
       self.cursor.execute ( sql )
+    self.kvStartTxn()
 
   def rollback ( self ):
     """Rollback the transaction.  To be called on exceptions."""
 
+    self.kvRollback()
     if self.cursor is not None:
       self.cursor.close()
       self.conn.rollback()
 
+#
+#  Key/value transactions nest inside the transaction started by startTxn.
+#   Cubes written with putCube are buffered decompressed and written
+#   with putCubes when the outermost transaction commits.
+#
+
+  def kvStartTxn ( self ):
+    """Start a key/value transaction or join the open one"""
+
+    if self.kvtxns == 0:
+      self.kvio.startTxn()
+      self.dirtycubes = OrderedDict()
+      self.dirtybytes = 0
+    self.kvtxns += 1
+
+  def kvCommit ( self ):
+    """Leave a key/value transaction.  The outermost commit writes the buffered cubes."""
+
+    if self.kvtxns > 1:
+      self.kvtxns -= 1
+      return
+
+    try:
+      self.flushDirtyCubes()
+    except:
+      self.kvRollback()
+      raise
+
+    self.kvtxns = 0
+    self.dirtycubes = None
+    self.kvio.commit()
+
+    # readers may have cached the old cuboids while the transaction was open
+    writtenkeys = self.writtenkeys
+    self.writtenkeys = set()
+    self.invalidateKeys ( writtenkeys )
+
+    self.annoIdx.flushCompactions()
+
+  def kvRollback ( self ):
+    """Abandon the key/value transaction and the buffered cubes"""
+
+    self.kvtxns = 0
+    self.dirtycubes = None
+    self.kvio.rollback()
+    self.annoIdx.dropCompactions()
+
+    # readers may have cached cuboids that the transaction wrote and the rollback undid
+    writtenkeys = self.writtenkeys
+    self.writtenkeys = set()
+    self.invalidateKeys ( writtenkeys )
+
+  def flushDirtyCubes ( self ):
+    """Write the buffered cubes with one putCubes for each channel and resolution"""
+
+    if not self.dirtycubes:
+      return
+
+    batches = OrderedDict()
+    for ( channame, resolution, zidx ) in sorted ( self.dirtycubes.keys() ):
+      ( ch, cube ) = self.dirtycubes[(channame, resolution, zidx)]
+      ( batchch, listofidxs, listofcubes ) = batches.setdefault ( ( channame, resolution ), ( ch, [], [] ) )
+      listofidxs.append ( zidx )
+      listofcubes.append ( cube )
+
+    self.dirtycubes.clear()
+    self.dirtybytes = 0
+
+    for ( channame, resolution ), ( ch, listofidxs, listofcubes ) in batches.iteritems():
+      # Handle the cube format here.
+      listofcubes = self.parallelMap ( lambda cube: cube.toCodec ( ch.getCodec(), self.NPZ ), listofcubes )
+      self.putCubes ( ch, listofidxs, resolution, listofcubes, True )
+
+  def parallelMap ( self, fn, items ):
+    """Apply fn to each item in the cutout pool when CUTOUT_WORKERS > 1.  Results are in the order of items."""
+
+    items = list ( items )
+    if self.cutout_workers > 1 and len(items) > 1:
+      return list ( getCutoutPool().map ( fn, items ) )
+    return [ fn(item) for item in items ]
+
 
   def peekID ( self ):
     """Look at the next ID but don't claim it.  This is an internal interface.
@@ -321,14 +486,111 @@ class OCPCADB:
       return identifier+1
 
 
+  # Cuboid cache keys and invalidation
+
+  def cacheKey ( self, ch, zidx, resolution, timestamp=None ):
+    """Key of a cuboid in the cuboid cache"""
+
+    if timestamp is None:
+      return ( self.proj.getProjectName(), ch.getChannelName(), resolution, int(zidx) )
+    else:
+      return ( self.proj.getProjectName(), ch.getChannelName(), resolution, int(zidx), timestamp )
+
+  def readCachedCuboid ( self, key, consume ):
+    """Pass the cached array for key to consume.  Returns False on a miss.
+       The array is read only and shared so consume must copy what it keeps."""
+
+    if self.cubecache is not None:
+      data = self.cubecache.get ( key )
+      if data is not None:
+        consume ( data )
+        return True
+
+    if self.shmcache is not None:
+      hit = self.shmcache.lookup ( key )
+      if hit is not None:
+        slot, seq, data = hit
+        consume ( data )
+        # another process may have reused the slot while we were copying
+        if self.shmcache.validate ( slot, seq ):
+          return True
+
+    return False
+
+  def cacheEpoch ( self, key ):
+    """Epoch of a cache key.  Take it before reading the cuboid from the kvio."""
+    return self.epochs.epoch ( key )
+
+  def cacheCuboid ( self, key, data, epoch ):
+    """Add a decompressed cuboid read at epoch to the caches.  The caches take ownership of data."""
+
+    # this transaction's writes aren't committed yet
+    if key in self.writtenkeys:
+      return
+
+    if self.cubecache is not None:
+      self.cubecache.put ( key, data, epoch )
+    if self.shmcache is not None:
+      self.shmcache.put ( key, data, epoch )
+
+  def invalidateCubes ( self, ch, listofidxs, resolution, timestamp=None ):
+    """Drop written cuboids from the cuboid caches.  In a transaction they are dropped again when it commits."""
+
+    if self.usecache:
+      keys = [ self.cacheKey ( ch, zidx, resolution, timestamp ) for zidx in listofidxs ]
+      self.invalidateKeys ( keys )
+      if self.kvtxns > 0:
+        self.writtenkeys.update ( keys )
+
+  def invalidateKeys ( self, keys ):
+    """Drop cache keys from the cuboid caches and move their epochs so no process caches the old cuboids again"""
+
+    for key in keys:
+      # the shared cache moves the epoch before it drops the key
+      if self.shmcache is not None:
+        self.shmcache.invalidate ( key )
+      else:
+        self.epochs.bump ( key )
+      if self.cubecache is not None:
+        self.cubecache.invalidate ( key )
+
+
+  def existingCubes ( self, ch, listofidxs, resolution, neariso=False ):
+    """The cuboids in listofidxs that may exist.  All of them when the channel has no bitmaps."""
+
+    if not self.useexists or neariso or ch.getChannelType() in TIMESERIES_CHANNELS:
+      return listofidxs
+    return cubeexists.existingCubes ( self.kvio, ch, resolution, listofidxs )
+
+  def markCubes ( self, ch, listofidxs, resolution ):
+    """Record cuboids in the existence bitmaps before they are written"""
+
+    if self.useexists and ch.getChannelType() not in TIMESERIES_CHANNELS:
+      cubeexists.markCubes ( self.kvio, ch, resolution, listofidxs )
+
+
   # GET and PUT Methods for Image/Annotaion/Probmap Tables
 
   def getCube(self, ch, zidx, resolution, update=False):
     """Load a cube from the database"""
 
+    # cubes written in this transaction
+    if self.dirtycubes:
+      dirty = self.dirtycubes.get ( ( ch.getChannelName(), resolution, int(zidx) ) )
+      if dirty is not None:
+        return dirty[1]
+
     # get the size of the image and cube
     [xcubedim, ycubedim, zcubedim] = cubedim = self.datasetcfg.cubedim[resolution] 
     cube = Cube.getCube(cubedim, ch.getChannelType(), ch.getDataType())
+
+    # reads for update lock the row so they always go to the database
+    # the caller may modify the cube so it gets a private copy
+    if self.usecache and not update:
+      cachekey = self.cacheKey ( ch, zidx, resolution )
+      if self.readCachedCuboid ( cachekey, lambda data: cube.fromArray ( data.copy() ) ):
+        return cube
+      epoch = self.cacheEpoch ( cachekey )
   
     # get the block from the database
     cubestr = self.kvio.getCube(ch, zidx, resolution, update)
@@ -337,32 +599,101 @@ class OCPCADB:
       cube.zeros()
     else:
       # Handle the cube format here and decompress the cube
-      if self.NPZ:
-        cube.fromNPZ ( cubestr )
-      else:
-        cube.fromBlosc ( cubestr )
+      cube.fromCodec ( cubestr, self.NPZ )
+
+      if self.usecache and not update:
+        self.cacheCuboid ( cachekey, cube.data.copy(), epoch )
 
     return cube
 
 
+  def getCubesForUpdate ( self, ch, listofidxs, resolution ):
+    """Lock and load a list of cubes with one batch read.  Returns the cubes in the order of listofidxs."""
+
+    cubedim = self.datasetcfg.cubedim[resolution]
+    listofidxs = [ int(zidx) for zidx in listofidxs ]
+
+    # cubes written in this transaction
+    dirty = {}
+    if self.dirtycubes:
+      for zidx in listofidxs:
+        entry = self.dirtycubes.get ( ( ch.getChannelName(), resolution, zidx ) )
+        if entry is not None:
+          dirty[zidx] = entry[1]
+
+    # the locks are taken in the database so skip the caches and bitmaps
+    readidxs = [ zidx for zidx in listofidxs if zidx not in dirty ]
+    if readidxs:
+      cubestrs = dict ( self.kvio.getCubes ( ch, readidxs, resolution, update=True ) )
+    else:
+      cubestrs = {}
+
+    def loadCube ( zidx ):
+      if zidx in dirty:
+        return dirty[zidx]
+      cube = Cube.getCube ( cubedim, ch.getChannelType(), ch.getDataType() )
+      cubestr = cubestrs.get ( zidx )
+      if not cubestr:
+        cube.zeros()
+      else:
+        cube.fromCodec ( cubestr, self.NPZ )
+      return cube
+
+    return self.parallelMap ( loadCube, listofidxs )
+
+
   def getCubes(self, ch, listofidxs, resolution, neariso=False):
     """Return a list of cubes"""
     
-    return self.kvio.getCubes(ch, listofidxs, resolution, neariso)
+    # the database has to see the cubes written in this transaction
+    self.flushDirtyCubes()
+    return self.kvio.getCubes(ch, self.existingCubes(ch, listofidxs, resolution, neariso), resolution, neariso)
 
   def putCubes(self, ch, listofidxs, resolution, listofcubes, update=False):
     """Insert a list of cubes"""
 
-    return self.kvio.putCubes(ch, listofidxs, resolution, listofcubes, update)
+    # these replace any buffered versions
+    if self.dirtycubes:
+      for zidx in listofidxs:
+        old = self.dirtycubes.pop ( ( ch.getChannelName(), resolution, int(zidx) ), None )
+        if old is not None:
+          self.dirtybytes -= old[1].data.nbytes
+
+    self.invalidateCubes ( ch, listofidxs, resolution )
+    self.markCubes ( ch, listofidxs, resolution )
+    result = self.kvio.putCubes(ch, listofidxs, resolution, listofcubes, update)
+
+    # outside a transaction the write is committed now.  drop what readers cached in between.
+    if self.kvtxns == 0:
+      self.invalidateCubes ( ch, listofidxs, resolution )
+    return result
 
   def putCube(self, ch, zidx, resolution, cube, update=False):
     """ Store a cube in the annotation database """
+
+    self.invalidateCubes ( ch, [zidx], resolution )
+
+    # in a transaction keep the cube until commit.  the buffer owns the cube.
+    #  flushDirtyCubes marks the buffered cubes with one batch in putCubes.
+    if self.dirtycubes is not None:
+      key = ( ch.getChannelName(), resolution, int(zidx) )
+      old = self.dirtycubes.get ( key )
+      if old is not None:
+        self.dirtybytes -= old[1].data.nbytes
+      self.dirtycubes[key] = ( ch, cube )
+      self.dirtybytes += cube.data.nbytes
+      # bound the memory held by long transactions
+      if self.dirtybytes > self.maxdirtybytes:
+        self.flushDirtyCubes()
+      return
     
+    self.markCubes ( ch, [zidx], resolution )
+
     # Handle the cube format here.  
-    if self.NPZ:
-      self.kvio.putCube(ch, zidx, resolution, cube.toNPZ(), not cube.fromZeros())
-    else:
-      self.kvio.putCube(ch, zidx, resolution, cube.toBlosc(), not cube.fromZeros())
+    self.kvio.putCube(ch, zidx, resolution, cube.toCodec(ch.getCodec(), self.NPZ), not cube.fromZeros())
+
+    # the write is committed now.  drop what readers cached in between.
+    self.invalidateCubes ( ch, [zidx], resolution )
   
   
   # GET AND PUT methods for Timeseries Database
@@ -374,6 +705,12 @@ class OCPCADB:
     [xcubedim, ycubedim, zcubedim] = cubedim = self.datasetcfg.cubedim[resolution] 
     cube = Cube.getCube(cubedim, ch.getChannelType(), ch.getDataType())
 
+    if self.usecache and not update:
+      cachekey = self.cacheKey ( ch, zidx, resolution, timestamp )
+      if self.readCachedCuboid ( cachekey, lambda data: cube.fromArray ( data.copy() ) ):
+        return cube
+      epoch = self.cacheEpoch ( cachekey )
+
     # get the block from the database
     cubestr = self.kvio.getTimeCube(ch, zidx, timestamp, resolution, update)
 
@@ -381,10 +718,10 @@ class OCPCADB:
       cube.zeros()
     else:
       # Handle the cube format here and decompress the cube
-      if self.NPZ:
-        cube.fromNPZ(cubestr)
-      else:
-        cube.fromBlosc(cubestr)
+      cube.fromCodec ( cubestr, self.NPZ )
+
+      if self.usecache and not update:
+        self.cacheCuboid ( cachekey, cube.data.copy(), epoch )
 
     return cube
   
@@ -398,12 +735,15 @@ class OCPCADB:
   def putTimeCube(self, ch, zidx, timestamp, resolution, cube, update=False):
     """Store a cube in the annotation database"""
 
+    self.invalidateCubes ( ch, [zidx], resolution, timestamp )
+
     if cube.isNotZeros():
       # Handle the cube format here.  
-      if self.NPZ:
-        self.kvio.putTimeCube(ch, zidx, timestamp, resolution, cube.toNPZ(), update)
-      else:
-        self.kvio.putTimeCube(ch, zidx, timestamp, resolution, cube.toBlosc(), update)
+      self.kvio.putTimeCube(ch, zidx, timestamp, resolution, cube.toCodec(ch.getCodec(), self.NPZ), update)
+
+      # outside a transaction the write is committed now.  drop what readers cached in between.
+      if self.kvtxns == 0:
+        self.invalidateCubes ( ch, [zidx], resolution, timestamp )
   
   def getExceptions ( self, ch, zidx, resolution, annoid ):
     """Load a cube from the annotation database"""
@@ -427,10 +767,9 @@ class OCPCADB:
     update = False
 
     if curexlist!=[]:
-      oldexlist = [ ocplib.XYZMorton ( trpl ) for trpl in curexlist ]
-      newexlist = [ ocplib.XYZMorton ( trpl ) for trpl in exceptions ]
-      exlist = set(newexlist + oldexlist)
-      exlist = [ ocplib.MortonXYZ ( zidx ) for zidx in exlist ]
+      oldexlist = ocplib.XYZMortonBatch ( curexlist )
+      newexlist = ocplib.XYZMortonBatch ( exceptions )
+      exlist = ocplib.MortonXYZBatch ( np.union1d ( newexlist, oldexlist ) )
       update = True
     else:
       exlist = exceptions
@@ -460,12 +799,132 @@ class OCPCADB:
 
     if curexlist != []:
 
-      oldexlist = set([ ocplib.XYZMorton ( trpl ) for trpl in curexlist ])
-      newexlist = set([ ocplib.XYZMorton ( trpl ) for trpl in exceptions ])
-      exlist = oldexlist-newexlist
-      exlist = [ ocplib.MortonXYZ ( zidx ) for zidx in exlist ]
+      oldexlist = ocplib.XYZMortonBatch ( curexlist )
+      newexlist = ocplib.XYZMortonBatch ( exceptions )
+      exlist = ocplib.MortonXYZBatch ( np.setdiff1d ( oldexlist, newexlist ) )
 
-      self.putExceptions ( ch, key, resolution, exid, exlist, True )
+      self.putExceptions ( ch, key, resolution, entityid, exlist, True )
+
+
+  def _getExceptionBlobs ( self, ch, listofidxs, resolution, update=False ):
+    """{ zidx : excstr } of a list of cuboids or None if the channel keeps exceptions per id"""
+
+    if getattr ( self.kvio, 'getCubeExceptions', None ) is None or ch.getChannelName() in self.noexcblobs:
+      return None
+    blobs = self.kvio.getCubeExceptions ( ch, listofidxs, resolution, update )
+    if blobs is None:
+      self.noexcblobs.add ( ch.getChannelName() )
+    return blobs
+
+  def _putExceptionBlobs ( self, ch, resolution, cubeexcs ):
+    """Write { zidx : { annid : voxels } } and delete the blobs of cuboids left without exceptions"""
+
+    listofblobs = []
+    emptyidxs = []
+    for zidx, exceptions in cubeexcs.iteritems():
+      if any ( [ len(voxels) for voxels in exceptions.itervalues() ] ):
+        listofblobs.append ( ( zidx, exceptioncodec.encode ( exceptions ) ) )
+      else:
+        emptyidxs.append ( zidx )
+
+    if listofblobs:
+      self.kvio.putCubeExceptions ( ch, resolution, listofblobs )
+    if emptyidxs:
+      self.kvio.deleteCubeExceptions ( ch, resolution, emptyidxs )
+
+  def getCubeExceptions ( self, ch, listofidxs, resolution, annids ):
+    """Bulk fetch the exceptions of annids in a list of cuboids as { zidx : { annid : voxels } }"""
+
+    listofidxs = [ int(zidx) for zidx in listofidxs ]
+    cubeexcs = {}
+
+    blobs = self._getExceptionBlobs ( ch, listofidxs, resolution )
+    if blobs is not None:
+      for zidx, excstr in blobs.iteritems():
+        exceptions = exceptioncodec.decode ( excstr )
+        exceptions = dict ( [ ( annid, exceptions[annid] ) for annid in annids if annid in exceptions ] )
+        if exceptions:
+          cubeexcs[zidx] = exceptions
+      return cubeexcs
+
+    # one read per cuboid and id
+    for zidx in listofidxs:
+      for annid in annids:
+        voxels = self.getExceptions ( ch, zidx, resolution, annid )
+        if len(voxels):
+          cubeexcs.setdefault ( zidx, {} )[annid] = voxels
+    return cubeexcs
+
+  def updateCubeExceptions ( self, ch, resolution, listofexceptions ):
+    """Merge a list of ( zidx, { annid : voxels } ) into the exceptions with one read and one write of the blobs"""
+
+    listofexceptions = [ ( int(zidx), exceptions ) for zidx, exceptions in listofexceptions if exceptions ]
+    if not listofexceptions:
+      return
+
+    blobs = self._getExceptionBlobs ( ch, [ zidx for zidx, exceptions in listofexceptions ], resolution, True )
+    if blobs is None:
+      for zidx, exceptions in listofexceptions:
+        for annid, voxels in exceptions.iteritems():
+          self.updateExceptions ( ch, zidx, resolution, annid, voxels )
+      return
+
+    cubeexcs = {}
+    for zidx, exceptions in listofexceptions:
+      if zidx not in cubeexcs:
+        cubeexcs[zidx] = exceptioncodec.decode ( blobs.get ( zidx ) )
+      for annid, voxels in exceptions.iteritems():
+        cubeexcs[zidx][int(annid)] = exceptioncodec.merge ( cubeexcs[zidx].get ( int(annid), [] ), voxels )
+
+    self._putExceptionBlobs ( ch, resolution, cubeexcs )
+
+  def removeCubeExceptions ( self, ch, resolution, listofexceptions ):
+    """Remove a list of ( zidx, { annid : voxels } ) from the exceptions"""
+
+    listofexceptions = [ ( int(zidx), exceptions ) for zidx, exceptions in listofexceptions if exceptions ]
+    if not listofexceptions:
+      return
+
+    blobs = self._getExceptionBlobs ( ch, [ zidx for zidx, exceptions in listofexceptions ], resolution, True )
+    if blobs is None:
+      for zidx, exceptions in listofexceptions:
+        for annid, voxels in exceptions.iteritems():
+          self.removeExceptions ( ch, zidx, resolution, annid, voxels )
+      return
+
+    cubeexcs = {}
+    for zidx, exceptions in listofexceptions:
+      # nothing to remove from cuboids without exceptions
+      if zidx not in blobs:
+        continue
+      if zidx not in cubeexcs:
+        cubeexcs[zidx] = exceptioncodec.decode ( blobs[zidx] )
+      for annid, voxels in exceptions.iteritems():
+        if int(annid) in cubeexcs[zidx]:
+          cubeexcs[zidx][int(annid)] = exceptioncodec.remove ( cubeexcs[zidx][int(annid)], voxels )
+
+    self._putExceptionBlobs ( ch, resolution, cubeexcs )
+
+  def deleteCubeExceptions ( self, ch, resolution, listofidxs, annid ):
+    """Delete all of the exceptions of an annotation in a list of cuboids"""
+
+    listofidxs = [ int(zidx) for zidx in listofidxs ]
+    if not listofidxs:
+      return
+
+    blobs = self._getExceptionBlobs ( ch, listofidxs, resolution, True )
+    if blobs is None:
+      for zidx in listofidxs:
+        self.kvio.deleteExceptions ( ch, zidx, resolution, annid )
+      return
+
+    cubeexcs = {}
+    for zidx, excstr in blobs.iteritems():
+      exceptions = exceptioncodec.decode ( excstr )
+      if exceptions.pop ( int(annid), None ) is not None:
+        cubeexcs[zidx] = exceptions
+
+    self._putExceptionBlobs ( ch, resolution, cubeexcs )
 
 
   def getNextCube ( self ):
@@ -486,10 +945,7 @@ class OCPCADB:
       return [None,None]
     else: 
       # decompress the cube
-      if self.NPZ:
-        cube.fromNPZ ( row[1] )
-      else:
-        cube.fromBlosc ( row[1] )
+      cube.fromCodec ( row[1], self.NPZ )
       return [row[0],cube]
 
 
@@ -539,40 +995,51 @@ class OCPCADB:
     # then turn into a set of ranges of the same element
     listoffsets = np.r_[0, nzdiff + 1, len(cubelocs)]
 
+    def annotateCube ( item ):
+      ( key, voxlist, cube ) = item
+      # get a voxel offset for the cube
+      cubeoff = ocplib.MortonXYZ( key )
+      offset = np.asarray([cubeoff[0]*cubedim[0],cubeoff[1]*cubedim[1],cubeoff[2]*cubedim[2]], dtype = np.uint32)
+      # add the items
+      return np.array(cube.annotate(entityid, offset, voxlist, conflictopt), dtype=np.uint8)
+
     # start a transaction if supported
-    self.kvio.startTxn()
-    for i in range(len(listoffsets)-1):
+    self.kvStartTxn()
 
-      # grab the list of voxels for the first cube
-      voxlist = cubelocs[listoffsets[i]:listoffsets[i+1],:][:,1:4]
-      #  and the morton key
-      key = cubelocs[listoffsets[i],0]
+    try:
 
-      cube = self.getCube ( ch, key, resolution, True )
+      # lock and read a batch of cubes at a time
+      for start in range ( 0, len(listoffsets)-1, self.updatecubes ):
 
-      # get a voxel offset for the cube
-      cubeoff = ocplib.MortonXYZ( key )
-      #cubeoff = zindex.MortonXYZ(key)
-      offset = np.asarray([cubeoff[0]*cubedim[0],cubeoff[1]*cubedim[1],cubeoff[2]*cubedim[2]], dtype = np.uint32)
+        batch = range ( start, min ( start+self.updatecubes, len(listoffsets)-1 ) )
+        # the morton key and list of voxels of each cube
+        keys = [ int(cubelocs[listoffsets[i],0]) for i in batch ]
+        voxlists = [ cubelocs[listoffsets[i]:listoffsets[i+1],:][:,1:4] for i in batch ]
 
-      # add the items
-      exceptions = np.array(cube.annotate(entityid, offset, voxlist, conflictopt), dtype=np.uint8)
-      #exceptions = np.array(cube.annotate(entityid, offset, voxlist, conflictopt), dtype=np.uint8)
+        cubes = self.getCubesForUpdate ( ch, keys, resolution )
+        listofexceptions = self.parallelMap ( annotateCube, zip ( keys, voxlists, cubes ) )
 
-      # update the sparse list of exceptions
-      if ch.getExceptions() == EXCEPTION_TRUE:
-        if len(exceptions) != 0:
-          self.updateExceptions(ch, key, resolution, entityid, exceptions)
+        # update the sparse lists of exceptions of the batch together
+        if ch.getExceptions() == EXCEPTION_TRUE:
+          self.updateCubeExceptions ( ch, resolution, [ ( key, { entityid : exceptions } ) for key, exceptions in zip ( keys, listofexceptions ) if len(exceptions) != 0 ] )
+
+        for key, cube in zip ( keys, cubes ):
 
-      self.putCube(ch, key, resolution, cube)
+          # buffered and written with one putCubes when the transaction commits
+          self.putCube(ch, key, resolution, cube)
 
-      # add this cube to the index
-      cubeidx[entityid].add(key)
+          # add this cube to the index
+          cubeidx[entityid].add(key)
+
+      # write it to the database
+      self.annoIdx.updateIndexDense(ch, cubeidx, resolution)
+
+    except:
+      self.kvRollback()
+      raise
 
-    # write it to the database
-    self.annoIdx.updateIndexDense(ch, cubeidx, resolution)
     # commit cubes.  not commit controlled with metadata
-    self.kvio.commit()
+    self.kvCommit()
 
 
   #
@@ -600,44 +1067,48 @@ class OCPCADB:
     # then turn into a set of ranges of the same element
     listoffsets = np.r_[0, nzdiff + 1, len(cubelocs)]
 
-    self.kvio.startTxn()
+    def shaveCube ( item ):
+      ( key, voxlist, cube ) = item
+      # get a voxel offset for the cube
+      cubeoff = ocplib.MortonXYZ(key)
+      offset = np.asarray( [cubeoff[0]*cubedim[0],cubeoff[1]*cubedim[1],cubeoff[2]*cubedim[2]], dtype=np.uint32 )
+      # remove the items
+      exlist, zeroed = cube.shave (entityid, offset, voxlist)
+      # voxels are removed from the exceptions as uint32 like they are stored
+      return np.array(exlist, dtype=np.uint32)
 
-    try:
+    self.kvStartTxn()
 
-      for i in range(len(listoffsets)-1):
+    try:
 
-        # grab the list of voxels for the first cube
-        voxlist = cubelocs[listoffsets[i]:listoffsets[i+1],:][:,1:4]
-        #  and the morton key
-        key = cubelocs[listoffsets[i],0]
+      # lock and read a batch of cubes at a time
+      for start in range ( 0, len(listoffsets)-1, self.updatecubes ):
 
-        cube = self.getCube (ch, key, resolution, True)
+        batch = range ( start, min ( start+self.updatecubes, len(listoffsets)-1 ) )
+        # the morton key and list of voxels of each cube
+        keys = [ int(cubelocs[listoffsets[i],0]) for i in batch ]
+        voxlists = [ cubelocs[listoffsets[i]:listoffsets[i+1],:][:,1:4] for i in batch ]
 
-        # get a voxel offset for the cube
-        cubeoff = ocplib.MortonXYZ(key)
-        #cubeoff2 = zindex.MortonXYZ(key)
-        offset = np.asarray( [cubeoff[0]*cubedim[0],cubeoff[1]*cubedim[1],cubeoff[2]*cubedim[2]], dtype=np.uint32 )
+        cubes = self.getCubesForUpdate ( ch, keys, resolution )
+        listofexceptions = self.parallelMap ( shaveCube, zip ( keys, voxlists, cubes ) )
 
-        # remove the items
-        exlist, zeroed = cube.shave (entityid, offset, voxlist)
-        # make sure that exceptions are stored as 8 bits
-        exceptions = np.array(exlist, dtype=np.uint8)
+        # update the sparse lists of exceptions of the batch together
+        if ch.getExceptions() == EXCEPTION_TRUE:
+          self.removeCubeExceptions ( ch, resolution, [ ( key, { entityid : exceptions } ) for key, exceptions in zip ( keys, listofexceptions ) if len(exceptions) != 0 ] )
 
-        # update the sparse list of exceptions
-        if ch.getExceptions == EXCEPTION_TRUE:
-          if len(exceptions) != 0:
-            self.removeExceptions ( ch, key, resolution, entityid, exceptions )
+        for key, cube in zip ( keys, cubes ):
 
-        self.putCube (ch, key, resolution, cube)
+          # buffered and written with one putCubes when the transaction commits
+          self.putCube (ch, key, resolution, cube)
 
         # For now do no index processing when shaving.  Assume there are still some
         #  voxels in the cube???
 
     except:
-      self.kvio.rollback()
+      self.kvRollback()
       raise
 
-    self.kvio.commit()
+    self.kvCommit()
 
 
   #
@@ -668,16 +1139,22 @@ class OCPCADB:
     databuffer = np.zeros ([znumcubes*zcubedim, ynumcubes*ycubedim, xnumcubes*xcubedim], dtype=np.uint32 )
     databuffer [ zoffset:zoffset+dim[2], yoffset:yoffset+dim[1], xoffset:xoffset+dim[0] ] = annodata 
 
+    # morton indexes of all the cuboids in z,y,x order
+    keys = ocplib.XYZMortonBatch ( ocplib.XYZBox ( [xstart,ystart,zstart], [xnumcubes,ynumcubes,znumcubes] ) ).tolist()
+
     # start a transaction if supported
-    self.kvio.startTxn()
+    self.kvStartTxn()
 
     try:
 
+      # the new exceptions of each cuboid are written together at the end
+      listofexceptions = []
+
       for z in range(znumcubes):
         for y in range(ynumcubes):
           for x in range(xnumcubes):
 
-            key = ocplib.XYZMorton ([x+xstart,y+ystart,z+zstart])
+            key = keys[(z*ynumcubes+y)*xnumcubes+x]
             cube = self.getCube (ch, key, resolution, True)
             
             if conflictopt == 'O':
@@ -687,16 +1164,12 @@ class OCPCADB:
             elif conflictopt == 'E': 
               if ch.getExceptions() == EXCEPTION_TRUE:
                 exdata = cube.exception ( databuffer [ z*zcubedim:(z+1)*zcubedim, y*ycubedim:(y+1)*ycubedim, x*xcubedim:(x+1)*xcubedim ] )
-                for exid in np.unique ( exdata ):
-                  if exid != 0:
-                    # get the offsets
-                    exoffsets = np.nonzero ( exdata==exid )
-                    # assemble into 3-tuples zyx->xyz
-                    exceptions = np.array ( zip(exoffsets[2], exoffsets[1], exoffsets[0]), dtype=np.uint32 )
-                    # update the exceptions
-                    self.updateExceptions ( ch, key, resolution, exid, exceptions )
-                    # add to the index
-                    index_dict[exid].add(key)
+                # the xyz offsets of each id's exceptions in one pass over the cube
+                exceptions = dict ( ocplib.VoxelGroups ( exdata ) )
+                listofexceptions.append ( ( key, exceptions ) )
+                # add to the index
+                for exid in exceptions:
+                  index_dict[exid].add(key)
               else:
                 logger.error("No exceptions for this project.")
                 raise OCPCAError ( "No exceptions for this project.")
@@ -706,25 +1179,22 @@ class OCPCADB:
             
             self.putCube (ch, key, resolution, cube)
 
-            # update the index for the cube
-            # get the unique elements that are being added to the data
-            uniqueels = np.unique ( databuffer [ z*zcubedim:(z+1)*zcubedim, y*ycubedim:(y+1)*ycubedim, x*xcubedim:(x+1)*xcubedim ] )
-            for el in uniqueels:
-              index_dict[el].add(key) 
+      # update the exceptions of all the cuboids with one read and one write
+      self.updateCubeExceptions ( ch, resolution, listofexceptions )
 
-            # remove 0 no reason to index that
-            if 0 in index_dict:
-              del(index_dict[0])
+      # update the index with the cuboids of each id being added to the data.  0 is not indexed.
+      for annid, cubenos in ocplib.CuboidIds ( databuffer, cubedim ):
+        index_dict[annid].update ( [ keys[cubeno] for cubeno in cubenos ] )
 
       # Update all indexes
       self.annoIdx.updateIndexDense(ch, index_dict, resolution)
       # commit cubes.  not commit controlled with metadata
 
     except:
-      self.kvio.rollback()
+      self.kvRollback()
       raise
     
-    self.kvio.commit()
+    self.kvCommit()
 
 
   #
@@ -772,29 +1242,31 @@ class OCPCADB:
     databuffer = np.zeros ([znumcubes*zcubedim, ynumcubes*ycubedim, xnumcubes*xcubedim], dtype=np.uint32 )
     databuffer [ zoffset:zoffset+dim[2], yoffset:yoffset+dim[1], xoffset:xoffset+dim[0] ] = annodata 
 
+    # morton indexes of all the cuboids in z,y,x order
+    keys = ocplib.XYZMortonBatch ( ocplib.XYZBox ( [xstart,ystart,zstart], [xnumcubes,ynumcubes,znumcubes] ) ).tolist()
+
     # start a transaction if supported
-    self.kvio.startTxn()
+    self.kvStartTxn()
 
     try:
 
+      # the shaved exceptions of each cuboid are removed together at the end
+      listofexceptions = []
+
       for z in range(znumcubes):
         for y in range(ynumcubes):
           for x in range(xnumcubes):
 
-            key = ocplib.XYZMorton ([x+xstart,y+ystart,z+zstart])
+            key = keys[(z*ynumcubes+y)*xnumcubes+x]
             cube = self.getCube(ch, key, resolution, True)
 
             exdata = cube.shaveDense ( databuffer [ z*zcubedim:(z+1)*zcubedim, y*ycubedim:(y+1)*ycubedim, x*xcubedim:(x+1)*xcubedim ] )
-            for exid in np.unique ( exdata ):
-              if exid != 0:
-                # get the offsets
-                exoffsets = np.nonzero ( exdata==exid )
-                # assemble into 3-tuples zyx->xyz
-                exceptions = np.array ( zip(exoffsets[2], exoffsets[1], exoffsets[0]), dtype=np.uint32 )
-                # update the exceptions
-                self.removeExceptions ( key, resolution, exid, exceptions )
-                # add to the index
-                index_dict[exid].add(key)
+            # the xyz offsets of each id's exceptions in one pass over the cube
+            exceptions = dict ( ocplib.VoxelGroups ( exdata ) )
+            listofexceptions.append ( ( key, exceptions ) )
+            # add to the index
+            for exid in exceptions:
+              index_dict[exid].add(key)
 
             self.putCube(ch, key, resolution, cube)
 
@@ -807,15 +1279,18 @@ class OCPCADB:
             # remove 0 no reason to index that
             del(index_dict[0])
 
+      # remove the exceptions of all the cuboids with one read and one write
+      self.removeCubeExceptions ( ch, resolution, listofexceptions )
+
       # Update all indexes
       self.annoIdx.updateIndexDense(ch, index_dict, resolution)
 
     except:
-      self.kvio.rollback()
+      self.kvRollback()
       raise
 
     # commit cubes.  not commit controlled with metadata
-    self.kvio.commit()
+    self.kvCommit()
 
 
   #
@@ -867,6 +1342,9 @@ class OCPCADB:
   def cutout ( self, ch, corner, dim, resolution, zscaling=None, annoids=None ):
     """Extract a cube of arbitrary size.  Need not be aligned."""
 
+    # cuboids are assembled into a padded cube and trimmed after scaling
+    trimoffset = None
+
     # if cutout is below resolution, get a smaller cube and scaleup
     if ch.getChannelType() in ANNOTATION_CHANNELS and ch.getResolution() > resolution:
 
@@ -891,6 +1369,9 @@ class OCPCADB:
       effdim = dim
       effresolution = resolution 
 
+      # no scaling so allocate only the requested region and copy cuboids into it
+      trimoffset = [ corner[0]%xcubedim, corner[1]%ycubedim, corner[2]%zcubedim ]
+
     # Round to the nearest larger cube in all dimensions
     zstart = effcorner[2]/zcubedim
     ystart = effcorner[1]/ycubedim
@@ -901,64 +1382,123 @@ class OCPCADB:
     xnumcubes = (effcorner[0]+effdim[0]+xcubedim-1)/xcubedim - xstart
   
     # use the requested resolution
-    if zscaling == 'nearisotropic' and self.datasetcfg.nearisoscaledown[resolution] > 1:
+    neariso = zscaling == 'nearisotropic' and self.datasetcfg.nearisoscaledown[resolution] > 1
+    if neariso:
       dbname = ch.getNearIsoTable(resolution)
     else:
       dbname = ch.getTable(effresolution)
 
     import cube
     incube = Cube.getCube ( cubedim, ch.getChannelType(), ch.getDataType() )
-    outcube = Cube.getCube([xnumcubes*xcubedim,ynumcubes*ycubedim,znumcubes*zcubedim], ch.getChannelType(), ch.getDataType())
+    if trimoffset is None:
+      outcube = Cube.getCube([xnumcubes*xcubedim,ynumcubes*ycubedim,znumcubes*zcubedim], ch.getChannelType(), ch.getDataType())
+    else:
+      outcube = Cube.getCube(dim, ch.getChannelType(), ch.getDataType())
                                         
-    # Build a list of indexes to access
-    listofidxs = []
-    for z in range ( znumcubes ):
-      for y in range ( ynumcubes ):
-        for x in range ( xnumcubes ):
-          mortonidx = ocplib.XYZMorton ( [x+xstart, y+ystart, z+zstart] )
-          listofidxs.append ( mortonidx )
-
-    # Sort the indexes in Morton order
-    listofidxs.sort()
+    # xyz offset stored for later use and the end of the box of cuboids
+    lowxyz = [ xstart, ystart, zstart ]
+    highxyz = [ xstart+xnumcubes, ystart+ynumcubes, zstart+znumcubes ]
     
-    # xyz offset stored for later use
-    lowxyz = ocplib.MortonXYZ ( listofidxs[0] )
-    
-    self.kvio.startTxn()
+    self.kvStartTxn()
 
     try:
 
-      if zscaling == 'nearisotropic' and self.datasetcfg.nearisoscaledown[resolution] > 1:
-        cuboids = self.getCubes(ch, listofidxs, effresolution, True)
+      # the database has to see the cubes written in this transaction
+      self.flushDirtyCubes()
+
+      applyexcs = annoids is not None and ch.getChannelType() in ANNOTATION_CHANNELS and ch.getExceptions() == EXCEPTION_TRUE
+      # cached cuboids that wait for the exceptions as ( zidx, array )
+      cachedcubes = []
+      # epochs of the cuboids to cache by zidx.  None when nothing is cached.
+      epochs = None
+
+      # copy cached cuboids into the output cube and fetch only the rest
+      if self.usecache and not neariso:
+
+        # Build a list of indexes to access in Morton order
+        listofidxs = np.sort ( ocplib.XYZMortonBatch ( ocplib.XYZBox ( lowxyz, [xnumcubes,ynumcubes,znumcubes] ) ) ).tolist()
+
+        def addCached ( data ):
+          incube.fromArray ( data )
+          self._addCutoutCuboid ( ch, effresolution, idx, incube, outcube, lowxyz, trimoffset, annoids )
+
+        # with exceptions to apply, cached cuboids are added after one read of all the exceptions
+        def copyCached ( data ):
+          cachedcubes.append ( ( idx, data.copy() ) )
+
+        missedidxs = []
+        for idx in listofidxs:
+          if applyexcs:
+            ncached = len(cachedcubes)
+            if not self.readCachedCuboid ( self.cacheKey ( ch, idx, effresolution ), copyCached ):
+              # drop a copy of a slot that was reused while it was copied
+              del cachedcubes[ncached:]
+              missedidxs.append ( idx )
+          elif not self.readCachedCuboid ( self.cacheKey ( ch, idx, effresolution ), addCached ):
+            missedidxs.append ( idx )
+        listofidxs = missedidxs
+
+        # a write that commits while the cuboids are read keeps them out of the caches
+        epochs = dict ( [ ( idx, self.cacheEpoch ( self.cacheKey ( ch, idx, effresolution ) ) ) for idx in listofidxs ] )
+
+        if listofidxs:
+          cuboids = self.getCubes(ch, listofidxs, effresolution, neariso)
+        else:
+          cuboids = []
+
       else:
-        cuboids = self.getCubes(ch, listofidxs, effresolution)
+        # read the whole box with range scans
+        ranges = ocplib.MortonRanges ( lowxyz, highxyz, self.rangegap )
+
+        # scan only around the cuboids that exist
+        if self.useexists and not neariso:
+          listofidxs = ocplib.XYZMortonBatch ( ocplib.XYZBox ( lowxyz, [xnumcubes,ynumcubes,znumcubes] ) )
+          existingidxs = self.existingCubes ( ch, listofidxs, effresolution )
+          if len(existingidxs) < len(listofidxs):
+            ranges = ocplib.IndexRanges ( existingidxs, self.rangegap )
+
+        if len(ranges):
+          cuboids = self._boxCuboids ( self.kvio.getCubeRanges ( ch, ranges, effresolution, neariso ), lowxyz, highxyz )
+        else:
+          cuboids = []
 
-      # use the batch generator interface
-      for idx, datastring in cuboids:
+      # exceptions are read while the cuboids are applied so finish reading the cuboids first
+      cubeexcs = None
+      if applyexcs:
+        cuboids = list ( cuboids )
+        # and read the exceptions of all of them and the cached ones together
+        excidxs = [ idx for idx, data in cachedcubes ] + [ idx for idx, datastring in cuboids if not cubecodec.isZeros ( datastring ) ]
+        cubeexcs = self.getCubeExceptions ( ch, excidxs, effresolution, annoids )
 
-        #add the query result cube to the bigger cube
-        curxyz = ocplib.MortonXYZ(int(idx))
-        offset = [ curxyz[0]-lowxyz[0], curxyz[1]-lowxyz[1], curxyz[2]-lowxyz[2] ]
-        
-        if self.NPZ:
-          incube.fromNPZ ( datastring[:] )
-        else:
-          incube.fromBlosc ( datastring[:] )
+        for idx, data in cachedcubes:
+          incube.fromArray ( data )
+          self._addCutoutCuboid ( ch, effresolution, idx, incube, outcube, lowxyz, trimoffset, annoids, cubeexcs )
 
-        # apply exceptions if it's an annotation project
-        if annoids!= None and ch.getChannelType() in ANNOTATION_CHANNELS:
-          incube.data = ocplib.filter_ctype_OMP ( incube.data, annoids )
-          if ch.getExceptions() == EXCEPTION_TRUE:
-            self.applyCubeExceptions ( ch, annoids, effresolution, idx, incube )
+      # pipeline the fetch and decompression when there are no exceptions to apply
+      if self.cutout_workers > 1 and annoids is None:
+        self._pipelineCutout ( ch, cubedim, effresolution, epochs, cuboids, outcube, lowxyz, trimoffset )
 
-        # add it to the output cube
-        outcube.addData ( incube, offset ) 
+      else:
+        # use the batch generator interface
+        for idx, datastring in cuboids:
+
+          # the output cube starts as zeros
+          if cubecodec.isZeros ( datastring ):
+            continue
+
+          incube.fromCodec ( datastring[:], self.NPZ )
+
+          if epochs is not None:
+            self.cacheCuboid ( self.cacheKey ( ch, idx, effresolution ), incube.data, epochs[int(idx)] )
+
+          #add the query result cube to the bigger cube
+          self._addCutoutCuboid ( ch, effresolution, idx, incube, outcube, lowxyz, trimoffset, annoids, cubeexcs )
 
     except:
-      self.kvio.rollback()
+      self.kvRollback()
       raise
 
-    self.kvio.commit()
+    self.kvCommit()
 
     # if we fetched a smaller cube to zoom, correct the result
     if ch.getChannelType() in ANNOTATION_CHANNELS and ch.getResolution() > resolution:
@@ -976,15 +1516,130 @@ class OCPCADB:
       # need to trime based on the cube cutout at resolution
       outcube.trim ( corner[0]%(xcubedim*(2**(ch.getResolution()-resolution))),dim[0], corner[1]%(ycubedim*(2**(ch.getResolution()-resolution))),dim[1], corner[2]%zcubedim,dim[2] )
       
-    # need to trim down the array to size only if the dimensions are not the same
-    elif dim[0] % xcubedim  == 0 and dim[1] % ycubedim  == 0 and dim[2] % zcubedim  == 0 and corner[0] % xcubedim  == 0 and corner[1] % ycubedim  == 0 and corner[2] % zcubedim  == 0:
-      pass
-    else:
-      outcube.trim ( corner[0]%xcubedim,dim[0],corner[1]%ycubedim,dim[1],corner[2]%zcubedim,dim[2] )
+    # otherwise the cube was allocated at the requested size and needs no trim
 
     return outcube
 
 
+  def _boxCuboids ( self, cuboids, lowxyz, highxyz ):
+    """Drop the cuboids outside of the box that merged ranges picked up"""
+
+    for idx, datastring in cuboids:
+      if self.rangegap == 0:
+        yield ( idx, datastring )
+      else:
+        curxyz = ocplib.MortonXYZ(int(idx))
+        if all ( [ lowxyz[i] <= curxyz[i] < highxyz[i] for i in range(3) ] ):
+          yield ( idx, datastring )
+
+
+  @kvmetrics.timed ( 'assemble.cutout' )
+  def _addCutoutCuboid ( self, ch, resolution, idx, incube, outcube, lowxyz, trimoffset, annoids, cubeexcs=None ):
+    """Filter a cuboid and copy it into the output cube at its offset from lowxyz.  cubeexcs are the prefetched exceptions by zidx."""
+
+    curxyz = ocplib.MortonXYZ(int(idx))
+    offset = [ curxyz[0]-lowxyz[0], curxyz[1]-lowxyz[1], curxyz[2]-lowxyz[2] ]
+
+    # apply exceptions if it's an annotation project
+    if annoids!= None and ch.getChannelType() in ANNOTATION_CHANNELS:
+      # filtering works in place and cached data is read only
+      if not incube.data.flags.writeable:
+        incube.data = incube.data.copy()
+      incube.data = ocplib.filter_ctype_OMP ( incube.data, annoids )
+      if ch.getExceptions() == EXCEPTION_TRUE:
+        self.applyCubeExceptions ( ch, annoids, resolution, idx, incube, None if cubeexcs is None else cubeexcs.get ( int(idx), {} ) )
+
+    # add it to the output cube
+    if trimoffset is None:
+      outcube.addData ( incube, offset ) 
+    else:
+      outcube.addTrimmedData ( incube, offset, trimoffset )
+
+
+  def _assembleCuboid ( self, ch, cubedim, datastring, outcube, offset, trimoffset, cachekey=None, epoch=None ):
+    """Decompress one cuboid and copy it into the output cube. Runs in the cutout pool."""
+
+    incube = Cube.getCube ( cubedim, ch.getChannelType(), ch.getDataType() )
+    incube.fromCodec ( datastring, self.NPZ )
+
+    if cachekey is not None:
+      self.cacheCuboid ( cachekey, incube.data, epoch )
+
+    # cuboids do not overlap so the threads write to disjoint regions
+    if trimoffset is None:
+      outcube.addData ( incube, offset )
+    else:
+      outcube.addTrimmedData ( incube, offset, trimoffset )
+
+
+  def _pipelineCutout ( self, ch, cubedim, resolution, epochs, cuboids, outcube, lowxyz, trimoffset ):
+    """Stream cuboids from the kvio in this thread while the cutout pool decompresses them.  Cuboids are cached at their epochs unless epochs is None."""
+
+    pool = getCutoutPool()
+
+    # bound the number of compressed cuboids waiting in memory
+    maxinflight = 2 * self.cutout_workers
+    inflight = deque()
+
+    try:
+      for idx, datastring in cuboids:
+
+        # the output cube starts as zeros
+        if cubecodec.isZeros ( datastring ):
+          continue
+
+        curxyz = ocplib.MortonXYZ(int(idx))
+        offset = [ curxyz[0]-lowxyz[0], curxyz[1]-lowxyz[1], curxyz[2]-lowxyz[2] ]
+        if epochs is not None:
+          cachekey = self.cacheKey ( ch, idx, resolution )
+          epoch = epochs[int(idx)]
+        else:
+          cachekey = epoch = None
+
+        inflight.append ( pool.submit ( self._assembleCuboid, ch, cubedim, datastring[:], outcube, offset, trimoffset, cachekey, epoch ) )
+
+        if len(inflight) >= maxinflight:
+          inflight.popleft().result()
+
+    except:
+      # don't leave workers writing into the cube after an error
+      for future in inflight:
+        future.cancel()
+      futures.wait ( inflight )
+      raise
+
+    # wait for the remaining cuboids and surface any decompression errors
+    while inflight:
+      inflight.popleft().result()
+
+
+  def slabBoxes ( self, ch, corner, dim, resolution ):
+    """Split a cutout into slabs one cuboid layer deep.  Returns a list of ( zoffset, corner, dim ) in z order."""
+
+    # the cuboids are read at the channel resolution when zooming annotations
+    if ch.getChannelType() in ANNOTATION_CHANNELS and ch.getResolution() != resolution:
+      zcubedim = self.datasetcfg.cubedim [ ch.getResolution() ][2]
+    else:
+      zcubedim = self.datasetcfg.cubedim [ resolution ][2]
+
+    boxes = []
+    zstart = corner[2]
+    zend = corner[2] + dim[2]
+    while zstart < zend:
+      # slabs end on cuboid boundaries so no cuboid is read twice
+      zslab = min ( (zstart/zcubedim+1)*zcubedim, zend ) - zstart
+      boxes.append ( ( zstart-corner[2], [ corner[0], corner[1], zstart ], [ dim[0], dim[1], zslab ] ) )
+      zstart += zslab
+    return boxes
+
+  def cutoutSlabs ( self, ch, corner, dim, resolution, zscaling=None, annoids=None ):
+    """Generator version of cutout.  Yields ( zoffset, cube ) in z order one cuboid layer
+       at a time so only a single slab of a large cutout is in memory."""
+
+    for zoffset, slabcorner, slabdim in self.slabBoxes ( ch, corner, dim, resolution ):
+      yield ( zoffset, self.cutout ( ch, slabcorner, slabdim, resolution, zscaling, annoids ) )
+
+
   def timecutout(self, ch, corner, dim, resolution, timerange):
     """Extract a cube of arbitrary size.  Need not be aligned."""
 
@@ -1005,46 +1660,38 @@ class OCPCADB:
     incube = Cube.getCube ( cubedim, ch.getChannelType(), ch.getDataType() )
     outcube = Cube.getCube([xnumcubes*xcubedim,ynumcubes*ycubedim,znumcubes*zcubedim], ch.getChannelType(), ch.getDataType(), timerange=timerange)
 
-    # Build a list of indexes to access
-    listofidxs = []
-    for z in range (znumcubes):
-      for y in range (ynumcubes):
-        for x in range (xnumcubes):
-          mortonidx = ocplib.XYZMorton([x+xstart, y+ystart, z+zstart])
-          listofidxs.append(mortonidx)
-
-    # Sort the indexes in Morton order
-    listofidxs.sort()
-
     # xyz offset stored for later use
-    lowxyz = ocplib.MortonXYZ(listofidxs[0])
+    lowxyz = [ xstart, ystart, zstart ]
 
-    self.kvio.startTxn()
+    # Build a list of indexes to access and their coordinates in Morton order
+    listofxyzs = ocplib.XYZBox ( lowxyz, [xnumcubes,ynumcubes,znumcubes] )
+    listofidxs = ocplib.XYZMortonBatch ( listofxyzs )
+    order = np.argsort ( listofidxs )
+    listofidxs = listofidxs[order].tolist()
+    listofxyzs = listofxyzs[order].tolist()
+
+    self.kvStartTxn()
 
     try:
-      for idx in listofidxs:
+      for idx, curxyz in zip ( listofidxs, listofxyzs ):
         cuboids = self.getTimeCubes(ch, idx, range(timerange[0],timerange[1]), resolution)
         
         # use the batch generator interface
         for idx, timestamp, datastring in cuboids:
 
           # add the query result cube to the bigger cube
-          curxyz = ocplib.MortonXYZ(int(idx))
           offset = [ curxyz[0]-lowxyz[0], curxyz[1]-lowxyz[1], curxyz[2]-lowxyz[2] ]
 
-          if self.NPZ:
-            incube.fromNPZ(datastring[:])
-          else:
-            incube.fromBlosc(datastring[:])
+          incube.fromCodec ( datastring[:], self.NPZ )
           
           # add it to the output cube
           outcube.addData(incube, offset, timestamp)
 
     except:
-      self.kvio.rollback()
+      self.kvRollback()
       raise
 
-    self.kvio.commit()
+    self.kvCommit()
 
     # need to trim down the array to size only if the dimensions are not the same
     if dim[0] % xcubedim  == 0 and dim[1] % ycubedim  == 0 and dim[2] % zcubedim  == 0 and corner[0] % xcubedim  == 0 and corner[1] % ycubedim  == 0 and corner[2] % zcubedim  == 0:
@@ -1106,20 +1753,19 @@ class OCPCADB:
     return cube
 
   # helper function to apply exceptions
-  def applyCubeExceptions ( self, ch, annoids, resolution, idx, cube ):
-    """Apply the expcetions to a specified cube and resolution"""
+  def applyCubeExceptions ( self, ch, annoids, resolution, idx, cube, exceptions=None ):
+    """Apply the expcetions to a specified cube and resolution.  exceptions are { annoid : voxels } when already read."""
 
-    # get the size of the image and cube
-    [ xcubedim, ycubedim, zcubedim ] = cubedim = self.datasetcfg.cubedim [ resolution ] 
-  
-    (x,y,z) = ocplib.MortonXYZ ( idx )
+    if exceptions is None:
+      exceptions = self.getCubeExceptions ( ch, [ idx ], resolution, annoids ).get ( int(idx), {} )
 
     # for the target ids
     for annoid in annoids:
       # apply exceptions
-      exceptions = self.getExceptions( ch, idx, resolution, annoid ) 
-      for e in exceptions:
-        cube.data[e[2],e[1],e[0]]=annoid
+      voxels = exceptions.get ( annoid, [] )
+      if len(voxels):
+        voxels = np.asarray ( voxels, dtype=np.uint32 )
+        cube.data[voxels[:,2],voxels[:,1],voxels[:,0]]=annoid
 
   #
   #  zoomVoxels
@@ -1158,6 +1804,10 @@ class OCPCADB:
     
     zidxs = self.annoIdx.getIndex(ch,entityid,resolution)
 
+    # read the exceptions of all the cuboids together
+    if ch.getExceptions() ==  EXCEPTION_TRUE:
+      cubeexcs = self.getCubeExceptions ( ch, zidxs, resolution, [ entityid ] )
+
     for zidx in zidxs:
 
       cb = self.getCube(ch, zidx,effectiveres) 
@@ -1179,8 +1829,8 @@ class OCPCADB:
 
       # Now add the exception voxels
       if ch.getExceptions() ==  EXCEPTION_TRUE:
-        exceptions = self.getExceptions( ch, zidx, resolution, entityid ) 
-        if exceptions != []:
+        exceptions = cubeexcs.get ( int(zidx), {} ).get ( entityid, [] )
+        if len(exceptions):
           voxels = np.append ( voxels.flatten(), exceptions.flatten())
           voxels = voxels.reshape(len(voxels)/3,3)
 
@@ -1209,15 +1859,12 @@ class OCPCADB:
       scaling=1
 
     # all boxes in the indexes
-    zidxs=[]
-    for annid in annids:
-      zidxs = itertools.chain(zidxs,self.annoIdx.getIndex(ch, annid, effectiveres))
+    ranges = indexcodec.union ( [ self.annoIdx.getIndexRanges(ch, annid, effectiveres) for annid in annids ] )
     
     # convert to xyz coordinates
-    try:
-      xyzvals = np.array ( [ ocplib.MortonXYZ(zidx) for zidx in zidxs ], dtype=np.uint32 )
-    # if there's nothing in the chain, the array creation will fail
-    except:
+    xyzvals = ocplib.MortonXYZBatch ( indexcodec.toZidxs ( ranges ) )
+    # if there's nothing in the chain there is no bounding box
+    if len(xyzvals) == 0:
       return None, None
 
     cubedim = self.datasetcfg.cubedim [ resolution ] 
@@ -1247,9 +1894,11 @@ class OCPCADB:
     else:
       effectiveres = resolution
     
-    zidxs = set()
-    for did in dataids:
-      zidxs |= set ( self.annoIdx.getIndex(ch, did, effectiveres))
+    zidxs = indexcodec.toZidxs ( indexcodec.union ( [ self.annoIdx.getIndexRanges(ch, did, effectiveres) for did in dataids ] ) )
+
+    # read the exceptions of all the cuboids together
+    if ch.getExceptions() == EXCEPTION_TRUE:
+      cubeexcs = self.getCubeExceptions ( ch, zidxs, effectiveres, dataids )
 
     for zidx in zidxs:
 
@@ -1276,8 +1925,8 @@ class OCPCADB:
       # Get exceptions if this DB supports it
       if ch.getExceptions() == EXCEPTION_TRUE:
         for exid in dataids:
-          exceptions = self.getExceptions(ch, zidx, effectiveres, exid) 
-          if exceptions != []:
+          exceptions = cubeexcs.get ( int(zidx), {} ).get ( exid, [] )
+          if len(exceptions):
             if resolution < effectiveres:
                 exceptions = self.zoomVoxels ( exceptions, effectiveres-resolution )
             # write as a loop first, then figure out how to optimize 
@@ -1361,7 +2010,7 @@ class OCPCADB:
     
     resolutions = self.datasetcfg.resolutions
 
-    self.kvio.startTxn()
+    self.kvStartTxn()
 
     try:
 
@@ -1376,19 +2025,20 @@ class OCPCADB:
           # KL TODO
           vec_func = np.vectorize ( lambda x: np.uint32(0) if x == annoid else x )
           cube.data = vec_func ( cube.data )
-          # remove the expcetions
-          if ch.getExceptions == EXCEPTION_TRUE:
-            self.kvio.deleteExceptions(ch, key, res, annoid)
           self.putCube(ch, key, res, cube)
+
+        # remove the expcetions
+        if ch.getExceptions() == EXCEPTION_TRUE:
+          self.deleteCubeExceptions ( ch, res, zidxs, annoid )
         
       # delete Index
       self.annoIdx.deleteIndex(ch, annoid,resolutions)
 
     except:
-      self.kvio.rollback()
+      self.kvRollback()
       raise
 
-    self.kvio.commit()
+    self.kvCommit()
 
 
   def getChildren ( self, ch, annoid ):
@@ -1524,9 +2174,10 @@ class OCPCADB:
 
     incube = Cube.getCube ( cubedim, ch.getChannelType(), ch.getDataType() )
     
-    self.kvio.startTxn()
+    self.kvStartTxn()
     
-    listofidxs = []
+    # morton indexes of all the cuboids in z,y,x order
+    listofidxs = ocplib.XYZMortonBatch ( ocplib.XYZBox ( start, [xnumcubes,ynumcubes,znumcubes] ) ).tolist()
     listofcubes = []
 
     try:
@@ -1534,17 +2185,16 @@ class OCPCADB:
         for y in range(ynumcubes):
           for x in range(xnumcubes):
 
-            listofidxs.append(ocplib.XYZMorton ([x+xstart,y+ystart,z+zstart]))
             incube.data = databuffer [ z*zcubedim:(z+1)*zcubedim, y*ycubedim:(y+1)*ycubedim, x*xcubedim:(x+1)*xcubedim ]
-            listofcubes.append(incube.toBlosc())
+            listofcubes.append(incube.toCodec(ch.getCodec(), self.NPZ))
 
       self.putCubes(ch, listofidxs, resolution, listofcubes, update=False)
 
     except:
-      self.kvio.rollback()
+      self.kvRollback()
       raise
 
-    self.kvio.commit()
+    self.kvCommit()
 
   def writeCuboid(self, ch, corner, resolution, cuboiddata):
     """Write an image through the Web service"""
@@ -1573,14 +2223,17 @@ class OCPCADB:
     databuffer = np.zeros ([znumcubes*zcubedim, ynumcubes*ycubedim, xnumcubes*xcubedim], dtype=cuboiddata.dtype )
     databuffer [ zoffset:zoffset+dim[2], yoffset:yoffset+dim[1], xoffset:xoffset+dim[0] ] = cuboiddata 
 
-    self.kvio.startTxn()
+    # morton indexes of all the cuboids in z,y,x order
+    keys = ocplib.XYZMortonBatch ( ocplib.XYZBox ( start, [xnumcubes,ynumcubes,znumcubes] ) ).tolist()
+
+    self.kvStartTxn()
  
     try:
       for z in range(znumcubes):
         for y in range(ynumcubes):
           for x in range(xnumcubes):
 
-            key = ocplib.XYZMorton ([x+xstart,y+ystart,z+zstart])
+            key = keys[(z*ynumcubes+y)*xnumcubes+x]
             cube = self.getCube (ch, key, resolution, update=True)
             # overwrite the cube
             cube.overwrite ( databuffer [ z*zcubedim:(z+1)*zcubedim, y*ycubedim:(y+1)*ycubedim, x*xcubedim:(x+1)*xcubedim ] )
@@ -1588,10 +2241,10 @@ class OCPCADB:
             self.putCube (ch, key, resolution, cube)
 
     except:
-      self.kvio.rollback()
+      self.kvRollback()
       raise
 
-    self.kvio.commit()
+    self.kvCommit()
 
   def writeTimeCuboid(self, ch, corner, resolution, timerange, cuboiddata):
     """Write an image through the Web service"""
@@ -1618,15 +2271,18 @@ class OCPCADB:
     databuffer = np.zeros([timerange[1]-timerange[0]]+[znumcubes*zcubedim, ynumcubes*ycubedim, xnumcubes*xcubedim], dtype=cuboiddata.dtype )
     databuffer[:, zoffset:zoffset+dim[2], yoffset:yoffset+dim[1], xoffset:xoffset+dim[0]] = cuboiddata 
 
-    self.kvio.startTxn()
+    # morton indexes of all the cuboids in z,y,x order
+    keys = ocplib.XYZMortonBatch ( ocplib.XYZBox ( [xstart,ystart,zstart], [xnumcubes,ynumcubes,znumcubes] ) ).tolist()
+
+    self.kvStartTxn()
  
     try:
       for z in range(znumcubes):
         for y in range(ynumcubes):
           for x in range(xnumcubes):
+            zidx = keys[(z*ynumcubes+y)*xnumcubes+x]
             for timestamp in range(timerange[0], timerange[1], 1):
 
-              zidx = ocplib.XYZMorton([x+xstart,y+ystart,z+zstart])
               cube = self.getTimeCube(ch, zidx, timestamp, resolution, update=True)
               # overwrite the cube
               cube.overwrite(databuffer[timestamp-timerange[0], z*zcubedim:(z+1)*zcubedim, y*ycubedim:(y+1)*ycubedim, x*xcubedim:(x+1)*xcubedim])
@@ -1634,10 +2290,10 @@ class OCPCADB:
               self.putTimeCube(ch, zidx, timestamp, resolution, cube)
 
     except:
-      self.kvio.rollback()
+      self.kvRollback()
       raise
 
-    self.kvio.commit()
+    self.kvCommit()
 
 
   def mergeGlobal(self, ch, ids, mergetype, res):
@@ -1655,32 +2311,31 @@ class OCPCADB:
   
     # Get the list of cubeindexes for the Ramon objects
     listofidxs = set()
-    addindex = []
+    addranges = indexcodec.empty()
     # RB!!!! do this for all ids, promoting the exceptions of the merge id
     for annid in ids:
       if annid == mergeid:
         continue
       # Get the Annotation index for that id
-      curindex = self.annoIdx.getIndex(ch, annid,resolution)
+      curranges = self.annoIdx.getIndexRanges(ch, annid,resolution)
       # Final list of index which has to be updated in idx table
-      addindex = np.union1d(addindex,curindex)
+      addranges = indexcodec.union ( [ addranges, curranges ] )
       # Merge the annotations in the cubes for the current id
-      listofidxs = set(curindex)
+      listofidxs = indexcodec.toZidxs ( curranges )
       for key in listofidxs:
         cube = self.getCube (ch, key,resolution)
-        if ch.getExceptions() == EXCEPTION_TRUE:
-          oldexlist = self.getExceptions( ch, key, resolution, annid ) 
-          self.kvio.deleteExceptions ( ch, key, resolution, annid )
-        #
-        # RB!!!!! this next line is wrong!  the problem is that
-        #  we are merging all annotations.  So at the end, there
-        #  need to be no exceptions left.  This line will leave
-        #  exceptions with the same value as the annotation.
-        #  Just delete the exceptions
-        #
         # Ctype optimized version for mergeCube
         ocplib.mergeCube_ctype ( cube.data, mergeid, annid )
         self.putCube ( ch, key, resolution, cube )
+      #
+      # RB!!!!! merging the exceptions is wrong!  the problem is that
+      #  we are merging all annotations.  So at the end, there
+      #  need to be no exceptions left.  Merging would leave
+      #  exceptions with the same value as the annotation.
+      #  Just delete the exceptions in all the cubes at once
+      #
+      if ch.getExceptions() == EXCEPTION_TRUE:
+        self.deleteCubeExceptions ( ch, resolution, listofidxs, annid )
         
       # Delete annotation and all it's meta data from the database
       #
@@ -1694,8 +2349,8 @@ class OCPCADB:
           self.deleteAnnotation (ch, annid, '' )
         except:
           logger.warning("Failed to delete annotation {} during merge.".format(annid))
-    self.annoIdx.updateIndex(ch, mergeid,addindex,resolution)     
-    self.kvio.commit()
+    self.annoIdx.updateIndex(ch, mergeid,indexcodec.toZidxs(addranges),resolution)     
+    self.kvCommit()
     
     return "Merged Id's {} into {}".format(ids, mergeid)
 
@@ -26,7 +26,11 @@ from ocpuser.models import Dataset
 from ocpuser.models import Token
 from ocpuser.models import Channel
 import annotation
-from ocptype import IMAGE_CHANNELS, ANNOTATION_CHANNELS, ZSLICES, ISOTROPIC, READONLY_TRUE, READONLY_FALSE, PUBLIC_TRUE, NOT_PROPAGATED, UNDER_PROPAGATION, PROPAGATED, IMAGE, ANNOTATION, TIMESERIES, MYSQL, CASSANDRA, RIAK, OCP_servermap
+import mysqlpool
+import filekvio
+import tieredkvio
+import cubeexists
+from ocptype import IMAGE_CHANNELS, ANNOTATION_CHANNELS, TIMESERIES_CHANNELS, ZSLICES, ISOTROPIC, READONLY_TRUE, READONLY_FALSE, PUBLIC_TRUE, NOT_PROPAGATED, UNDER_PROPAGATION, PROPAGATED, IMAGE, ANNOTATION, TIMESERIES, MYSQL, CASSANDRA, RIAK, FILE, AEROSPIKE, OCP_servermap, CODEC_DEFAULT, CODEC_ZLIB, CODEC_BLOSC, CODEC_LZ4, CODEC_ZSTD
 
 # need imports to be conditional
 try:
@@ -37,6 +41,10 @@ try:
   import riak
 except:
    pass
+try:
+  import askvio
+except:
+   pass
 
 from ocpcaerror import OCPCAError
 import logging
@@ -217,6 +225,8 @@ class OCPCAProject:
     return self.pr.kvengine
   def getKVServer ( self ):
     return self.pr.kvserver
+  def getKVTier ( self ):
+    return self.pr.kvtier
   def getDBName ( self ):
     return self.pr.project_name
   def getProjectName ( self ):
@@ -272,6 +282,8 @@ class OCPCAChannel:
     return self.ch.channel_description
   def getExceptions ( self ):
     return self.ch.exceptions
+  def getCodec ( self ):
+    return self.ch.codec
   def getReadOnly (self):
     return self.ch.readonly
   def getResolution (self):
@@ -294,7 +306,7 @@ class OCPCAChannel:
     if self.pr.getOCPVersion() == '0.0':
       return "res{}".format(resolution)
     else:
-      if self.pr.getKVEngine() == MYSQL:
+      if self.pr.getKVEngine() in [MYSQL, FILE]:
         return "{}_res{}".format(self.ch.channel_name, resolution)
       elif self.pr.getKVEngine() == CASSANDRA:
         return "{}_{}".format(self.ch.channel_name, 'cuboids')
@@ -318,7 +330,7 @@ class OCPCAChannel:
     if self.pr.getOCPVersion() == '0.0':
       return "idx{}".format(resolution)
     else:
-      if self.pr.getKVEngine() == MYSQL:
+      if self.pr.getKVEngine() in [MYSQL, FILE]:
         return "{}_idx{}".format(self.ch.channel_name, resolution)
       elif self.pr.getKVEngine() == CASSANDRA:
         return "{}_{}".format(self.ch.channel_name, 'indexes')
@@ -337,6 +349,27 @@ class OCPCAChannel:
     else:
       return "{}_exc{}".format(self.ch.channel_name, resolution)
 
+  def getCubeExceptionsTable (self, resolution):
+    """Return the table of per cuboid exception blobs for the specified resolution"""
+    if self.pr.getOCPVersion() == '0.0':
+      return "cubeexc{}".format(resolution)
+    else:
+      return "{}_cubeexc{}".format(self.ch.channel_name, resolution)
+
+  def getIdxLogTable (self, resolution):
+    """Return the index delta log table for the specified resolution"""
+    if self.pr.getOCPVersion() == '0.0':
+      return "idxlog{}".format(resolution)
+    else:
+      return "{}_idxlog{}".format(self.ch.channel_name, resolution)
+
+  def getExistsTable (self):
+    """Return the table of cuboid existence bitmaps"""
+    if self.pr.getOCPVersion() == '0.0':
+      return "cubeexists"
+    else:
+      return "{}_exists".format(self.ch.channel_name)
+
   def setPropagate (self, value):
     if value in [NOT_PROPAGATED, PROPAGATED]:
       self.ch.propagate = value
@@ -358,6 +391,14 @@ class OCPCAChannel:
       logger.error ( "Wrong Readonly Value {} for Channel {}".format( value, self.channel_name ) )
       raise OCPCAError ( "Wrong Readonly Value {} for Channel {}".format( value, self.ch.channel_name ) )
 
+  def setCodec (self, value):
+    if value in [CODEC_DEFAULT, CODEC_ZLIB, CODEC_BLOSC, CODEC_LZ4, CODEC_ZSTD]:
+      self.ch.codec = value
+      self.ch.save()
+    else:
+      logger.error ( "Wrong Codec Value {} for Channel {}".format( value, self.ch.channel_name ) )
+      raise OCPCAError ( "Wrong Codec Value {} for Channel {}".format( value, self.ch.channel_name ) )
+
   def isPropagated (self):
     if self.ch.propagate in [PROPAGATED]:
       return True
@@ -370,11 +411,14 @@ class OCPCAProjectsDB:
   def __init__(self):
     """Create the database connection"""
 
-    self.conn = MySQLdb.connect (host = settings.DATABASES['default']['HOST'], user = settings.DATABASES['default']['USER'], passwd = settings.DATABASES['default']['PASSWORD'], db = settings.DATABASES['default']['NAME']) 
+    self.conn = mysqlpool.connect (host = settings.DATABASES['default']['HOST'], user = settings.DATABASES['default']['USER'], passwd = settings.DATABASES['default']['PASSWORD'], db = settings.DATABASES['default']['NAME']) 
 
   # for context lib closing
   def close (self):
-    pass
+    """Return the connection to the pool"""
+    if self.conn:
+      mysqlpool.release (self.conn, host = settings.DATABASES['default']['HOST'], user = settings.DATABASES['default']['USER'], passwd = settings.DATABASES['default']['PASSWORD'], db = settings.DATABASES['default']['NAME'])
+      self.conn = None
 
   def newOCPCAProject ( self, project_name ):
     """Make the database for a project."""
@@ -412,6 +456,13 @@ class OCPCAProjectsDB:
       finally:
         session.shutdown()
 
+    elif pr.kvengine == FILE:
+      filekvio.makeDirs ( filekvio.projectPath ( pr.project_name ) )
+
+    elif pr.kvengine in [RIAK, AEROSPIKE]:
+      # buckets and sets are created on the first write
+      pass
+
 
   def newOCPCAChannel ( self, project_name, channel_name ):
     """Make the tables for a channel."""
@@ -431,6 +482,10 @@ class OCPCAProjectsDB:
             if ch.channel_type not in [TIMESERIES]:
               for i in range(ds.scalinglevels+1): 
                 cursor.execute ( "CREATE TABLE {}_res{} ( zindex BIGINT PRIMARY KEY, cube LONGBLOB )".format(ch.channel_name,i) )
+              # existence bitmaps start out complete and empty
+              cursor.execute ( "CREATE TABLE {}_exists ( resolution INT, block BIGINT, bitmap BLOB, PRIMARY KEY(resolution,block))".format(ch.channel_name) )
+              for i in range(ds.scalinglevels+1):
+                cursor.execute ( "INSERT INTO {}_exists (resolution,block,bitmap) VALUES (%s,%s,'')".format(ch.channel_name), [i, cubeexists.READY] )
             # tables specific to timeseries data
             elif ch.channel_type == TIMESERIES:
               for i in range(ds.scalinglevels+1): 
@@ -452,7 +507,11 @@ class OCPCAProjectsDB:
               cursor.execute ( "CREATE TABLE {}_kvpairs ( annoid BIGINT, kv_key VARCHAR(255), kv_value VARCHAR(20000), PRIMARY KEY ( annoid, kv_key ))".format(ch.channel_name))
               for i in range(ds.scalinglevels+1):
                 cursor.execute ( "CREATE TABLE {}_exc{} ( zindex BIGINT, id BIGINT, exlist LONGBLOB, PRIMARY KEY ( zindex, id))".format(ch.channel_name,i))
+                # the exceptions of new channels are kept as one blob per cuboid
+                if getattr ( settings, 'EXCEPTION_CUBE_BLOBS', True ):
+                  cursor.execute ( "CREATE TABLE {}_cubeexc{} ( zindex BIGINT PRIMARY KEY, exlist LONGBLOB )".format(ch.channel_name,i))
                 cursor.execute ( "CREATE TABLE {}_idx{} ( annid BIGINT PRIMARY KEY, cube LONGBLOB )".format(ch.channel_name,i))
+                cursor.execute ( "CREATE TABLE {}_idxlog{} ( seq BIGINT AUTO_INCREMENT PRIMARY KEY, annid BIGINT, delta LONGBLOB, INDEX ( annid, seq ) )".format(ch.channel_name,i))
            
             # Commiting at the end
             conn.commit()
@@ -464,9 +523,13 @@ class OCPCAProjectsDB:
     elif pr.kvengine == RIAK:
       #RBTODO figure out new schema for Riak
       rcli = riak.RiakClient(host=pr.kvserver, pb_port=8087, protocol='pbc')
-      bucket = rcli.bucket_type("ocp{}".format(proj.getProjectType())).bucket(proj.getDBName())
+      bucket = rcli.bucket(pr.project_name)
       bucket.set_property('allow_mult',False)
 
+    elif pr.kvengine == AEROSPIKE:
+      # sets are created on the first write
+      pass
+
     elif pr.kvengine == CASSANDRA:
       try:
         if ch.channel_type not in [TIMESERIES]:
@@ -481,6 +544,11 @@ class OCPCAProjectsDB:
         raise OCPCAError("Failed to create table for channel {}".format(channel_name))
       finally:
         session.shutdown()
+
+    elif pr.kvengine == FILE:
+      filekvio.makeDirs ( filekvio.channelPath ( pr.project_name, ch.channel_name ) )
+      if ch.channel_type not in [TIMESERIES]:
+        filekvio.markExistsReady ( pr.project_name, ch.channel_name, range(ds.scalinglevels+1) )
       
     else:
       logging.error ("Unknown KV Engine requested: {}".format("RBTODO get name"))
@@ -524,14 +592,23 @@ class OCPCAProjectsDB:
 
     elif pr.kvengine == RIAK:
       # connect to Riak
-      rcli = riak.RiakClient(host=proj.kvserver, pb_port=8087, protocol='pbc')
-      bucket = rcli.bucket_type("ocp{}".format(proj.getProjectType())).bucket(proj.getDBName())
+      rcli = riak.RiakClient(host=pr.kvserver, pb_port=8087, protocol='pbc')
+      bucket = rcli.bucket(pr.project_name)
 
       key_list = rcli.get_keys(bucket)
 
       for k in key_list:
         bucket.delete(k)
 
+    elif pr.kvengine == AEROSPIKE:
+      askvio.deleteSet ( pr.kvserver, pr.project_name )
+
+    elif pr.kvengine == FILE:
+      filekvio.deletePath ( filekvio.projectPath ( pr.project_name ) )
+
+    # the local store of a tiered project.  it may be left from when the project had a tier.
+    filekvio.deletePath ( tieredkvio.tierPath ( pr.project_name ) )
+
 
   def deleteOCPCAChannel (self, proj, channel_name):
     """Delete the tables for this channel"""
@@ -545,10 +622,13 @@ class OCPCAProjectsDB:
       for key in annotation.anno_dbtables.keys():
         table_list.append(ch.getAnnoTable(key))
 
+    if ch.getChannelType() not in TIMESERIES_CHANNELS:
+      table_list.append(ch.getExistsTable())
+
     for i in pr.datasetcfg.getResolutions():
       table_list.append(ch.getTable(i))
       if ch.getChannelType() in ANNOTATION_CHANNELS:
-        table_list = table_list + [ch.getIdxTable(i), ch.getExceptionsTable(i)]
+        table_list = table_list + [ch.getIdxTable(i), ch.getIdxLogTable(i), ch.getExceptionsTable(i), ch.getCubeExceptionsTable(i)]
 
     print table_list
     if pr.getKVEngine() == MYSQL:
@@ -579,6 +659,12 @@ class OCPCAProjectsDB:
       # KL TODO
       pass
 
+    elif pr.getKVEngine() == FILE:
+      filekvio.deletePath ( filekvio.channelPath ( pr.getDBName(), channel_name ) )
+
+    # the local store of a tiered project.  it may be left from when the project had a tier.
+    filekvio.deletePath ( tieredkvio.tierPath ( pr.getDBName(), channel_name ) )
+
   def loadDatasetConfig ( self, dataset ):
     """Query the database for the dataset information and build a db configuration"""
     return OCPCADataset (dataset)
@@ -21,6 +21,7 @@ import os
 import cStringIO
 import csv
 import re
+import copy
 import json
 import blosc
 from PIL import Image
@@ -45,6 +46,7 @@ import mcfc
 import ocplib
 import ocpcaskel
 import ocpcanifti
+import singleflight
 from windowcutout import windowCutout
 from ocptype import TIMESERIES_CHANNELS, IMAGE_CHANNELS, ANNOTATION_CHANNELS, NOT_PROPAGATED, UNDER_PROPAGATION, PROPAGATED, OCP_dtypetonp, DTYPE_uint8, DTYPE_uint16, DTYPE_uint32, READONLY_TRUE, READONLY_FALSE
 
@@ -52,11 +54,16 @@ from ocpcaerror import OCPCAError
 import logging
 logger=logging.getLogger("ocp")
 
+# size of the reads when streaming a result file
+STREAM_CHUNK_SIZE = 2**20
+
+# services whose arguments are channels/service/cutoutargs
+CUTOUT_SERVICES = [ 'hdf5', 'tiff', 'npz', 'blosc', 'jpeg', 'zip', 'ids' ]
+
+
+def cutoutArgs ( imageargs, proj ):
+  """Parse and validate the arguments of a cutout"""
 
-def cutout (imageargs, ch, proj, db):
-  """Build and Return a cube of data for the specified dimensions. This method is called by all of the more basic services to build the data. They then format and refine the output. """
-  
-  # Perform argument processing
   try:
     args = restargs.BrainRestArgs ()
     args.cutoutArgs(imageargs, proj.datasetcfg)
@@ -64,6 +71,15 @@ def cutout (imageargs, ch, proj, db):
     logger.warning("REST Arguments {} failed: {}".format(imageargs,e))
     raise OCPCAError(e.value)
 
+  return args
+
+
+def cutout (imageargs, ch, proj, db):
+  """Build and Return a cube of data for the specified dimensions. This method is called by all of the more basic services to build the data. They then format and refine the output. """
+  
+  # Perform argument processing
+  args = cutoutArgs ( imageargs, proj )
+
   # Extract the relevant values
   corner = args.getCorner()
   dim = args.getDim()
@@ -81,6 +97,74 @@ def cutout (imageargs, ch, proj, db):
   filterCube(ch, cube, filterlist)
   return cube
 
+def cutoutKey ( proj, channels, service, args, corner=None, dim=None ):
+  """singleflight key of a cutout from its parsed arguments.  corner and dim default to the arguments'."""
+
+  filterlist = args.getFilter()
+  return 'cutout/{}/{}/{}/{}/{}/{}/{}/{}/{}'.format ( proj.getProjectName(), channels, service, args.getResolution(),
+      ','.join ( [ str(i) for i in corner or args.getCorner() ] ), ','.join ( [ str(i) for i in dim or args.getDim() ] ),
+      ','.join ( [ str(i) for i in args.getTimeRange() ] ), args.getZScaling(),
+      '' if filterlist is None else ','.join ( [ str(i) for i in np.unique ( filterlist ) ] ) )
+
+def requestKey ( proj, channel, service, chanargs ):
+  """singleflight key of a GET request.  Requests that only spell their arguments differently share it."""
+
+  if service in CUTOUT_SERVICES:
+    return cutoutKey ( proj, channel, service, cutoutArgs ( chanargs, proj ) )
+
+  # slices and voxels have formats of their own.  normalize the slashes and numbers.
+  chanargs = re.sub ( r'\d+', lambda m: str ( int ( m.group(0) ) ), re.sub ( r'/+', '/', chanargs ).strip('/') )
+  return 'request/{}/{}/{}/{}'.format ( proj.getProjectName(), channel, service, chanargs )
+
+def cutoutSlabs ( args, ch, db ):
+  """Generator version of cutout.  Yields ( zoffset, cube ) one cuboid layer deep so that large cutouts are never in memory at once.
+     Concurrent cutouts of the same slab share one read.  The cube is shared so only replace its data, don't modify it."""
+
+  # timeseries cutouts are not split
+  if ch.getChannelType() in TIMESERIES_CHANNELS:
+    cube = db.timecutout(ch, args.getCorner(), args.getDim(), args.getResolution(), args.getTimeRange())
+    filterCube(ch, cube, args.getFilter())
+    yield ( 0, cube )
+    return
+
+  def slabCutout ( corner, dim ):
+    cube = db.cutout ( ch, corner, dim, args.getResolution(), args.getZScaling() )
+    filterCube(ch, cube, args.getFilter())
+    return cube
+
+  for zoffset, corner, dim in db.slabBoxes ( ch, args.getCorner(), args.getDim(), args.getResolution() ):
+    cube = singleflight.do ( cutoutKey ( db.proj, ch.getChannelName(), 'slab', args, corner, dim ), lambda: slabCutout ( corner, dim ) )
+    # each caller gets its own cube object around the shared data
+    yield ( zoffset, copy.copy ( cube ) )
+
+def slabIndex ( data, zoffset, zdim ):
+  """Return the shape of the full cutout and the index of a slab in it.  z is the third axis from the end."""
+
+  zaxis = data.ndim-3
+  shape = data.shape[:zaxis] + (zdim,) + data.shape[zaxis+1:]
+  return shape, (slice(None),)*zaxis + (slice(zoffset,zoffset+data.shape[zaxis]),)
+
+def streamArgs ( chanargs, proj ):
+  """Parse channel/service/imageargs for the services that read a cutout slab by slab"""
+
+  try:
+    # argument of format channel/service/imageargs
+    m = re.match("([\w+,]+)/(\w+)/([\w+,/-]+)$", chanargs)
+    [channels, service, imageargs] = [i for i in m.groups()]
+  except Exception, e:
+    logger.warning("Arguments not in the correct format {}. {}".format(chanargs, e))
+    raise OCPCAError("Arguments not in the correct format {}. {}".format(chanargs, e))
+
+  return channels.split(','), imageargs, cutoutArgs ( imageargs, proj )
+
+def streamFile ( fileobj ):
+  """Yield the contents of a file in chunks and close it"""
+
+  with closing ( fileobj ):
+    fileobj.seek(0)
+    for chunk in iter ( lambda: fileobj.read(STREAM_CHUNK_SIZE), '' ):
+      yield chunk
+
 def filterCube(ch, cube, filterlist=None):
   """Call Filter on a cube"""
 
@@ -94,46 +178,65 @@ def numpyZip ( chanargs, proj, db ):
   """Return a web readable Numpy Pickle zipped"""
 
   try:
-    # argument of format channel/service/imageargs
-    m = re.match("([\w+,]+)/(\w+)/([\w+,/-]+)$", chanargs)
-    [channels, service, imageargs] = [i for i in m.groups()]
-  except Exception, e:
-    logger.warning("Arguments not in the correct format {}. {}".format(chanargs, e))
-    raise OCPCAError("Arguments not in the correct format {}. {}".format(chanargs, e))
+    return ''.join ( numpyZipStream ( chanargs, proj, db ) )
+  except OCPCAError:
+    raise
+  except Exception,e:
+    raise OCPCAError("{}".format(e))
 
-  try: 
-    channel_list = channels.split(',')
-    ch = proj.getChannelObj(channel_list[0])
 
-    channel_data = cutout( imageargs, ch, proj, db ).data
-    cubedata = np.zeros ( (len(channel_list),)+channel_data.shape, dtype=channel_data.dtype )
-    cubedata[0,:] = channel_data
+def numpyZipStream ( chanargs, proj, db ):
+  """Stream a web readable Numpy Pickle zipped.  Each cuboid layer is compressed and sent as it is read."""
 
-    # if one channel convert 3-d to 4-d array
-    for idx,channel_name in enumerate(channel_list[1:]):
-      if channel_name == '0':
-        continue
-      else:
-        ch = proj.getChannelObj(channel_name)
-        if OCP_dtypetonp[ch.getDataType()] == cubedata.dtype:
-          cubedata[idx+1,:] = cutout(imageargs, ch, proj, db).data
-        else:
-          raise OCPCAError("The npz cutout can only contain cutouts of one single Channel Type.")
+  channel_list, imageargs, args = streamArgs ( chanargs, proj )
+  return numpyZipChunks ( numpyChannels ( channel_list, proj ), args, db )
 
-    
-    # Create the compressed cube
-    fileobj = cStringIO.StringIO ()
-    np.save ( fileobj, cubedata )
-    cdz = zlib.compress (fileobj.getvalue()) 
 
-    # Package the object as a Web readable file handle
-    fileobj = cStringIO.StringIO(cdz)
-    fileobj.seek(0)
-    return fileobj.read()
+def numpyChannels ( channel_list, proj ):
+  """The channels of an npz cutout.  None for the placeholder channel 0."""
 
-  except Exception,e:
-    raise OCPCAError("{}".format(e))
+  channels = []
+  for channel_name in channel_list:
+    # channel 0 is a placeholder of zeros
+    if channel_name == '0' and channels:
+      channels.append ( None )
+    else:
+      ch = proj.getChannelObj(channel_name)
+      if channels and OCP_dtypetonp[ch.getDataType()] != OCP_dtypetonp[channels[0].getDataType()]:
+        raise OCPCAError("The npz cutout can only contain cutouts of one single Channel Type.")
+      channels.append ( ch )
+
+  return channels
+
+
+def numpyZipChunks ( channels, args, db, slabs=cutoutSlabs ):
+  """Generator of the zipped npy file.  The array is in C order so each channel is a run of z slabs."""
 
+  zdim = args.getDim()[2]
+  compressor = zlib.compressobj()
+  chshape = None
+
+  for ch in channels:
+
+    if ch is None:
+      plane = np.zeros ( chshape[-2:], dtype=dtype ).tostring()
+      for i in range ( int(np.prod(chshape[:-2])) ):
+        yield compressor.compress ( plane )
+      continue
+
+    for zoffset, cube in slabs ( args, ch, db ):
+
+      # the npy header takes the shape and type of the first channel
+      if chshape is None:
+        chshape, slab = slabIndex ( cube.data, zoffset, zdim )
+        dtype = cube.data.dtype
+        fileobj = cStringIO.StringIO ()
+        np.lib.format.write_array_header_1_0 ( fileobj, { 'descr' : np.lib.format.dtype_to_descr(dtype), 'fortran_order' : False, 'shape' : (len(channels),)+chshape } )
+        yield compressor.compress ( fileobj.getvalue() )
+
+      yield compressor.compress ( cube.data.tostring() )
+
+  yield compressor.flush()
 
 def JPEG ( chanargs, proj, db ):
   """Return a web readable JPEG File"""
@@ -189,39 +292,34 @@ def JPEG ( chanargs, proj, db ):
 def BLOSC ( chanargs, proj, db ):
   """Return a web readable blosc file"""
 
-  try:
-    # argument of format channel/service/imageargs
-    m = re.match("([\w+,]+)/(\w+)/([\w+,/-]+)$", chanargs)
-    [channels, service, imageargs] = [i for i in m.groups()]
-  except Exception, e:
-    logger.warning("Arguments not in the correct format {}. {}".format(chanargs, e))
-    raise OCPCAError("Arguments not in the correct format {}. {}".format(chanargs, e))
+  channel_list, imageargs, args = streamArgs ( chanargs, proj )
 
   try: 
-    channel_list = channels.split(',')
-    ch = proj.getChannelObj(channel_list[0])
+    return bloscPack ( channel_list, proj, args, db )
+  except Exception,e:
+    raise OCPCAError("{}".format(e))
 
-    channel_data = cutout( imageargs, ch, proj, db ).data
-    cubedata = np.zeros ( (len(channel_list),)+channel_data.shape, dtype=channel_data.dtype )
-    cubedata[0,:] = channel_data
+def bloscPack ( channel_list, proj, args, db, slabs=cutoutSlabs ):
+  """Pack the cutouts of channels into one blosc array"""
 
-    # if one channel convert 3-d to 4-d array
-    for idx,channel_name in enumerate(channel_list[1:]):
-      if channel_name == '0':
-        continue
-      else:
-        ch = proj.getChannelObj(channel_name)
-        if OCP_dtypetonp[ch.getDataType()] == cubedata.dtype:
-          cubedata[idx+1,:] = cutout(imageargs, ch, proj, db).data
-        else:
-          raise OCPCAError("The npz cutout can only contain cutouts of one single Channel Type.")
+  # a blosc array is packed in one piece so fill the result one slab at a time
+  cubedata = None
+  for idx,channel_name in enumerate(channel_list):
+    if channel_name == '0' and idx > 0:
+      continue
 
-    
-    # Create the compressed cube
-    return blosc.pack_array(cubedata)
+    ch = proj.getChannelObj(channel_name)
+    if cubedata is not None and OCP_dtypetonp[ch.getDataType()] != cubedata.dtype:
+      raise OCPCAError("The npz cutout can only contain cutouts of one single Channel Type.")
 
-  except Exception,e:
-    raise OCPCAError("{}".format(e))
+    for zoffset, cube in slabs ( args, ch, db ):
+      shape, slab = slabIndex ( cube.data, zoffset, args.getDim()[2] )
+      if cubedata is None:
+        cubedata = np.zeros ( (len(channel_list),)+shape, dtype=cube.data.dtype )
+      cubedata[idx][slab] = cube.data
+  
+  # Create the compressed cube
+  return blosc.pack_array(cubedata)
 
 def binZip ( chanargs, proj, db ):
   """Return a web readable Numpy Pickle zipped"""
@@ -269,37 +367,53 @@ def binZip ( chanargs, proj, db ):
 def HDF5(chanargs, proj, db):
   """Return a web readable HDF5 file"""
 
-  # Create an in-memory HDF5 file
+  return ''.join ( HDF5Stream ( chanargs, proj, db ) )
+
+
+def HDF5Stream ( chanargs, proj, db ):
+  """Stream a web readable HDF5 file.  The cutout is written to a file on disk one slab at a time."""
+
+  channel_list, imageargs, args = streamArgs ( chanargs, proj )
+  channels = [ ( channel_name, proj.getChannelObj(channel_name) ) for channel_name in channel_list ]
+
+  return HDF5Chunks ( channels, args, db )
+
+
+def HDF5Chunks ( channels, args, db ):
+  """Generator of the HDF5 file"""
+
   tmpfile = tempfile.NamedTemporaryFile()
-  fh5out = h5py.File(tmpfile.name, driver='core', backing_store=True)
 
   try:
-    # argument of format channel/service/imageargs
-    m = re.match("([\w+,]+)/(\w+)/([\w+,/-]+)$", chanargs)
-    [channels, service, imageargs] = [i for i in m.groups()]
-  except Exception, e:
-    logger.warning("Arguments not in the correct format {}. {}".format(chanargs, e))
-    raise OCPCAError("Arguments not in the correct format {}. {}".format(chanargs, e))
+    HDF5Write ( channels, args, db, tmpfile.name )
+  except:
+    tmpfile.close()
+    raise
+
+  for chunk in streamFile ( tmpfile ):
+    yield chunk
+
+
+def HDF5Write ( channels, args, db, filename, slabs=cutoutSlabs ):
+  """Write the HDF5 file of a list of ( channel_name, ch ) one slab at a time"""
+
+  fh5out = h5py.File(filename, 'w')
 
   try: 
-    for channel_name in channels.split(','):
-      ch = proj.getChannelObj(channel_name)
-      cube = cutout(imageargs, ch, proj, db)
-      cube.RGBAChannel()
+    for channel_name, ch in channels:
       changrp = fh5out.create_group( "{}".format(channel_name) )
-      changrp.create_dataset("CUTOUT", tuple(cube.data.shape), cube.data.dtype, compression='gzip', data=cube.data)
+      cutoutds = None
+      for zoffset, cube in slabs ( args, ch, db ):
+        cube.RGBAChannel()
+        shape, slab = slabIndex ( cube.data, zoffset, args.getDim()[2] )
+        if cutoutds is None:
+          cutoutds = changrp.create_dataset("CUTOUT", shape, cube.data.dtype, compression='gzip')
+        cutoutds[slab] = cube.data
       changrp.create_dataset("CHANNELTYPE", (1,), dtype=h5py.special_dtype(vlen=str), data=ch.getChannelType())
       changrp.create_dataset("DATATYPE", (1,), dtype=h5py.special_dtype(vlen=str), data=ch.getDataType())
 
-  except:
+  finally:
     fh5out.close()
-    tmpfile.close()
-    raise
-
-  fh5out.close()
-  tmpfile.seek(0)
-  return tmpfile.read()
-
 
 def postTiff3d ( channel, postargs, proj, db, postdata ):
   """Upload a tiff to the database"""
@@ -369,7 +483,21 @@ def postTiff3d ( channel, postargs, proj, db, postdata ):
 def tiff3d ( chanargs, proj, db ):
   """Return a 3d tiff file"""
 
+  return ''.join ( tiff3dStream ( chanargs, proj, db ) )
+
+
+def tiff3dStream ( chanargs, proj, db ):
+  """Stream a 3d tiff file.  Slabs are appended to the file on disk as they are read."""
+
   [channels, service, imageargs] = chanargs.split('/', 2)
+  args = cutoutArgs ( imageargs, proj )
+  channels = [ proj.getChannelObj(channel_name) for channel_name in channels.split(',') ]
+
+  return tiff3dChunks ( channels, imageargs, args, db )
+
+
+def tiff3dChunks ( channels, imageargs, args, db ):
+  """Generator of the 3d tiff file"""
 
   # create a temporary tif file
   tmpfile = tempfile.NamedTemporaryFile()
@@ -377,11 +505,10 @@ def tiff3d ( chanargs, proj, db ):
 
   try: 
 
-    for channel_name in channels.split(','):
+    for ch in channels:
 
-      ch = proj.getChannelObj(channel_name)
-      cube = cutout ( imageargs, ch, proj, db )
-      FilterCube ( imageargs, cube )
+      for zoffset, cube in cutoutSlabs ( args, ch, db ):
+        FilterCube ( imageargs, cube )
 
 
 # RB -- I think this is a cutout format.  So, let's not recolor.
@@ -402,7 +529,8 @@ def tiff3d ( chanargs, proj, db ):
 #
 #      else:
 
-      tif.write_image(cube.data)
+        # each slice is a directory so slabs append to the file
+        tif.write_image(cube.data)
 
   except:
     tif.close()
@@ -410,8 +538,8 @@ def tiff3d ( chanargs, proj, db ):
     raise
 
   tif.close()
-  tmpfile.seek(0)
-  return tmpfile.read()
+  for chunk in streamFile ( tmpfile ):
+    yield chunk
  
 
 def FilterCube ( imageargs, cb ):
@@ -822,11 +950,66 @@ def getCutout ( webargs ):
   with closing ( ocpcaproj.OCPCAProjectsDB() ) as projdb:
     proj = projdb.loadToken ( token )
 
-  # and the database and then call the db function
+  # identical requests in flight share one cutout
+  return singleflight.do ( requestKey ( proj, channel, service, chanargs ), lambda: loadCutout ( proj, service, webargs ) )
+
+
+def loadCutout ( proj, service, webargs ):
+  """Load the database and run the service"""
+
   with closing ( ocpcadb.OCPCADB(proj) ) as db:
     return selectService ( service, webargs, proj, db )
 
 
+def selectStreamService ( service, webargs, proj, db ):
+  """Select a service that returns its response as an iterator of chunks"""
+
+  if service == 'hdf5':
+    return HDF5Stream ( webargs, proj, db )
+  elif service == 'tiff':
+    return tiff3dStream ( webargs, proj, db )
+  elif service == 'npz':
+    return numpyZipStream ( webargs, proj, db )
+  else:
+    logger.warning("An illegal Web GET streaming service was requested {}. Args {}".format(service, webargs))
+    raise OCPCAError("An illegal Web GET streaming service was requested {}. Args {}".format(service, webargs))
+
+
+def getCutoutStream ( webargs ):
+  """Interface to the cutout services that stream large volumes.  Arguments are checked before this returns
+     and the cutout is read one slab at a time as the response is sent."""
+
+  [token, webargs] = webargs.split('/', 1)
+  [channel, service, chanargs] = webargs.split('/', 2)
+
+  # get the project 
+  with closing ( ocpcaproj.OCPCAProjectsDB() ) as projdb:
+    proj = projdb.loadToken ( token )
+
+  # the database stays open until the response has been sent
+  db = ocpcadb.OCPCADB(proj)
+  try:
+    chunks = selectStreamService ( service, webargs, proj, db )
+  except:
+    db.close()
+    raise
+
+  return closeAfterStream ( chunks, db )
+
+
+def closeAfterStream ( chunks, db ):
+  """Yield the chunks of a streamed response and then close the database"""
+
+  with closing ( db ):
+    try:
+      for chunk in chunks:
+        yield chunk
+    except Exception, e:
+      # the response has started so all we can do is log
+      logger.exception("Streamed cutout failed. {}".format(e))
+      raise
+
+
 def putCutout ( webargs, postdata ):
   """Interface to the write cutout data. Load the annotation project and invoke the appropriate dataset"""
 
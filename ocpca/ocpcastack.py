@@ -143,14 +143,16 @@ def buildAnnoStack ( proj, ch, res=None ):
       for mortonidx in range(0, lastzindex, 64): 
 
         # call the range query
-        cuboids = db.getCubes(ch, range(mortonidx,mortonidx+64), cur_res-1)
+        cuboids = list ( db.getCubes(ch, range(mortonidx,mortonidx+64), cur_res-1) )
         cube = Cube.getCube(cubedim, ch.getChannelType(), ch.getDataType())
 
+        # decode the locations of the whole batch at once
+        xyzs = ocplib.MortonXYZBatch ( [ idx for idx, datastring in cuboids ] ).tolist()
+
         # get the first cube
-        for idx, datastring in cuboids:
+        for (idx, datastring), xyz in zip ( cuboids, xyzs ):
 
-          xyz = ocplib.MortonXYZ(idx)
-          cube.fromNPZ(datastring)
+          cube.fromCodec(datastring, db.NPZ)
 
           if scaling == ZSLICES:
 
@@ -223,6 +225,9 @@ def buildImageStack(proj, ch, res=None):
       ylimit = (yimagesz-1) / ycubedim + 1
       zlimit = (zimagesz-1) / zcubedim + 1
 
+      # morton indexes of all the cuboids in z,y,x order
+      zidxs = ocplib.XYZMortonBatch ( ocplib.XYZBox ( [0,0,0], [xlimit,ylimit,zlimit] ) ).tolist()
+
       # Iterating over time
       for ts in range(timerange[0], timerange[1]+1, 1):
         # Iterating over zslice
@@ -271,7 +276,7 @@ def buildImageStack(proj, ch, res=None):
                   tempdata = np.asarray(slimage.resize([xcubedim, ycubedim]))
                   newdata[sl,:,:] = np.left_shift(tempdata[:,:,3], 24, dtype=np.uint32) | np.left_shift(tempdata[:,:,2], 16, dtype=np.uint32) | np.left_shift(tempdata[:,:,1], 8, dtype=np.uint32) | np.uint32(tempdata[:,:,0])
 
-              zidx = ocplib.XYZMorton ([x,y,z])
+              zidx = zidxs[(z*ylimit+y)*xlimit+x]
               cube = Cube.getCube(cubedim, ch.getChannelType(), ch.getDataType())
               cube.zeros()
 
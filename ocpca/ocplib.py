@@ -50,6 +50,9 @@ ocplib.locateCube.argtypes = [ array_2d_uint64, cp.c_int, array_2d_uint32, cp.c_
 ocplib.annotateCube.argtypes = [ array_1d_uint32, cp.c_int, cp.POINTER(cp.c_int), cp.c_int, array_1d_uint32, array_2d_uint32, cp.c_int, cp.c_char, array_2d_uint32 ]
 ocplib.XYZMorton.argtypes = [ array_1d_uint64 ]
 ocplib.MortonXYZ.argtypes = [ npct.ctypes.c_int64 , array_1d_uint64 ]
+ocplib.XYZMortonBatch.argtypes = [ array_2d_uint32, array_1d_uint64, cp.c_int ]
+ocplib.MortonXYZBatch.argtypes = [ array_1d_uint64, array_2d_uint32, cp.c_int ]
+ocplib.MortonRanges.argtypes = [ array_1d_uint64, array_1d_uint64, npct.ctypes.c_uint64, array_2d_uint64, cp.c_int ]
 ocplib.recolorCubeOMP.argtypes = [ array_2d_uint32, cp.c_int, cp.c_int, array_2d_uint32, array_1d_uint32 ]
 ocplib.quicksort.argtypes = [ array_2d_uint64, cp.c_int ]
 ocplib.shaveCube.argtypes = [ array_1d_uint32, cp.c_int, cp.POINTER(cp.c_int), cp.c_int, array_1d_uint32, array_2d_uint32, cp.c_int, array_2d_uint32, cp.c_int, array_2d_uint32 ]
@@ -80,6 +83,9 @@ ocplib.locateCube.restype = None
 ocplib.annotateCube.restype = cp.c_int
 ocplib.XYZMorton.restype = npct.ctypes.c_uint64
 ocplib.MortonXYZ.restype = None
+ocplib.XYZMortonBatch.restype = None
+ocplib.MortonXYZBatch.restype = None
+ocplib.MortonRanges.restype = cp.c_int
 ocplib.recolorCubeOMP.restype = None
 ocplib.quicksort.restype = None
 ocplib.shaveCube.restype = None
@@ -183,6 +189,119 @@ def MortonXYZ ( morton ):
   cubeoff = np.uint32(cubeoff)
   return [i for i in cubeoff]
 
+def XYZMortonBatch ( xyz ):
+  """ Get the morton order of each row of an (N,3) array of XYZ coordinates """
+
+  xyz = np.ascontiguousarray ( np.asarray(xyz, dtype=np.uint32).reshape(-1,3) )
+  morton = np.zeros ( len(xyz), dtype=np.uint64 )
+
+  # Calling the C native function
+  ocplib.XYZMortonBatch ( xyz, morton, cp.c_int(len(xyz)) )
+
+  return morton
+
+def MortonXYZBatch ( morton ):
+  """ Get the XYZ coordinates of an array of morton indexes as an (N,3) array """
+
+  morton = np.ascontiguousarray ( np.asarray(morton, dtype=np.uint64).reshape(-1) )
+  xyz = np.zeros ( (len(morton),3), dtype=np.uint32 )
+
+  # Calling the C native function
+  ocplib.MortonXYZBatch ( morton, xyz, cp.c_int(len(morton)) )
+
+  return xyz
+
+def XYZBox ( start, numcubes ):
+  """ XYZ coordinates of the box of cuboids at start in z,y,x loop order (x varies fastest) """
+
+  [ xstart, ystart, zstart ] = start
+  [ xnumcubes, ynumcubes, znumcubes ] = numcubes
+
+  zyx = np.mgrid[zstart:zstart+znumcubes, ystart:ystart+ynumcubes, xstart:xstart+xnumcubes].reshape(3,-1)
+  return np.ascontiguousarray ( zyx[::-1].T, dtype=np.uint32 )
+
+def MortonRanges ( lo, hi, maxgap=0 ):
+  """ Get the Morton index ranges [start,end] that cover the box of cuboids [lo,hi).
+      Ranges with gaps of at most maxgap are merged. """
+
+  lo = np.asarray ( lo, dtype=np.uint64 )
+  hi = np.asarray ( hi, dtype=np.uint64 )
+
+  # there are never more ranges than cuboids
+  maxranges = int ( np.prod ( hi-lo ) )
+  ranges = np.zeros ( (maxranges,2), dtype=np.uint64 )
+
+  # Calling the C native function
+  nranges = ocplib.MortonRanges ( lo, hi, npct.ctypes.c_uint64(maxgap), ranges, cp.c_int(maxranges) )
+
+  return ranges[:nranges]
+
+def IndexRanges ( listofidxs, maxgap=0 ):
+  """ Collapse a list of Morton indexes into ranges [start,end].
+      Ranges with gaps of at most maxgap are merged. """
+
+  idxs = np.unique ( np.asarray ( listofidxs, dtype=np.uint64 ) )
+  if len(idxs) == 0:
+    return np.zeros ( (0,2), dtype=np.uint64 )
+
+  # a range ends wherever the next index is more than maxgap away
+  breaks = np.nonzero ( np.diff(idxs) > maxgap+1 )[0]
+  starts = np.concatenate ( ( idxs[:1], idxs[breaks+1] ) )
+  ends = np.concatenate ( ( idxs[breaks], idxs[-1:] ) )
+
+  return np.column_stack ( ( starts, ends ) )
+
+def CuboidIds ( data, cubedim ):
+  """ The cuboids of each nonzero id in a zyx volume of whole cuboids in one pass.
+      Returns a list of ( id, array of cuboid numbers in z,y,x order ). """
+
+  [ xcubedim, ycubedim, zcubedim ] = cubedim
+  ynumcubes = data.shape[1] / ycubedim
+  xnumcubes = data.shape[2] / xcubedim
+
+  # a layer of cuboids at a time bounds the memory of the voxel arrays
+  pairs = []
+  for z in range ( data.shape[0] / zcubedim ):
+    layer = data[z*zcubedim:(z+1)*zcubedim]
+    voxels = np.flatnonzero ( layer )
+    if len(voxels) == 0:
+      continue
+    ids = layer.ravel()[voxels].astype(np.uint64)
+    ( zs, ys, xs ) = np.unravel_index ( voxels, layer.shape )
+    cubenos = ( z*ynumcubes + ys/ycubedim ) * xnumcubes + xs/xcubedim
+    # one key per ( id, cuboid ) pair sorts by id then cuboid
+    pairs.append ( np.unique ( ( ids << np.uint64(32) ) | cubenos.astype(np.uint64) ) )
+
+  if len(pairs) == 0:
+    return []
+
+  pairs = np.unique ( np.concatenate ( pairs ) )
+  ids = pairs >> np.uint64(32)
+  cubenos = ( pairs & np.uint64(0xFFFFFFFF) ).astype(np.int64)
+
+  bounds = np.flatnonzero ( np.diff(ids) ) + 1
+  return [ ( np.uint32(ids[start]), cubenos[start:end] ) for start, end in zip ( np.r_[0, bounds], np.r_[bounds, len(ids)] ) ]
+
+def VoxelGroups ( data ):
+  """ The nonzero voxels of a zyx cube grouped by id in one pass.
+      Returns a list of ( id, (N,3) array of xyz offsets ) in id order. """
+
+  voxels = np.flatnonzero ( data )
+  if len(voxels) == 0:
+    return []
+
+  ids = data.ravel()[voxels]
+  # a stable sort keeps each id's voxels in zyx order
+  order = np.argsort ( ids, kind='mergesort' )
+  voxels = voxels[order]
+  ids = ids[order]
+
+  ( zs, ys, xs ) = np.unravel_index ( voxels, data.shape )
+  xyz = np.column_stack ( ( xs, ys, zs ) ).astype(np.uint32)
+
+  bounds = np.flatnonzero ( np.diff(ids) ) + 1
+  return [ ( ids[start], xyz[start:end] ) for start, end in zip ( np.r_[0, bounds], np.r_[bounds, len(ids)] ) ]
+
 def recolor_ctype ( cutout, imagemap ):
   """ Annotation recoloring function """
   
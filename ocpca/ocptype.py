@@ -26,7 +26,9 @@ UINT64 = 'uint64'
 FLOAT32 = 'float32'
 MYSQL = 'MySQL'
 CASSANDRA = 'Cassandra'
-RIAK = 'riak'
+RIAK = 'Riak'
+FILE = 'File'
+AEROSPIKE = 'Aerospike'
 
 # OCP Version
 OCP_VERSION = '0.7'
@@ -67,6 +69,13 @@ ISOTROPIC = 1
 EXCEPTION_TRUE = 1
 EXCEPTION_FALSE = 0
 
+# Cuboid codecs.  The default is the key/value engine's legacy format.
+CODEC_DEFAULT = ''
+CODEC_ZLIB = 'zlib'
+CODEC_BLOSC = 'blosc'
+CODEC_LZ4 = 'lz4'
+CODEC_ZSTD = 'zstd'
+
 # Public Values
 PUBLIC_TRUE = 1
 PUBLIC_FALSE = 0
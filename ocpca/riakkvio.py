@@ -13,18 +13,15 @@
 # limitations under the License.
 
 import numpy as np
-import cStringIO
-import zlib
-import MySQLdb
-import re
-from collections import defaultdict
-import itertools
-import tempfile
-import h5py
 import riak
 
-"""Helpers function to do cube I/O in across multiple DBs.
-    This file is aerospike
+import kvpool
+
+import logging
+logger=logging.getLogger("ocp")
+
+"""Helpers function to do cube I/O in Riak.
+    Each project is a bucket and keys are prefixed with the channel name.
     This uses the state and methods of ocpcadb"""
 
 class RiakKVIO:
@@ -34,9 +31,9 @@ class RiakKVIO:
 
     self.db = db
 
-    # connect to cassandra
-    self.rcli = riak.RiakClient(host=db.annoproj.getKVServer(), pb_port=8087, protocol='pbc')
-    self.bucket = self.rcli.bucket_type("ocp{}".format(db.annoproj.getDBType())).bucket(db.annoproj.getDBName())
+    # connect to riak
+    self.rcli = riak.RiakClient(host=db.proj.getKVServer(), pb_port=8087, protocol='pbc')
+    self.bucket = self.rcli.bucket(db.proj.getDBName())
 
   def close ( self ):
     """Close the connection"""
@@ -56,97 +53,134 @@ class RiakKVIO:
     pass
     
 
-  def getCube ( self, zidx, resolution, update ):
+  def cubeKey ( self, ch, zidx, resolution, neariso=False ):
+    """Key of a cuboid"""
+    return "{}:{}:{}:{}".format(ch.getChannelName(), "neariso" if neariso else "cuboid", resolution, int(zidx))
+
+  def timeCubeKey ( self, ch, zidx, timestamp, resolution ):
+    """Key of a cuboid at a timestamp"""
+    return "{}:timecuboid:{}:{}:{}".format(ch.getChannelName(), resolution, int(zidx), int(timestamp))
+
+  def indexKey ( self, ch, annid, resolution ):
+    """Key of an annotation index"""
+    return "{}:idx:{}:{}".format(ch.getChannelName(), resolution, annid)
+
+  def exceptionsKey ( self, ch, zidx, resolution, annid ):
+    """Key of the exceptions of an annotation in a cuboid"""
+    return "{}:excs:{}:{}:{}".format(ch.getChannelName(), resolution, int(zidx), annid)
+
+  def _get ( self, key ):
+    """Value of a key or None.  riak returns an object with None in the data fields if its not there"""
+    return self.bucket.get ( key ).encoded_data
+
+  def _multiget ( self, keys ):
+    """Values of a list of keys in the same order.  The client fetches them in parallel."""
+
+    values = {}
+    for robj in self.bucket.multiget ( keys ):
+      # failed fetches come back as ( type, bucket, key, exception )
+      if isinstance ( robj, tuple ):
+        raise robj[3]
+      values[robj.key] = robj.encoded_data
+    return [ values.get(key) for key in keys ]
+
+  def _put ( self, key, value ):
+    """Store a value"""
+    self.bucket.new ( key=key, encoded_data=value ).store()
+
+  def _multiput ( self, items ):
+    """Store a list of ( key, value ) in parallel"""
+    kvpool.parallelMap ( lambda item: self._put ( item[0], item[1] ), items )
+
+
+  def getCube ( self, ch, zidx, resolution, update=False ):
     """Retrieve a cube from the database by token, resolution, and zidx"""
+    return self._get ( self.cubeKey ( ch, zidx, resolution ) )
+
+  def getTimeCube ( self, ch, zidx, timestamp, resolution, update=False ):
+    """Retrieve a cube by resolution, timestamp and zidx"""
+    return self._get ( self.timeCubeKey ( ch, zidx, timestamp, resolution ) )
 
-    try:
-      # riak returns an object with None in the data fields if its not there
-      robj = self.bucket.get( "cuboid:{}:{}".format(resolution,zidx) )
-      return robj.encoded_data 
-    except Exception, e:
-      raise
+  def getCubes ( self, ch, listofidxs, resolution, neariso=False, update=False ):
+    """Retrieve a list of cubes with one parallel multiget"""
 
+    listofidxs = [ int(zidx) for zidx in listofidxs ]
+    values = self._multiget ( [ self.cubeKey ( ch, zidx, resolution, neariso ) for zidx in listofidxs ] )
+    for zidx, value in zip ( listofidxs, values ):
+      if value is not None:
+        yield ( zidx, value )
 
-  def getCubes ( self, listofidxs, resolution ):
+  def getCubeRanges ( self, ch, ranges, resolution, neariso=False ):
+    """Retrieve the cubes in a list of inclusive [start,end] zindex ranges"""
 
-    rkeys = [ "cuboid:{}:{}".format(resolution,l) for l in listofidxs ]
+    listofidxs = [ zidx for ( start, end ) in np.asarray(ranges, dtype=np.uint64).tolist() for zidx in xrange(start, end+1) ]
+    return self.getCubes ( ch, listofidxs, resolution, neariso )
 
-    try:
-      robjs = self.bucket.multiget(rkeys)
+  def getTimeCubes ( self, ch, idx, listoftimestamps, resolution ):
+    """Retrieve the cubes at zidx for a list of timestamps"""
 
-      for r in robjs:
-        yield re.match( "cuboid:[\d+]:(.*)", r.key).group(1), r.encoded_data
+    listoftimestamps = list ( listoftimestamps )
+    values = self._multiget ( [ self.timeCubeKey ( ch, idx, timestamp, resolution ) for timestamp in listoftimestamps ] )
+    for timestamp, value in zip ( listoftimestamps, values ):
+      if value is not None:
+        yield ( idx, timestamp, value )
 
-    except Exception, e:
-      raise
+  def putCubes ( self, ch, listofidxs, resolution, listofcubes, update=False ):
+    """Store multiple cubes in parallel"""
+    self._multiput ( [ ( self.cubeKey ( ch, zidx, resolution ), cubestr ) for zidx, cubestr in zip ( listofidxs, listofcubes ) ] )
 
-  #
-  # putCube
-  #
-  def putCube ( self, zidx, resolution, cubestr, udpate ):
+  def putCube ( self, ch, zidx, resolution, cubestr, update=False ):
     """Store a cube from the annotation database"""
+    self._put ( self.cubeKey ( ch, zidx, resolution ), cubestr )
 
-    try:
-      robj = self.bucket.new( key="cuboid:{}:{}".format(resolution,zidx), encoded_data=cubestr )
-      robj.store()
-    except Exception, e:
-      raise
+  def putTimeCube ( self, ch, zidx, timestamp, resolution, cubestr, update=False ):
+    """Store a cube at a timestamp"""
+    self._put ( self.timeCubeKey ( ch, zidx, timestamp, resolution ), cubestr )
 
 
-  def getIndex ( self, annid, resolution, update ):
+  def getIndex ( self, ch, annid, resolution, update=False ):
     """Fetch index routine.  Update is irrelevant for KV clients"""
 
-    try:
-      robj = self.bucket.get( "idx:{}:{}".format(resolution,annid) )
-      return robj.encoded_data 
-    except Exception, e:
-      raise
+    indexstr = self._get ( self.indexKey ( ch, annid, resolution ) )
+    # If we can't find a index, they don't exist
+    if indexstr is None:
+      return []
+    return indexstr
 
+  def putIndex ( self, ch, annid, resolution, indexstr, update=False ):
+    """Riak put index routine"""
+    self._put ( self.indexKey ( ch, annid, resolution ), indexstr )
 
-  def putIndex ( self, annid, resolution, indexstr, update ):
-    """MySQL put index routine"""
+  def deleteIndex ( self, ch, annid, resolution ):
+    """Riak delete index routine"""
+    self.bucket.delete ( self.indexKey ( ch, annid, resolution ) )
 
-    try:
-      robj = self.bucket.new( key="idx:{}:{}".format(resolution,annid), encoded_data=indexstr )
-      robj.store()
-    except Exception, e:
-      raise
-    
+  def getIndexes ( self, ch, listofannids, resolution, update=False ):
+    """Fetch the indexes of a list of annotations in order with one multiget.  None for missing indexes."""
+    return self._multiget ( [ self.indexKey ( ch, annid, resolution ) for annid in listofannids ] )
 
-  def deleteIndex ( self, annid, resolution ):
-    """MySQL update index routine"""
+  def putIndexes ( self, ch, resolution, listofindexes ):
+    """Store the indexes of a list of ( annid, indexstr ) in parallel"""
+    self._multiput ( [ ( self.indexKey ( ch, annid, resolution ), indexstr ) for annid, indexstr in listofindexes ] )
 
-    try:
-      self.bucket.delete( "idx:{}:{}".format(resolution,annid) )
-    except Exception, e:
-      raise
+  def deleteIndexes ( self, ch, resolution, listofannids ):
+    """Delete the indexes of a list of annotations in parallel"""
+    kvpool.parallelMap ( lambda annid: self.bucket.delete ( self.indexKey ( ch, annid, resolution ) ), listofannids )
 
 
-  def getExceptions ( self, zidx, resolution, annid ):
+  def getExceptions ( self, ch, zidx, resolution, annid ):
     """Retrieve exceptions from the database by token, resolution, and zidx"""
 
-    try:
-      robj = self.bucket.get( "excs:{}:{}:{}".format(resolution,zidx,annid) )
-      return robj.encoded_data
-    except Exception, e:
-      raise
-
+    excstr = self._get ( self.exceptionsKey ( ch, zidx, resolution, annid ) )
+    # If we can't find a list of exceptions, they don't exist
+    if excstr is None:
+      return []
+    return excstr
 
-  def putExceptions ( self, zidx, resolution, annid, excstr, update=False ):
+  def putExceptions ( self, ch, zidx, resolution, annid, excstr, update=False ):
     """Store exceptions in the annotation database"""
+    self._put ( self.exceptionsKey ( ch, zidx, resolution, annid ), excstr )
 
-    try:
-      robj = self.bucket.new( key="excs:{}:{}:{}".format(resolution,zidx,annid), encoded_data=excstr )
-      robj.store()
-    except Exception, e:
-      raise
-
-
-  def deleteExceptions ( self, zidx, resolution, annid ):
+  def deleteExceptions ( self, ch, zidx, resolution, annid ):
     """Delete a list of exceptions for this cuboid"""
-
-    try:
-      self.bucket.delete( "excs:{}:{}:{}".format(resolution,zidx,annid) )
-    except Exception, e:
-      raise
-
+    self.bucket.delete ( self.exceptionsKey ( ch, zidx, resolution, annid ) )
@@ -0,0 +1,258 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import fcntl
+import hashlib
+import threading
+import numpy as np
+
+from django.conf import settings
+
+import logging
+logger=logging.getLogger("ocp")
+
+"""
+  Cuboid cache shared by all processes on a host.
+
+  The arena is a memory mapped file (in /dev/shm by default) laid out as
+    an arena header, a table of slot headers and fixed size data slots.
+  The number of slots and their size are part of the file name so that
+    processes configured with a different layout map a different arena.
+  Slots are grouped into sets of WAYS.  A key hashes to one set and
+    the least recently used slot in the set is evicted.
+
+  Lookups return a view into the arena.  Every write to a slot bumps
+    its sequence number so a reader copies out of the view and then
+    calls validate to make sure the slot was not reused underneath it.
+
+  Keys also hash to one of EPOCHS invalidation epochs in a file of their
+    own that every layout shares.  A writer bumps the epoch of a key before
+    it drops the key.  A reader takes the epoch before it reads a cuboid
+    from the kvio and put refuses the cuboid if the epoch has moved, so
+    data read before a write committed is never cached after it.
+"""
+
+MAGIC = 0x4f4350435542453a
+WAYS = 8
+EPOCHS = 65536
+
+ARENA_DTYPE = np.dtype ( [ ('magic', np.uint64), ('nslots', np.uint64), ('slotbytes', np.uint64), ('clock', np.uint64) ] )
+SLOT_DTYPE = np.dtype ( [ ('key0', np.uint64), ('key1', np.uint64), ('seq', np.uint64), ('lastuse', np.uint64), ('nbytes', np.uint64), ('shape', np.uint32, (3,)), ('dtype', 'S4'), ('valid', np.uint32) ] )
+
+# the data slots start on a page boundary
+PAGESIZE = 4096
+
+
+class HostLock:
+  """Lock held by one thread of one process on the host.  flock excludes other processes and the mutex excludes other threads."""
+
+  def __init__ ( self, path ):
+    self._lock = threading.Lock()
+    self.fd = os.open ( path, os.O_RDWR | os.O_CREAT, 0600 )
+
+  def __enter__ ( self ):
+    self._lock.acquire()
+    try:
+      fcntl.flock ( self.fd, fcntl.LOCK_EX )
+    except:
+      self._lock.release()
+      raise
+
+  def __exit__ ( self, exc_type, exc_value, traceback ):
+    fcntl.flock ( self.fd, fcntl.LOCK_UN )
+    self._lock.release()
+
+
+def digest ( key ):
+  """128 bit hash of the key as two integers"""
+  md5 = hashlib.md5 ( repr(key) ).digest()
+  return np.frombuffer ( md5, dtype=np.uint64 )
+
+
+class EpochTable:
+
+  def __init__ ( self, path ):
+    """Map the epochs at path"""
+
+    self.path = path
+    self.lock = HostLock ( path )
+    with self.lock:
+      if os.fstat(self.lock.fd).st_size < EPOCHS*8:
+        os.ftruncate ( self.lock.fd, EPOCHS*8 )
+      self.epochs = np.memmap ( path, dtype=np.uint64, mode='r+', shape=(EPOCHS,) )
+
+  def epoch ( self, key ):
+    """Current epoch of the key"""
+    # an aligned 64 bit load doesn't need the lock
+    return int ( self.epochs[int ( digest(key)[0] % EPOCHS )] )
+
+  def bump ( self, key ):
+    """Move the epoch of a key that is being written"""
+
+    index = int ( digest(key)[0] % EPOCHS )
+    with self.lock:
+      self.epochs[index] += 1
+
+
+class SharedCuboidCache:
+
+  def __init__ ( self, path, maxbytes, slotbytes, epochs ):
+    """Map the arena for this layout at path.  Initialize it if it is new."""
+
+    self.epochs = epochs
+    self.slotbytes = slotbytes
+    self.nsets = max ( 1, maxbytes / ( slotbytes * WAYS ) )
+    self.nslots = self.nsets * WAYS
+    self.path = path = '{}.{}x{}'.format ( path, self.nslots, self.slotbytes )
+
+    self.slotoffset = PAGESIZE
+    self.dataoffset = ( ( self.slotoffset + self.nslots*SLOT_DTYPE.itemsize + PAGESIZE-1 ) / PAGESIZE ) * PAGESIZE
+    self.size = self.dataoffset + self.nslots*self.slotbytes
+
+    self.lock = HostLock ( path )
+
+    with self.lock:
+      if os.fstat(self.lock.fd).st_size < self.size:
+        os.ftruncate ( self.lock.fd, self.size )
+
+      self.arena = np.memmap ( path, dtype=np.uint8, mode='r+', shape=(self.size,) )
+      self.header = self.arena[0:ARENA_DTYPE.itemsize].view(ARENA_DTYPE)[0:1]
+      self.slots = self.arena[self.slotoffset:self.slotoffset+self.nslots*SLOT_DTYPE.itemsize].view(SLOT_DTYPE)
+
+      if self.header['magic'][0] != MAGIC or self.header['nslots'][0] != self.nslots or self.header['slotbytes'][0] != self.slotbytes:
+        logger.info ( "Initializing shared cuboid cache {} with {} slots of {} bytes".format(path, self.nslots, self.slotbytes) )
+        self.slots[:] = np.zeros ( self.nslots, dtype=SLOT_DTYPE )
+        self.header['nslots'] = self.nslots
+        self.header['slotbytes'] = self.slotbytes
+        self.header['clock'] = 0
+        self.header['magic'] = MAGIC
+
+  def _find ( self, key0, key1 ):
+    """Index of the valid slot holding the key or None.  Call with the lock held."""
+
+    first = int ( key0 % self.nsets ) * WAYS
+    for slot in range ( first, first+WAYS ):
+      if self.slots['valid'][slot] and self.slots['key0'][slot] == key0 and self.slots['key1'][slot] == key1:
+        return slot
+    return None
+
+  def _touch ( self, slot ):
+    """Mark the slot as most recently used.  Call with the lock held."""
+    self.header['clock'] += 1
+    self.slots['lastuse'][slot] = self.header['clock'][0]
+
+  def _view ( self, slot ):
+    """Array view of the data in a slot"""
+
+    offset = self.dataoffset + slot*self.slotbytes
+    dtype = np.dtype ( self.slots['dtype'][slot] )
+    shape = tuple ( self.slots['shape'][slot] )
+    nbytes = int ( self.slots['nbytes'][slot] )
+    data = np.asarray ( self.arena[offset:offset+nbytes] ).view(dtype).reshape(shape)
+    data.flags.writeable = False
+    return data
+
+  def lookup ( self, key ):
+    """Return ( slot, seq, view ) for the key or None"""
+
+    key0, key1 = digest ( key )
+    with self.lock:
+      slot = self._find ( key0, key1 )
+      if slot is None:
+        return None
+      self._touch ( slot )
+      return ( slot, self.slots['seq'][slot], self._view(slot) )
+
+  def validate ( self, slot, seq ):
+    """True if the slot has not been written since the lookup returned seq"""
+    return self.slots['seq'][slot] == seq
+
+  def put ( self, key, data, epoch ):
+    """Copy an array read at epoch into the cache, evicting the least recently used slot in its set.
+       Nothing is cached if the key was written since epoch."""
+
+    if data.nbytes > self.slotbytes or len(data.shape) != 3:
+      return
+
+    key0, key1 = digest ( key )
+    with self.lock:
+      # invalidate bumps the epoch before it takes the lock to drop the slot
+      if self.epochs.epoch ( key ) != epoch:
+        return
+
+      slot = self._find ( key0, key1 )
+      if slot is None:
+        first = int ( key0 % self.nsets ) * WAYS
+        ways = self.slots[first:first+WAYS]
+        # prefer an empty slot otherwise evict the oldest
+        slot = first + int ( np.argmin ( np.where ( ways['valid'], ways['lastuse'], 0 ) ) )
+
+      # readers of the old contents will fail to validate
+      self.slots['valid'][slot] = 0
+      self.slots['seq'][slot] += 1
+
+      offset = self.dataoffset + slot*self.slotbytes
+      self.arena[offset:offset+data.nbytes].view(data.dtype).reshape(data.shape)[:] = data
+
+      self.slots['key0'][slot] = key0
+      self.slots['key1'][slot] = key1
+      self.slots['nbytes'][slot] = data.nbytes
+      self.slots['shape'][slot] = data.shape
+      self.slots['dtype'][slot] = data.dtype.str
+      self._touch ( slot )
+      self.slots['valid'][slot] = 1
+
+  def invalidate ( self, key ):
+    """Drop a cuboid that has been written.  Readers that took the epoch before can't cache it again."""
+
+    self.epochs.bump ( key )
+
+    key0, key1 = digest ( key )
+    with self.lock:
+      slot = self._find ( key0, key1 )
+      if slot is not None:
+        self.slots['valid'][slot] = 0
+        self.slots['seq'][slot] += 1
+
+
+_epochs = None
+_shmcache = None
+_shmcache_lock = threading.Lock()
+
+def getEpochTable ():
+  """Return this process' mapping of the invalidation epochs"""
+
+  global _epochs
+  with _shmcache_lock:
+    if _epochs is None:
+      path = getattr ( settings, 'SHM_CUBE_CACHE_PATH', '/dev/shm/ocpcubecache' )
+      _epochs = EpochTable ( path + '.epochs' )
+  return _epochs
+
+def getShmCache ():
+  """Return this process' mapping of the shared cache or None if SHM_CUBE_CACHE_BYTES is not set"""
+
+  global _shmcache
+  maxbytes = getattr ( settings, 'SHM_CUBE_CACHE_BYTES', 0 )
+  if not maxbytes:
+    return None
+
+  epochs = getEpochTable()
+  with _shmcache_lock:
+    if _shmcache is None:
+      path = getattr ( settings, 'SHM_CUBE_CACHE_PATH', '/dev/shm/ocpcubecache' )
+      slotbytes = getattr ( settings, 'SHM_CUBE_CACHE_SLOTBYTES', 128*128*16*4 )
+      _shmcache = SharedCuboidCache ( path, maxbytes, slotbytes, epochs )
+  return _shmcache
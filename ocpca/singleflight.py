@@ -0,0 +1,163 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import hashlib
+import threading
+
+from django.conf import settings
+
+try:
+  import pylibmc
+except ImportError:
+  pylibmc = None
+
+import logging
+logger=logging.getLogger("ocp")
+
+"""
+  Coalesce concurrent identical requests.
+
+  The first caller with a key runs the function and the callers that
+    arrive while it runs wait and get the same result or exception.
+    Callers that arrive after it finishes run the function again so
+    no result outlives its request.  A caller can still join a flight
+    that started before its own write committed and read the old data,
+    so SINGLEFLIGHT is off unless clients can live with that.
+
+  With SINGLEFLIGHT_SHARED, processes also coalesce through memcache,
+    the tile cache's unless the caller passes its own client.  The leader
+    holds a lock added to memcache with a flight id and stores the result
+    under that id for SINGLEFLIGHT_RESULT_SECONDS.  Other processes poll
+    for it and run the function themselves if the lock goes away without
+    a result, e.g. results too large for memcache.
+"""
+
+# memcache keys are limited to 250 bytes without spaces
+KEYPREFIX = 'singleflight/'
+
+
+class Flight:
+  """One running call"""
+
+  def __init__ ( self ):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+# memcache clients are not thread safe so each thread has its own
+_clients = threading.local()
+
+def sharedClient ():
+  """This thread's client of the SINGLEFLIGHT_MEMCACHE servers"""
+
+  if pylibmc is None:
+    return None
+  mc = getattr ( _clients, 'mc', None )
+  if mc is None:
+    mc = _clients.mc = pylibmc.Client ( getattr ( settings, 'SINGLEFLIGHT_MEMCACHE', ["127.0.0.1"] ), binary=True, behaviors={"tcp_nodelay":True, "ketama":True} )
+  return mc
+
+
+def do ( key, func, mc=None ):
+  """Return func() shared with concurrent callers of the same key"""
+
+  if not getattr ( settings, 'SINGLEFLIGHT', False ):
+    return func()
+
+  with _flights_lock:
+    flight = _flights.get ( key )
+    leader = flight is None
+    if leader:
+      flight = _flights[key] = Flight()
+
+  if not leader:
+    if flight.done.wait ( getattr ( settings, 'SINGLEFLIGHT_WAIT', 60 ) ):
+      if flight.error is not None:
+        raise flight.error
+      return flight.result
+    # the leader is stuck so don't wait for it
+    logger.warning ( "Timed out waiting for a coalesced request {}".format(key) )
+    return func()
+
+  try:
+    # a client passed in is only used when flights are shared between processes
+    mc = ( mc or sharedClient() ) if getattr ( settings, 'SINGLEFLIGHT_SHARED', False ) else None
+    if mc is None:
+      flight.result = func()
+    else:
+      flight.result = _doShared ( key, func, mc )
+  except Exception, e:
+    flight.error = e
+    raise
+  finally:
+    with _flights_lock:
+      del _flights[key]
+    flight.done.set()
+
+  return flight.result
+
+
+def _doShared ( key, func, mc ):
+  """Coalesce with other processes through memcache"""
+
+  digest = hashlib.sha1 ( key ).hexdigest()
+  lockkey = KEYPREFIX + 'lock/' + digest
+  flightid = os.urandom(8).encode('hex')
+
+  try:
+    leader = mc.add ( lockkey, flightid, time=getattr ( settings, 'SINGLEFLIGHT_LOCK_SECONDS', 60 ) )
+  except Exception, e:
+    logger.warning ( "Failed to lock coalesced request in memcache. {}".format(e) )
+    return func()
+
+  if leader:
+    try:
+      result = func()
+      try:
+        mc.set ( KEYPREFIX + 'result/' + flightid, result, time=getattr ( settings, 'SINGLEFLIGHT_RESULT_SECONDS', 10 ) )
+      except Exception, e:
+        logger.warning ( "Failed to share coalesced request in memcache. {}".format(e) )
+      return result
+    finally:
+      try:
+        mc.delete ( lockkey )
+      except Exception, e:
+        pass
+
+  # wait for the result of the flight that holds the lock
+  poll = getattr ( settings, 'SINGLEFLIGHT_POLL_SECONDS', 0.02 )
+  deadline = time.time() + getattr ( settings, 'SINGLEFLIGHT_WAIT', 60 )
+  try:
+    leaderid = mc.get ( lockkey )
+    while leaderid is not None and time.time() < deadline:
+      result = mc.get ( KEYPREFIX + 'result/' + leaderid )
+      if result is not None:
+        return result
+      time.sleep ( poll )
+      if mc.get ( lockkey ) != leaderid:
+        # the leader finished.  look for its result once more.
+        result = mc.get ( KEYPREFIX + 'result/' + leaderid )
+        if result is not None:
+          return result
+        break
+  except Exception, e:
+    logger.warning ( "Failed to read coalesced request from memcache. {}".format(e) )
+
+  return func()
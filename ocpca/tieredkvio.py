@@ -0,0 +1,349 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import struct
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+
+from django.conf import settings
+
+import filekvio
+
+import logging
+logger=logging.getLogger("ocp")
+
+"""
+  A fast local store in front of a durable key/value engine.
+
+  Cuboids are read through the fast store.  A cuboid that misses is copied
+    into it once it has been read TIER_ADMIT_READS times.  Everything else
+    (indexes, exceptions, time and neariso cuboids, metadata) goes straight
+    to the backend.
+
+  TIER_WRITE_POLICY chooses how cuboid writes are handled:
+    writethrough  writes go to the backend and refresh a copy in the fast store
+                  of this host.  Other hosts don't see the write until their
+                  copy is older than TIER_COPY_TTL seconds and is read again
+                  from the backend.  A TTL of 0 keeps copies until this host
+                  overwrites them, which is only safe with a single writer host.
+    writeback     writes go to the fast store and reach the backend in batches
+                  of TIER_WRITEBACK_CUBES or when the kvio is closed.  Readers
+                  on other hosts see the backend and may read old cuboids until then.
+                  Copies don't expire, so there must be a single writer host.
+
+  The fast store is a File engine under TIER_KV_ROOT.  It only holds copies
+    and can be deleted at any time when there are no unflushed writes.
+    Each copy starts with COPY_MAGIC and the time it was made.
+"""
+
+WRITETHROUGH = 'writethrough'
+WRITEBACK = 'writeback'
+
+COPY_MAGIC = '\x93OCPT'
+COPY_HEADERSIZE = len(COPY_MAGIC)+8
+
+# cuboids read per backend query when warming
+WARM_BATCH = 1024
+
+
+# process wide count of reads that missed the fast store
+_misses = {}
+_misses_lock = threading.Lock()
+
+def countMiss ( key ):
+  """Count a miss and return the number of misses for the key"""
+
+  with _misses_lock:
+    # forget old counts rather than grow without bound
+    if len(_misses) > getattr ( settings, 'TIER_ADMIT_TRACK', 65536 ):
+      _misses.clear()
+    count = _misses[key] = _misses.get ( key, 0 ) + 1
+  return count
+
+def forgetMiss ( key ):
+  with _misses_lock:
+    _misses.pop ( key, None )
+
+
+def tierPath ( dbname, channame=None ):
+  """Directory of the fast store of a project or channel"""
+
+  path = filekvio.projectPath ( dbname, getattr ( settings, 'TIER_KV_ROOT', '/data/ocptier' ) )
+  if channame is not None:
+    path = os.path.join ( path, channame )
+  return path
+
+def toCopy ( cubestr ):
+  """A cuboid as a dated fast store copy"""
+  return COPY_MAGIC + struct.pack ( '<d', time.time() ) + cubestr
+
+def fromCopy ( copystr, ttl=0 ):
+  """The cuboid in a fast store copy.  None if it is older than ttl seconds."""
+
+  if copystr is None:
+    return None
+  # copies made before they were dated
+  if copystr[:len(COPY_MAGIC)] != COPY_MAGIC:
+    return None if ttl else copystr
+  if ttl and time.time() - struct.unpack ( '<d', copystr[len(COPY_MAGIC):COPY_HEADERSIZE] )[0] > ttl:
+    return None
+  return copystr[COPY_HEADERSIZE:]
+
+
+class TieredKVIO:
+
+  def __init__ ( self, db, backend ):
+    """Layer the fast store over a backend kvio"""
+
+    self.db = db
+    self.backend = backend
+    self.fast = filekvio.FileKVIO ( db, getattr ( settings, 'TIER_KV_ROOT', '/data/ocptier' ) )
+
+    self.policy = getattr ( settings, 'TIER_WRITE_POLICY', WRITETHROUGH )
+    # writeback copies may be the only copy so they never expire
+    self.ttl = getattr ( settings, 'TIER_COPY_TTL', 300 ) if self.policy == WRITETHROUGH else 0
+    self.admitreads = getattr ( settings, 'TIER_ADMIT_READS', 2 )
+    self.writebackcubes = getattr ( settings, 'TIER_WRITEBACK_CUBES', 1024 )
+
+    # writeback cuboids not yet in the backend ( channel name, resolution, zidx ) -> channel
+    self.dirty = OrderedDict()
+    # writeback cuboids of the open transaction
+    self.txndirty = OrderedDict()
+    self.txn = False
+
+  def __getattr__ ( self, name ):
+    """Everything that isn't tiered is the backend's"""
+    return getattr ( self.backend, name )
+
+  def close ( self ):
+    """Flush writeback cuboids and close both stores"""
+
+    try:
+      if self.txn:
+        self.rollback()
+      self.flush()
+    finally:
+      self.fast.close()
+      self.backend.close()
+
+  def startTxn ( self ):
+    """Start a transaction in both stores"""
+    self.backend.startTxn()
+    self.fast.startTxn()
+    self.txn = True
+
+  def commit ( self ):
+    """Commit the backend first so the fast store never holds what the backend lost"""
+
+    self.txn = False
+    try:
+      self.backend.commit()
+    except:
+      self.fast.rollback()
+      raise
+    self.fast.commit()
+
+    self.dirty.update ( self.txndirty )
+    self.txndirty.clear()
+    if len(self.dirty) > self.writebackcubes:
+      self.flush()
+
+  def rollback ( self ):
+    """Rollback both stores"""
+
+    self.txn = False
+    self.txndirty.clear()
+    try:
+      self.backend.rollback()
+    finally:
+      self.fast.rollback()
+
+  def _missKey ( self, ch, zidx, resolution ):
+    return ( self.db.proj.getDBName(), ch.getChannelName(), resolution, int(zidx) )
+
+  def _putCopies ( self, ch, resolution, cuboids ):
+    """Write a list of ( zidx, cubestr ) to the fast store"""
+    self.fast.putCubes ( ch, [ zidx for zidx, cubestr in cuboids ], resolution, [ toCopy(cubestr) for zidx, cubestr in cuboids ] )
+
+  def _getCopies ( self, ch, listofidxs, resolution ):
+    """The cuboids in the fast store that have not expired as { zidx : cubestr } and the zidxs of the expired ones"""
+
+    copies = {}
+    expired = set()
+    for zidx, copystr in self.fast.getCubes ( ch, listofidxs, resolution ):
+      cubestr = fromCopy ( copystr, self.ttl )
+      if cubestr is None:
+        expired.add ( zidx )
+      else:
+        copies[zidx] = cubestr
+    return copies, expired
+
+  def _admit ( self, ch, resolution, cuboids, expired=() ):
+    """Copy the cuboids that have been read often enough into the fast store.  Expired copies are refreshed."""
+
+    admitted = []
+    for zidx, cubestr in cuboids:
+      if zidx in expired:
+        admitted.append ( ( zidx, cubestr ) )
+        continue
+      key = self._missKey ( ch, zidx, resolution )
+      if countMiss ( key ) >= self.admitreads:
+        forgetMiss ( key )
+        admitted.append ( ( zidx, cubestr ) )
+
+    if admitted:
+      self._putCopies ( ch, resolution, admitted )
+
+
+  def getCube ( self, ch, zidx, resolution, update=False ):
+    """Read a cuboid from the fast store or the backend"""
+
+    # a locking read has to take the lock in the backend
+    if update:
+      cubestr = self.backend.getCube ( ch, zidx, resolution, update )
+
+    copies, expired = self._getCopies ( ch, [ int(zidx) ], resolution )
+    if copies:
+      return copies.values()[0]
+
+    if not update:
+      cubestr = self.backend.getCube ( ch, zidx, resolution, update )
+    if cubestr is not None:
+      self._admit ( ch, resolution, [ ( int(zidx), cubestr ) ], expired )
+    return cubestr
+
+  def getCubes ( self, ch, listofidxs, resolution, neariso=False, update=False ):
+    """Yield the cuboids in the fast store and read the rest from the backend"""
+
+    if neariso:
+      for retval in self.backend.getCubes ( ch, listofidxs, resolution, neariso ):
+        yield retval
+      return
+
+    listofidxs = [ int(zidx) for zidx in listofidxs ]
+
+    # a locking read has to take the locks in the backend.  writeback copies are newer.
+    if update:
+      cuboids = dict ( self.backend.getCubes ( ch, listofidxs, resolution, update=update ) )
+      cuboids.update ( self._getCopies ( ch, listofidxs, resolution )[0] )
+      for zidx, cubestr in cuboids.iteritems():
+        yield ( zidx, cubestr )
+      return
+    fastcubes, expired = self._getCopies ( ch, listofidxs, resolution )
+    for zidx, cubestr in fastcubes.iteritems():
+      yield ( zidx, cubestr )
+
+    missedidxs = [ zidx for zidx in listofidxs if zidx not in fastcubes ]
+    if not missedidxs:
+      return
+
+    # admit after the backend read is finished so the backend cursor isn't interrupted
+    cuboids = []
+    for zidx, cubestr in self.backend.getCubes ( ch, missedidxs, resolution ):
+      cuboids.append ( ( zidx, cubestr ) )
+      yield ( zidx, cubestr )
+    self._admit ( ch, resolution, cuboids, expired )
+
+  def getCubeRanges ( self, ch, ranges, resolution, neariso=False ):
+    """Retrieve the cubes in a list of inclusive [start,end] zindex ranges"""
+
+    if neariso:
+      return self.backend.getCubeRanges ( ch, ranges, resolution, neariso )
+
+    listofidxs = [ zidx for ( start, end ) in np.asarray(ranges, dtype=np.uint64).tolist() for zidx in xrange(start, end+1) ]
+    return self.getCubes ( ch, listofidxs, resolution )
+
+  def putCubes ( self, ch, listofidxs, resolution, listofcubes, update=False ):
+    """Write cuboids with the write policy"""
+
+    listofidxs = [ int(zidx) for zidx in listofidxs ]
+
+    if self.policy == WRITEBACK:
+      self._putCopies ( ch, resolution, zip ( listofidxs, listofcubes ) )
+      dirty = self.txndirty if self.txn else self.dirty
+      for zidx in listofidxs:
+        dirty[(ch.getChannelName(), resolution, zidx)] = ch
+      if not self.txn and len(self.dirty) > self.writebackcubes:
+        self.flush()
+      return
+
+    self.backend.putCubes ( ch, listofidxs, resolution, listofcubes, update )
+
+    # refresh the copies the fast store already has
+    cached = set ( [ zidx for zidx, copystr in self.fast.getCubes ( ch, listofidxs, resolution ) ] )
+    if cached:
+      self._putCopies ( ch, resolution, [ ( zidx, cubestr ) for zidx, cubestr in zip ( listofidxs, listofcubes ) if zidx in cached ] )
+
+  def putCube ( self, ch, zidx, resolution, cubestr, update=False ):
+    """Write a cuboid with the write policy"""
+
+    if self.policy == WRITEBACK:
+      self.putCubes ( ch, [ zidx ], resolution, [ cubestr ], update )
+      return
+
+    self.backend.putCube ( ch, zidx, resolution, cubestr, update )
+    if self.fast.getCube ( ch, zidx, resolution ) is not None:
+      self.fast.putCube ( ch, zidx, resolution, toCopy(cubestr) )
+
+  def flush ( self ):
+    """Write the writeback cuboids to the backend"""
+
+    if not self.dirty:
+      return
+
+    # one batch per channel and resolution
+    batches = OrderedDict()
+    for ( channame, resolution, zidx ), ch in self.dirty.iteritems():
+      batches.setdefault ( ( channame, resolution ), ( ch, [] ) )[1].append ( zidx )
+
+    # flushes happen between transactions
+    self.backend.startTxn()
+    try:
+      for ( channame, resolution ), ( ch, listofidxs ) in batches.iteritems():
+        cuboids = [ ( zidx, fromCopy(copystr) ) for zidx, copystr in self.fast.getCubes ( ch, listofidxs, resolution ) ]
+        self.backend.putCubes ( ch, [ zidx for zidx, cubestr in cuboids ], resolution, [ cubestr for zidx, cubestr in cuboids ], True )
+    except:
+      self.backend.rollback()
+      raise
+    self.backend.commit()
+
+    self.dirty.clear()
+
+  def compactLog ( self, ch ):
+    """Compact the fast store and a File backend.  Returns the bytes reclaimed."""
+
+    reclaimed = self.fast.compactLog ( ch )
+    if getattr ( self.backend, 'compactLog', None ) is not None:
+      reclaimed += self.backend.compactLog ( ch )
+    return reclaimed
+
+  def warm ( self, ch, listofidxs, resolution ):
+    """Copy cuboids from the backend into the fast store.  Returns the number copied."""
+
+    count = 0
+    listofidxs = [ int(zidx) for zidx in listofidxs ]
+    for start in range ( 0, len(listofidxs), WARM_BATCH ):
+      batch = listofidxs[start:start+WARM_BATCH]
+      cached = self._getCopies ( ch, batch, resolution )[0]
+      missedidxs = [ zidx for zidx in batch if zidx not in cached ]
+      if not missedidxs:
+        continue
+      cuboids = list ( self.backend.getCubes ( ch, missedidxs, resolution ) )
+      if cuboids:
+        self._putCopies ( ch, resolution, cuboids )
+      count += len(cuboids)
+    return count
@@ -41,6 +41,13 @@ uint64_t XYZMorton ( uint64_t * );
 // Declaring MortonXYZ zindex function
 void MortonXYZ ( uint64_t , uint64_t [3] );
 
+// Declaring the batch XYZMorton and MortonXYZ zindex functions
+void XYZMortonBatch ( uint32_t [][3] , uint64_t * , int );
+void MortonXYZBatch ( uint64_t * , uint32_t [][3] , int );
+
+// Declaring MortonRanges zindex function
+int MortonRanges ( uint64_t * , uint64_t * , uint64_t , uint64_t [][2] , int );
+
 // Declaring recolorCube function
 void recolorCubeOMP ( uint32_t * , int , int , uint32_t * , uint32_t * ); 
 
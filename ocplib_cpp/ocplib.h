@@ -41,6 +41,13 @@ extern "C" uint64_t XYZMorton ( uint64_t * );
 // Declaring MortonXYZ zindex function
 extern "C" void MortonXYZ ( uint64_t , uint64_t [3] );
 
+// Declaring the batch XYZMorton and MortonXYZ zindex functions
+extern "C" void XYZMortonBatch ( uint32_t [][3] , uint64_t * , int );
+extern "C" void MortonXYZBatch ( uint64_t * , uint32_t [][3] , int );
+
+// Declaring MortonRanges zindex function
+extern "C" int MortonRanges ( uint64_t * , uint64_t * , uint64_t , uint64_t [][2] , int );
+
 // Declaring recolorSlice function
 extern "C" void recolorCubeOMP ( uint32_t * , int , int , uint32_t * , uint32_t * ); 
 
@@ -67,3 +67,101 @@ void MortonXYZ ( uint64_t morton, uint64_t xyz[3] )
   }
 
 }
+
+// Generate morton order for an array of n XYZ coordinates
+
+void XYZMortonBatch ( uint32_t xyz[][3], uint64_t * morton, int n )
+{
+  int i;
+  uint64_t coords[3];
+
+  for ( i=0; i<n; i++ )
+  {
+    coords[0] = xyz[i][0];
+    coords[1] = xyz[i][1];
+    coords[2] = xyz[i][2];
+    morton[i] = XYZMorton ( coords );
+  }
+}
+
+// Generate XYZ coordinates for an array of n Morton indexes
+
+void MortonXYZBatch ( uint64_t * morton, uint32_t xyz[][3], int n )
+{
+  int i;
+  uint64_t coords[3];
+
+  for ( i=0; i<n; i++ )
+  {
+    // MortonXYZ accumulates into the coordinates
+    coords[0] = coords[1] = coords[2] = 0;
+    MortonXYZ ( morton[i], coords );
+    xyz[i][0] = coords[0];
+    xyz[i][1] = coords[1];
+    xyz[i][2] = coords[2];
+  }
+}
+
+// Add a range to the output, merging it with the previous range if the gap is at most maxgap.
+//  Returns the new number of ranges or -1 if the output is full.
+
+static int addMortonRange ( uint64_t start, uint64_t end, uint64_t maxgap, uint64_t ranges[][2], int nranges, int maxranges )
+{
+  if ( nranges > 0 && start - ranges[nranges-1][1] - 1 <= maxgap )
+  {
+    ranges[nranges-1][1] = end;
+    return nranges;
+  }
+
+  if ( nranges == maxranges )
+    return -1;
+
+  ranges[nranges][0] = start;
+  ranges[nranges][1] = end;
+  return nranges+1;
+}
+
+// Visit the octant of side 2^level at xyz whose first Morton index is base.
+//  Octants inside the box are one range.  Octants that straddle the box are split
+//  into their 8 children in Morton order so ranges are generated in increasing order.
+
+static int mortonRangesOctant ( uint64_t x, uint64_t y, uint64_t z, uint64_t base, int level, uint64_t * lo, uint64_t * hi, uint64_t maxgap, uint64_t ranges[][2], int nranges, int maxranges )
+{
+  int i;
+  uint64_t side = (uint64_t)1 << level;
+
+  // disjoint from the box
+  if ( x >= hi[0] || x+side <= lo[0] || y >= hi[1] || y+side <= lo[1] || z >= hi[2] || z+side <= lo[2] )
+    return nranges;
+
+  // inside the box
+  if ( x >= lo[0] && x+side <= hi[0] && y >= lo[1] && y+side <= hi[1] && z >= lo[2] && z+side <= hi[2] )
+    return addMortonRange ( base, base + (((uint64_t)1 << (3*level)) - 1), maxgap, ranges, nranges, maxranges );
+
+  side >>= 1;
+  for ( i=0; i<8 && nranges>=0; i++ )
+  {
+    nranges = mortonRangesOctant ( x + (i&1)*side, y + ((i>>1)&1)*side, z + ((i>>2)&1)*side, base + ((uint64_t)i << (3*(level-1))), level-1, lo, hi, maxgap, ranges, nranges, maxranges );
+  }
+
+  return nranges;
+}
+
+// Decompose the box [lo,hi) of cuboid coordinates into ranges of Morton indexes.
+//  Ranges are inclusive [start,end] pairs in increasing order.  Ranges whose gap is at
+//  most maxgap are merged so they can include a few indexes outside the box.
+//  Returns the number of ranges or -1 if more than maxranges are needed.
+
+int MortonRanges ( uint64_t * lo, uint64_t * hi, uint64_t maxgap, uint64_t ranges[][2], int maxranges )
+{
+  int level = 0;
+
+  if ( lo[0] >= hi[0] || lo[1] >= hi[1] || lo[2] >= hi[2] )
+    return 0;
+
+  // the smallest octant at the origin that holds the box.  21 bits per dimension.
+  while ( level < 21 && ( ((uint64_t)1 << level) < hi[0] || ((uint64_t)1 << level) < hi[1] || ((uint64_t)1 << level) < hi[2] ) )
+    level++;
+
+  return mortonRangesOctant ( 0, 0, 0, 0, level, lo, hi, maxgap, ranges, 0, maxranges );
+}
@@ -37,6 +37,9 @@ import ocpcadb
 
 """ Determine a histogram from an image stack """
 
+# number of cuboids to read in each query
+CUBE_BATCH = 1024
+
 class ImgHist():
   """ Get the histogram for an image dataset by getting individual histograms for cube aligned cutouts, then summing """  
   
@@ -65,19 +68,26 @@ class ImgHist():
       zlimit = (zimagesz-1) / zcubedim + 1
 
       hist_sum = np.zeros(self.numbins, dtype=np.uint32) 
-      
+      bins = np.linspace(0, self.numbins, self.numbins+1)
+
+      # all the cuboids in Morton order so they are read sequentially
+      zidxs = np.sort ( ocplib.XYZMortonBatch ( ocplib.XYZBox ( [0,0,0], [xlimit,ylimit,zlimit] ) ) ).tolist()
+      cube = Cube.getCube(cubedim, ch.getChannelType(), ch.getDataType())
+
       # sum the histograms 
-      for z in range(zlimit):
-        for y in range(ylimit):
-          for x in range(xlimit):
-
-            # cutout the data for the cube 
-            data = db.cutout(ch, [ x*xcubedim, y*ycubedim, z*zcubedim], cubedim, self.res ).data
-            
-            # compute the histogram and store it 
-            (hist, bins) = np.histogram(data[data > 0], bins=self.numbins, range=(0,self.numbins))
-            hist_sum = np.add( hist_sum, hist )
-            print "Processed cube {} {} {}".format(x,y,z)
+      for start in range(0, len(zidxs), CUBE_BATCH):
+
+        # missing cuboids are all zeros and don't contribute
+        for idx, datastring in db.getCubes(ch, zidxs[start:start+CUBE_BATCH], self.res):
+
+          cube.fromCodec(datastring[:], db.NPZ)
+          data = cube.data
+
+          # compute the histogram and store it 
+          (hist, bins) = np.histogram(data[data > 0], bins=self.numbins, range=(0,self.numbins))
+          hist_sum = np.add( hist_sum, hist )
+
+        print "Processed {} of {} cubes".format(min(start+CUBE_BATCH,len(zidxs)), len(zidxs))
         
       return (hist_sum, bins)
       
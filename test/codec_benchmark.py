@@ -0,0 +1,93 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import argparse
+import numpy as np
+import time
+
+sys.path += [os.path.abspath('../django')]
+import OCP.settings
+os.environ['DJANGO_SETTINGS_MODULE'] = 'OCP.settings'
+
+import blosc
+import cubecodec
+from ocptype import CODEC_DEFAULT
+
+#
+#  Compress and decompress cuboids with each channel codec.
+#
+#  Uses a synthetic EM-like cuboid (smooth background plus noise) or
+#    cuboids saved with np.save.  Prints the ratio and throughput of
+#    each codec and of the legacy MySQL (npz) and blosc formats.
+#
+
+
+def syntheticCuboid ( shape, dtype ):
+  """Low frequency structure with pixel noise, like EM data"""
+
+  coarse = np.random.random ( [ max(1,s/8) for s in shape ] )
+  smooth = coarse.repeat(8,axis=0).repeat(8,axis=1).repeat(8,axis=2)[:shape[0],:shape[1],:shape[2]]
+  data = smooth * 0.8 + np.random.random ( shape ) * 0.2
+  return ( data * np.iinfo(dtype).max ).astype(dtype)
+
+def timeit ( func, iterations ):
+  """Seconds per call"""
+
+  start = time.time()
+  for i in range ( iterations ):
+    result = func()
+  return ( time.time()-start ) / iterations, result
+
+def benchmark ( cuboids, codecs, iterations ):
+
+  rawbytes = sum ( [ data.nbytes for data in cuboids ] )
+  print "{:<14} {:>8} {:>14} {:>14}".format ( 'codec', 'ratio', 'compress MB/s', 'decompress MB/s' )
+
+  for name, codec, npz in codecs:
+    enctime, cubestrs = timeit ( lambda: [ cubecodec.compress ( data, codec, npz ) for data in cuboids ], iterations )
+    dectime, decoded = timeit ( lambda: [ cubecodec.decompress ( cubestr, npz ) for cubestr in cubestrs ], iterations )
+    for data, result in zip ( cuboids, decoded ):
+      assert np.array_equal ( data, result )
+    cubebytes = sum ( [ len(cubestr) for cubestr in cubestrs ] )
+    print "{:<14} {:>8.2f} {:>14.1f} {:>14.1f}".format ( name, float(rawbytes)/cubebytes, rawbytes/enctime/2**20, rawbytes/dectime/2**20 )
+
+
+def main():
+
+  parser = argparse.ArgumentParser(description='Benchmark the cuboid codecs')
+  parser.add_argument('--files', nargs='*', action="store", default=None, help='Cuboids saved with np.save.  Default is a synthetic cuboid.')
+  parser.add_argument('--dtype', action="store", default='uint16', help='Data type of the synthetic cuboid')
+  parser.add_argument('--shape', type=int, nargs=3, action="store", default=[16,128,128], help='Z Y X shape of the synthetic cuboid')
+  parser.add_argument('--iterations', type=int, action="store", default=20, help='Repetitions of each measurement')
+
+  result = parser.parse_args()
+
+  if result.files:
+    cuboids = [ np.load ( filename ) for filename in result.files ]
+  else:
+    cuboids = [ syntheticCuboid ( result.shape, np.dtype(result.dtype) ) ]
+
+  codecs = [ ( 'legacy npz', CODEC_DEFAULT, True ), ( 'legacy blosc', CODEC_DEFAULT, False ) ]
+  for codec in sorted ( cubecodec.CODEC_IDS.keys() ):
+    if codec in cubecodec.BLOSC_CNAMES and cubecodec.BLOSC_CNAMES[codec] not in blosc.compressor_list():
+      continue
+    codecs.append ( ( codec, codec, False ) )
+
+  benchmark ( cuboids, codecs, result.iterations )
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,183 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import types
+import threading
+
+"""
+  In process stand-ins for the riak and aerospike clients.
+
+  install() registers them as the riak and aerospike modules so riakkvio
+    and askvio run without a cluster.  They implement only the calls the
+    kvios make.  Every client shares one store, like clients of one cluster,
+    and counts its calls so tests can check that batches are batched.
+"""
+
+
+class CallCounts:
+
+  def __init__ ( self ):
+    self.counts = {}
+    # the kvios write from the kv pool's threads
+    self.lock = threading.Lock()
+
+  def count ( self, name ):
+    with self.lock:
+      self.counts[name] = self.counts.get ( name, 0 ) + 1
+
+  def get ( self, name ):
+    return self.counts.get ( name, 0 )
+
+  def clear ( self ):
+    self.counts.clear()
+
+calls = CallCounts()
+
+
+#
+#  riak
+#
+
+# bucket name -> { key : value }
+riakbuckets = {}
+
+class RiakObject:
+
+  def __init__ ( self, bucket, key, encoded_data ):
+    self.bucket = bucket
+    self.key = key
+    self.encoded_data = encoded_data
+
+  def store ( self ):
+    calls.count ( 'riak.store' )
+    riakbuckets.setdefault ( self.bucket.name, {} )[self.key] = str ( self.encoded_data )
+    return self
+
+class RiakBucket:
+
+  def __init__ ( self, name ):
+    self.name = name
+
+  def _data ( self ):
+    return riakbuckets.setdefault ( self.name, {} )
+
+  def get ( self, key ):
+    """Missing keys come back as an object without data"""
+    calls.count ( 'riak.get' )
+    return RiakObject ( self, key, self._data().get ( key ) )
+
+  def multiget ( self, keys ):
+    calls.count ( 'riak.multiget' )
+    return [ RiakObject ( self, key, self._data().get ( key ) ) for key in keys ]
+
+  def new ( self, key=None, encoded_data=None ):
+    return RiakObject ( self, key, encoded_data )
+
+  def delete ( self, key ):
+    calls.count ( 'riak.delete' )
+    self._data().pop ( key, None )
+
+class RiakClient:
+
+  def __init__ ( self, host=None, pb_port=None, protocol=None ):
+    self.closed = False
+
+  def bucket ( self, name ):
+    return RiakBucket ( name )
+
+  def close ( self ):
+    self.closed = True
+
+
+#
+#  aerospike
+#
+
+class RecordNotFound ( Exception ):
+  pass
+
+# ( namespace, set, key ) -> bins
+asrecords = {}
+
+class AerospikeScan:
+
+  def __init__ ( self, namespace, setname ):
+    self.namespace = namespace
+    self.setname = setname
+
+  def foreach ( self, callback ):
+    for askey, bins in asrecords.items():
+      if askey[:2] == ( self.namespace, self.setname ):
+        callback ( ( askey, { 'gen' : 1 }, bins ) )
+
+class AerospikeClient:
+
+  def __init__ ( self, config ):
+    self.config = config
+
+  def connect ( self ):
+    return self
+
+  def close ( self ):
+    pass
+
+  def get ( self, askey ):
+    calls.count ( 'aerospike.get' )
+    if askey not in asrecords:
+      raise RecordNotFound ( askey )
+    return ( askey, { 'gen' : 1 }, asrecords[askey] )
+
+  def get_many ( self, askeys ):
+    """Missing records come back with None metadata and bins"""
+    calls.count ( 'aerospike.get_many' )
+    return [ ( askey, { 'gen' : 1 }, asrecords[askey] ) if askey in asrecords else ( askey, None, None ) for askey in askeys ]
+
+  def put ( self, askey, bins ):
+    calls.count ( 'aerospike.put' )
+    asrecords[askey] = dict ( bins )
+
+  def remove ( self, askey ):
+    calls.count ( 'aerospike.remove' )
+    if askey not in asrecords:
+      raise RecordNotFound ( askey )
+    del asrecords[askey]
+
+  def scan ( self, namespace, setname ):
+    return AerospikeScan ( namespace, setname )
+
+
+def install ():
+  """Register the stand-ins as the riak and aerospike modules"""
+
+  riak = types.ModuleType ( 'riak' )
+  riak.RiakClient = RiakClient
+
+  exception = types.ModuleType ( 'aerospike.exception' )
+  exception.RecordNotFound = RecordNotFound
+
+  aerospike = types.ModuleType ( 'aerospike' )
+  aerospike.client = AerospikeClient
+  aerospike.exception = exception
+
+  sys.modules['riak'] = riak
+  sys.modules['aerospike'] = aerospike
+  sys.modules['aerospike.exception'] = exception
+
+def clear ():
+  """Empty the stores and the call counts"""
+
+  riakbuckets.clear()
+  asrecords.clear()
+  calls.clear()
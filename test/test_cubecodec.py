@@ -0,0 +1,127 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import zlib
+import cStringIO
+import numpy as np
+import pytest
+
+sys.path += [os.path.abspath('../django')]
+import OCP.settings
+os.environ['DJANGO_SETTINGS_MODULE'] = 'OCP.settings'
+
+import blosc
+import cubecodec
+from ocptype import CODEC_DEFAULT, CODEC_ZLIB, CODEC_BLOSC, CODEC_LZ4, CODEC_ZSTD
+from ocpcaerror import OCPCAError
+
+# Test_CubeCodec
+# 1 - test_roundtrip
+# 2 - test_legacy
+# 3 - test_constant
+# 4 - test_codecof
+# 5 - test_errors
+
+
+def available ( codec ):
+  """False for blosc compressors missing from this blosc build"""
+  return codec not in cubecodec.BLOSC_CNAMES or cubecodec.BLOSC_CNAMES[codec] in blosc.compressor_list()
+
+CODECS = [ codec for codec in [ CODEC_ZLIB, CODEC_BLOSC, CODEC_LZ4, CODEC_ZSTD ] if available(codec) ]
+
+
+class Test_CubeCodec:
+
+  def setup_class ( self ):
+
+    np.random.seed ( 1 )
+    self.cuboids = [ np.random.randint ( 0, 255, (16,128,128) ).astype(np.uint8),
+                     np.random.randint ( 0, 2**16, (16,128,128) ).astype(np.uint16),
+                     np.random.randint ( 0, 2**32, (16,128,128) ).astype(np.uint32),
+                     np.random.random ( (16,128,128) ).astype(np.float32),
+                     np.random.randint ( 0, 255, (8,128,128,3) ).astype(np.uint8) ]
+
+  def test_roundtrip ( self ):
+    """Every codec gives back the same array with a header naming the codec"""
+
+    for data in self.cuboids:
+      for codec in CODECS:
+        for npz in [ True, False ]:
+          cubestr = cubecodec.compress ( data, codec, npz )
+          assert cubestr.startswith ( cubecodec.MAGIC + chr(cubecodec.CODEC_IDS[codec]) )
+          result = cubecodec.decompress ( cubestr, npz )
+          assert result.dtype == data.dtype
+          assert np.array_equal ( result, data )
+
+  def test_legacy ( self ):
+    """The default codec and cuboids written before codecs are the engine's headerless format"""
+
+    data = self.cuboids[1]
+
+    # MySQL wrote np.save and zlib
+    fileobj = cStringIO.StringIO()
+    np.save ( fileobj, data )
+    npzstr = zlib.compress ( fileobj.getvalue() )
+    assert cubecodec.codecOf ( npzstr ) == CODEC_DEFAULT
+    assert np.array_equal ( cubecodec.decompress ( npzstr, True ), data )
+    assert cubecodec.compress ( data, CODEC_DEFAULT, True ) == npzstr
+
+    # the other engines wrote blosc.pack_array
+    bloscstr = blosc.pack_array ( data )
+    assert cubecodec.codecOf ( bloscstr ) == CODEC_DEFAULT
+    assert np.array_equal ( cubecodec.decompress ( bloscstr, False ), data )
+    assert np.array_equal ( cubecodec.decompress ( cubecodec.compress ( data, CODEC_DEFAULT, False ), False ), data )
+
+    # neither format can start with the magic
+    assert not npzstr.startswith ( cubecodec.MAGIC )
+    assert not bloscstr.startswith ( cubecodec.MAGIC )
+
+  def test_constant ( self ):
+    """Cuboids of one value are small constant records in any codec"""
+
+    for dtype in [ np.uint8, np.uint16, np.uint32, np.uint64, np.float32 ]:
+      for value in [ 0, 7 ]:
+        data = np.full ( (16,128,128), value, dtype=dtype )
+        for codec in [ CODEC_DEFAULT ] + CODECS:
+          cubestr = cubecodec.compress ( data, codec, True )
+          assert cubecodec.codecOf ( cubestr ) == cubecodec.CONSTANT
+          assert len(cubestr) < 64
+          assert cubecodec.isZeros ( cubestr ) == ( value == 0 )
+          assert cubecodec.fromConstant ( cubestr ) == ( np.dtype(dtype), (16,128,128), value )
+          result = cubecodec.decompress ( cubestr, False )
+          assert result.dtype == data.dtype
+          assert np.array_equal ( result, data )
+
+    # one different voxel anywhere is not constant
+    data = np.zeros ( (16,128,128), dtype=np.uint32 )
+    data[8,64,64] = 1
+    assert cubecodec.toConstant ( data ) is None
+    assert not cubecodec.isZeros ( cubecodec.compress ( data, CODEC_ZLIB, True ) )
+
+  def test_codecof ( self ):
+    """The codec is read from the header"""
+
+    data = self.cuboids[0]
+    for codec in CODECS:
+      assert cubecodec.codecOf ( cubecodec.compress ( data, codec, False ) ) == codec
+
+  def test_errors ( self ):
+    """Unknown codecs are errors"""
+
+    with pytest.raises ( OCPCAError ):
+      cubecodec.compress ( self.cuboids[0], 'nosuchcodec', False )
+    with pytest.raises ( OCPCAError ):
+      cubecodec.codecOf ( cubecodec.MAGIC + chr(12) + 'data' )
@@ -0,0 +1,99 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path += [os.path.abspath('../django')]
+import OCP.settings
+os.environ['DJANGO_SETTINGS_MODULE'] = 'OCP.settings'
+
+import exceptioncodec
+from ocpcaerror import OCPCAError
+
+# Test_ExceptionCodec
+# 1 - test_roundtrip
+# 2 - test_empty
+# 3 - test_merge
+# 4 - test_remove
+# 5 - test_errors
+
+
+def randomVoxels ( n ):
+  """Unique xyz offsets in a 128x128x16 cuboid"""
+  voxels = np.column_stack ( ( np.random.randint ( 0, 128, n ), np.random.randint ( 0, 128, n ), np.random.randint ( 0, 16, n ) ) ).astype(np.uint32)
+  return np.array ( sorted ( set ( map ( tuple, voxels ) ) ), dtype=np.uint32 ).reshape(-1,3)
+
+def voxelSet ( voxels ):
+  return set ( map ( tuple, np.asarray ( voxels ).reshape(-1,3).tolist() ) )
+
+
+class Test_ExceptionCodec:
+
+  def setup_class ( self ):
+    np.random.seed ( 3 )
+
+  def test_roundtrip ( self ):
+    """Every id comes back with the same voxels"""
+
+    exceptions = { 1 : randomVoxels(1), 2**40 : randomVoxels(500), 77 : randomVoxels(5000) }
+    excstr = exceptioncodec.encode ( exceptions )
+    assert excstr.startswith ( exceptioncodec.MAGIC )
+
+    decoded = exceptioncodec.decode ( excstr )
+    assert sorted ( decoded.keys() ) == sorted ( exceptions.keys() )
+    for annid, voxels in exceptions.iteritems():
+      assert decoded[annid].dtype == np.uint32
+      assert np.array_equal ( decoded[annid], voxels )
+
+    # lists work as well as arrays
+    decoded = exceptioncodec.decode ( exceptioncodec.encode ( { 5 : [ [1,2,3], [4,5,6] ] } ) )
+    assert np.array_equal ( decoded[5], [ [1,2,3], [4,5,6] ] )
+
+  def test_empty ( self ):
+    """Missing blobs and ids without voxels"""
+
+    assert exceptioncodec.decode ( None ) == {}
+    assert exceptioncodec.decode ( '' ) == {}
+    assert exceptioncodec.decode ( exceptioncodec.encode ( {} ) ) == {}
+
+    decoded = exceptioncodec.decode ( exceptioncodec.encode ( { 1 : np.zeros ( (0,3), dtype=np.uint32 ), 2 : [], 3 : randomVoxels(10) } ) )
+    assert decoded.keys() == [ 3 ]
+
+  def test_merge ( self ):
+    """merge is the union of the voxels"""
+
+    for n1, n2 in [ (0,10), (10,0), (100,100), (1000,50) ]:
+      voxels1 = randomVoxels ( n1 )
+      voxels2 = np.concatenate ( ( randomVoxels ( n2 ), voxels1[:n1/2] ) ).reshape(-1,3)
+      merged = exceptioncodec.merge ( voxels1, voxels2 )
+      assert voxelSet ( merged ) == voxelSet ( voxels1 ) | voxelSet ( voxels2 )
+      assert len(merged) == len ( voxelSet ( merged ) )
+
+  def test_remove ( self ):
+    """remove is the difference of the voxels"""
+
+    for n1, n2 in [ (0,10), (10,0), (100,100), (1000,50) ]:
+      voxels1 = randomVoxels ( n1 )
+      voxels2 = np.concatenate ( ( randomVoxels ( n2 ), voxels1[:n1/2] ) ).reshape(-1,3)
+      remaining = exceptioncodec.remove ( voxels1, voxels2 )
+      assert voxelSet ( remaining ) == voxelSet ( voxels1 ) - voxelSet ( voxels2 )
+
+  def test_errors ( self ):
+    """Blobs without the magic are errors"""
+
+    with pytest.raises ( OCPCAError ):
+      exceptioncodec.decode ( 'not exceptions' )
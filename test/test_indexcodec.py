@@ -0,0 +1,131 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import cStringIO
+import numpy as np
+
+sys.path += [os.path.abspath('../django')]
+import OCP.settings
+os.environ['DJANGO_SETTINGS_MODULE'] = 'OCP.settings'
+
+import blosc
+import indexcodec
+
+# Test_IndexCodec
+# 1 - test_roundtrip
+# 2 - test_canonical
+# 3 - test_legacy
+# 4 - test_union
+# 5 - test_intersect
+# 6 - test_contains
+# 7 - test_empty
+
+
+def randomZidxs ( size, high ):
+  """Sorted unique zindexes with both runs and isolated cuboids"""
+
+  runs = [ np.arange ( start, start+length ) for start, length in zip ( np.random.randint ( 0, high, size/8 ), np.random.randint ( 1, 64, size/8 ) ) ]
+  zidxs = np.concatenate ( runs + [ np.random.randint ( 0, high, size ) ] )
+  return np.unique ( zidxs ).astype(np.uint64)
+
+
+class Test_IndexCodec:
+
+  def setup_class ( self ):
+
+    np.random.seed ( 2 )
+    self.indexes = [ randomZidxs ( size, high ) for size, high in [ (1,10), (16,100), (1000,5000), (5000,2**40) ] ]
+    # the largest zindexes of 21 bit coordinates
+    self.indexes.append ( np.array ( [ 2**62, 2**62+1, 2**63-2, 2**63-1 ], dtype=np.uint64 ) )
+
+  def test_roundtrip ( self ):
+    """Encoded indexes decode to the same ranges and zindexes"""
+
+    for zidxs in self.indexes:
+      ranges = indexcodec.toRanges ( zidxs )
+      idxstr = indexcodec.encode ( ranges )
+      assert idxstr.startswith ( indexcodec.MAGIC )
+      decoded = indexcodec.decode ( idxstr, True )
+      assert np.array_equal ( decoded, ranges )
+      assert np.array_equal ( indexcodec.toZidxs ( decoded ), zidxs )
+      assert indexcodec.count ( decoded ) == len(zidxs)
+
+  def test_canonical ( self ):
+    """Ranges are sorted, disjoint and not adjacent"""
+
+    for zidxs in self.indexes:
+      ranges = indexcodec.toRanges ( zidxs )
+      assert ( ranges[:,0] <= ranges[:,1] ).all()
+      assert ( ranges[1:,0] > ranges[:-1,1] + 1 ).all()
+
+  def test_legacy ( self ):
+    """Indexes written as cuboid arrays before runs"""
+
+    for zidxs in self.indexes:
+      ranges = indexcodec.toRanges ( zidxs )
+
+      # MySQL wrote np.save
+      fileobj = cStringIO.StringIO()
+      np.save ( fileobj, zidxs )
+      assert np.array_equal ( indexcodec.decode ( fileobj.getvalue(), True ), ranges )
+
+      # the other engines wrote blosc.pack_array
+      assert np.array_equal ( indexcodec.decode ( blosc.pack_array ( zidxs ), False ), ranges )
+
+  def test_union ( self ):
+    """union matches np.union1d"""
+
+    for i in range ( len(self.indexes) ):
+      for j in range ( len(self.indexes) ):
+        result = indexcodec.union ( [ indexcodec.toRanges ( self.indexes[i] ), indexcodec.toRanges ( self.indexes[j] ) ] )
+        assert np.array_equal ( indexcodec.toZidxs ( result ), np.union1d ( self.indexes[i], self.indexes[j] ) )
+
+    # overlapping, adjacent and nested runs merge
+    result = indexcodec.union ( [ np.array ( [[0,4],[10,20]], dtype=np.uint64 ), np.array ( [[5,5],[12,14],[19,30]], dtype=np.uint64 ), np.array ( [[40,40]], dtype=np.uint64 ) ] )
+    assert np.array_equal ( result, [[0,5],[10,30],[40,40]] )
+
+  def test_intersect ( self ):
+    """intersect matches np.intersect1d"""
+
+    for i in range ( len(self.indexes) ):
+      for j in range ( len(self.indexes) ):
+        result = indexcodec.intersect ( indexcodec.toRanges ( self.indexes[i] ), indexcodec.toRanges ( self.indexes[j] ) )
+        assert np.array_equal ( indexcodec.toZidxs ( result ), np.intersect1d ( self.indexes[i], self.indexes[j] ) )
+
+    # runs that only touch don't intersect
+    assert len ( indexcodec.intersect ( np.array ( [[0,4]], dtype=np.uint64 ), np.array ( [[5,9]], dtype=np.uint64 ) ) ) == 0
+    assert np.array_equal ( indexcodec.intersect ( np.array ( [[0,4],[8,20]], dtype=np.uint64 ), np.array ( [[4,9],[20,25]], dtype=np.uint64 ) ), [[4,4],[8,9],[20,20]] )
+
+  def test_contains ( self ):
+    """contains matches np.in1d"""
+
+    for zidxs in self.indexes:
+      ranges = indexcodec.toRanges ( zidxs )
+      probes = np.concatenate ( ( zidxs, zidxs+np.uint64(1), zidxs-np.uint64(1), np.random.randint ( 0, 2**40, 100 ).astype(np.uint64) ) )
+      assert np.array_equal ( indexcodec.contains ( ranges, probes ), np.in1d ( probes, zidxs ) )
+
+  def test_empty ( self ):
+    """Empty and missing indexes"""
+
+    empty = indexcodec.empty()
+    assert indexcodec.encode ( empty ) == indexcodec.MAGIC
+    for idxstr in [ indexcodec.MAGIC, '', None, [] ]:
+      assert len ( indexcodec.decode ( idxstr, True ) ) == 0
+    assert indexcodec.count ( empty ) == 0
+    assert len ( indexcodec.toZidxs ( empty ) ) == 0
+    assert len ( indexcodec.union ( [ empty, empty ] ) ) == 0
+    assert len ( indexcodec.intersect ( empty, indexcodec.toRanges ( self.indexes[1] ) ) ) == 0
+    assert not indexcodec.contains ( empty, [ 1, 2 ] ).any()
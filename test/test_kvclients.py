@@ -0,0 +1,200 @@
+# Copyright 2014 Open Connectome Project (http://openconnecto.me)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+
+sys.path += [os.path.abspath('../django')]
+import OCP.settings
+os.environ['DJANGO_SETTINGS_MODULE'] = 'OCP.settings'
+
+import kvstandins
+kvstandins.install()
+
+import riakkvio
+import askvio
+
+# Test the Riak and Aerospike kvios against the stand-in clients
+#
+# Test_Riak and Test_Aerospike
+# 1 - test_cubes
+# 2 - test_cube
+# 3 - test_neariso
+# 4 - test_timecubes
+# 5 - test_indexes
+# 6 - test_exceptions
+# 7 - test_channels
+
+
+class Project:
+
+  def getKVServer ( self ):
+    return 'localhost'
+
+  def getDBName ( self ):
+    return 'unittest_kv'
+
+class DB:
+
+  def __init__ ( self ):
+    self.proj = Project()
+
+class Channel:
+
+  def __init__ ( self, channame ):
+    self.channame = channame
+
+  def getChannelName ( self ):
+    return self.channame
+
+
+class KVClientTests:
+  """Tests shared by the kvios.  Subclasses set kvioclass and the name of their batch read call."""
+
+  def setup_class ( self ):
+    self.ch = Channel ( 'unit_anno' )
+
+  def setup_method ( self, method ):
+    kvstandins.clear()
+    self.kvio = self.kvioclass ( DB() )
+
+  def teardown_method ( self, method ):
+    self.kvio.close()
+
+  def test_cubes ( self ):
+    """Cubes are written in parallel and read in one batch in the order asked for"""
+
+    listofidxs = range ( 0, 64, 2 )
+    self.kvio.putCubes ( self.ch, listofidxs, 0, [ 'cube{}'.format(zidx) for zidx in listofidxs ] )
+    assert kvstandins.calls.get ( self.putcall ) == len(listofidxs)
+
+    kvstandins.calls.clear()
+    cuboids = list ( self.kvio.getCubes ( self.ch, range(64)[::-1], 0 ) )
+    assert cuboids == [ ( zidx, 'cube{}'.format(zidx) ) for zidx in range(64)[::-1] if zidx % 2 == 0 ]
+    assert kvstandins.calls.get ( self.batchcall ) == 1
+    assert kvstandins.calls.get ( self.getcall ) == 0
+
+    # ranges are inclusive
+    cuboids = list ( self.kvio.getCubeRanges ( self.ch, [ [0,4], [10,10] ], 0 ) )
+    assert [ zidx for zidx, cubestr in cuboids ] == [ 0, 2, 4, 10 ]
+
+    # other resolutions are separate
+    assert list ( self.kvio.getCubes ( self.ch, listofidxs, 1 ) ) == []
+
+  def test_cube ( self ):
+    """Single cubes"""
+
+    assert self.kvio.getCube ( self.ch, 7, 0 ) is None
+    self.kvio.putCube ( self.ch, 7, 0, 'seven' )
+    assert self.kvio.getCube ( self.ch, 7, 0 ) == 'seven'
+    self.kvio.putCube ( self.ch, 7, 0, 'SEVEN', True )
+    assert self.kvio.getCube ( self.ch, 7, 0 ) == 'SEVEN'
+
+  def test_neariso ( self ):
+    """Neariso cubes don't collide with the cubes"""
+
+    self.kvio.putCubes ( self.ch, [ 1, 2 ], 0, [ 'one', 'two' ] )
+    assert list ( self.kvio.getCubes ( self.ch, [ 1, 2 ], 0, neariso=True ) ) == []
+
+  def test_timecubes ( self ):
+    """Time cubes are read in one batch"""
+
+    for timestamp in range ( 0, 10, 3 ):
+      self.kvio.putTimeCube ( self.ch, 5, timestamp, 0, 'time{}'.format(timestamp) )
+
+    kvstandins.calls.clear()
+    cuboids = list ( self.kvio.getTimeCubes ( self.ch, 5, range(10), 0 ) )
+    assert cuboids == [ ( 5, timestamp, 'time{}'.format(timestamp) ) for timestamp in range ( 0, 10, 3 ) ]
+    assert kvstandins.calls.get ( self.batchcall ) == 1
+    assert self.kvio.getTimeCube ( self.ch, 5, 3, 0 ) == 'time3'
+    assert self.kvio.getTimeCube ( self.ch, 5, 4, 0 ) is None
+
+  def test_indexes ( self ):
+    """Indexes come back in order with None for the missing ones"""
+
+    self.kvio.putIndexes ( self.ch, 0, [ ( annid, 'index{}'.format(annid) ) for annid in [ 3, 1, 4 ] ] )
+    self.kvio.putIndex ( self.ch, 5, 0, 'index5' )
+
+    kvstandins.calls.clear()
+    assert self.kvio.getIndexes ( self.ch, [ 1, 2, 3, 4, 5 ], 0 ) == [ 'index1', None, 'index3', 'index4', 'index5' ]
+    assert kvstandins.calls.get ( self.batchcall ) == 1
+    assert self.kvio.getIndexes ( self.ch, [], 0 ) == []
+
+    assert self.kvio.getIndex ( self.ch, 3, 0 ) == 'index3'
+    assert self.kvio.getIndex ( self.ch, 2, 0 ) == []
+
+    self.kvio.deleteIndex ( self.ch, 5, 0 )
+    self.kvio.deleteIndexes ( self.ch, 0, [ 1, 2, 3 ] )
+    assert self.kvio.getIndexes ( self.ch, [ 1, 2, 3, 4, 5 ], 0 ) == [ None, None, None, 'index4', None ]
+
+  def test_exceptions ( self ):
+    """Exceptions are kept per cuboid and annotation"""
+
+    assert self.kvio.getExceptions ( self.ch, 9, 0, 1 ) == []
+    self.kvio.putExceptions ( self.ch, 9, 0, 1, 'excs1' )
+    self.kvio.putExceptions ( self.ch, 9, 0, 2, 'excs2' )
+    assert self.kvio.getExceptions ( self.ch, 9, 0, 1 ) == 'excs1'
+    assert self.kvio.getExceptions ( self.ch, 9, 1, 1 ) == []
+
+    self.kvio.deleteExceptions ( self.ch, 9, 0, 1 )
+    assert self.kvio.getExceptions ( self.ch, 9, 0, 1 ) == []
+    assert self.kvio.getExceptions ( self.ch, 9, 0, 2 ) == 'excs2'
+
+    # deleting what isn't there is not an error
+    self.kvio.deleteExceptions ( self.ch, 9, 0, 1 )
+
+  def test_channels ( self ):
+    """Channels of a project share a bucket or set without colliding"""
+
+    other = Channel ( 'unit_anno2' )
+    self.kvio.putCubes ( self.ch, [ 1 ], 0, [ 'mine' ] )
+    self.kvio.putCubes ( other, [ 1 ], 0, [ 'other' ] )
+    self.kvio.putIndex ( other, 1, 0, 'otherindex' )
+
+    assert list ( self.kvio.getCubes ( self.ch, [ 1 ], 0 ) ) == [ ( 1, 'mine' ) ]
+    assert list ( self.kvio.getCubes ( other, [ 1 ], 0 ) ) == [ ( 1, 'other' ) ]
+    assert self.kvio.getIndex ( self.ch, 1, 0 ) == []
+
+
+class Test_Riak ( KVClientTests ):
+
+  kvioclass = riakkvio.RiakKVIO
+  batchcall = 'riak.multiget'
+  getcall = 'riak.get'
+  putcall = 'riak.store'
+
+
+class Test_Aerospike ( KVClientTests ):
+
+  kvioclass = askvio.AerospikeKVIO
+  batchcall = 'aerospike.get_many'
+  getcall = 'aerospike.get'
+  putcall = 'aerospike.put'
+
+  def test_values ( self ):
+    """Values are stored as blobs and read back as strings"""
+
+    self.kvio.putCube ( self.ch, 1, 0, '\x00\x93OCP\xff' )
+    assert self.kvio.getCube ( self.ch, 1, 0 ) == '\x00\x93OCP\xff'
+    assert isinstance ( kvstandins.asrecords.values()[0][askvio.VALUEBIN], bytearray )
+
+  def test_deleteset ( self ):
+    """Deleting a project removes only its records"""
+
+    self.kvio.putCubes ( self.ch, [ 1, 2 ], 0, [ 'one', 'two' ] )
+    kvstandins.asrecords[( 'ocp', 'otherproject', 'unit_anno:cuboid:0:1' )] = { askvio.VALUEBIN : bytearray('keep') }
+
+    askvio.deleteSet ( 'localhost', 'unittest_kv' )
+    assert list ( self.kvio.getCubes ( self.ch, [ 1, 2 ], 0 ) ) == []
+    assert kvstandins.asrecords.keys() == [ ( 'ocp', 'otherproject', 'unit_anno:cuboid:0:1' ) ]